@@ -1 +1,7 @@
-from modules import config  # noqa: F401
+import importlib
+
+# modules.config is imported on first access instead of with the package
+def __getattr__(name):
+    if name == 'config':
+        return importlib.import_module(f"{__name__}.config")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,254 @@
+from contextlib import contextmanager
+from pathlib import Path
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import time
+
+import pandas as pd
+import pyarrow as pa
+import typer
+from loguru import logger
+
+from benchmarks.synthetic import generate, SYNTHETIC_DATA_DIR, YEARS
+from dataset_modules.processor import (
+    filter_water, clean_water, clean_livestock, concat_livestock, read_livestock_files, read_water_streaming, LIVESTOCK_PARTITION_COLS,
+)
+from dataset_modules.outliers import outlier_flags
+from dataset_modules.profiler import profile_report
+from dataset_modules.uploader import write_parquet, write_parquet_dataset
+from dataset_modules.workbook import load_workbook
+from modules.config import PROJ_ROOT, REPORTS_DIR, POLLUTANTS
+
+app = typer.Typer()
+
+BENCHMARK_DIR = REPORTS_DIR / 'benchmarks'
+# Stages slower than the baseline by more than this fraction are reported as regressions
+REGRESSION_THRESHOLD = 0.10
+# Differences below this number of seconds are timer noise and never reported
+MIN_DIFFERENCE = 0.05
+
+class StageTimer:
+    """
+    Wall time of the stages of a run, with the rows each stage produced.
+    """
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the code of the block. Assign the output to `record['output']` to also record its rows.
+        """
+        record = {}
+        start = time.perf_counter()
+        yield record
+        seconds = time.perf_counter() - start
+
+        output = record.pop('output', None)
+        stage = self.stages.setdefault(name, {'runs': []})
+        stage['runs'].append(seconds)
+        if output is not None:
+            stage['rows'] = sum(len(df) for df in output) if isinstance(output, list) else len(output)
+        logger.info(f"{name}: {seconds:.3f} s")
+
+def water_stages(timer, workbook_path, work_dir, profile):
+    """
+    Run the water quality stages of processor.water_process on a workbook.
+    """
+    with timer.stage('water.read') as record:
+        sheets = load_workbook(workbook_path, use_cache=False)
+        record['output'] = sheets[1]
+
+    # Second read, from the Parquet cache of the workbook
+    cache_dir = work_dir / 'workbooks'
+    load_workbook(workbook_path, cache_dir=cache_dir)
+    with timer.stage('water.read_cached'):
+        load_workbook(workbook_path, cache_dir=cache_dir)
+
+    # Streaming mode of water_process: only the results of the studied sites are kept
+    with timer.stage('water.read_streaming') as record:
+        record['output'] = read_water_streaming(workbook_path)[1]
+
+    with timer.stage('water.merge_filter') as record:
+        water = filter_water(sheets[0], sheets[1])
+        record['output'] = water
+
+    with timer.stage('water.numeric') as record:
+        water = clean_water(water)
+        record['output'] = water
+
+    with timer.stage('water.outliers') as record:
+        water = pd.concat([water, outlier_flags(water, POLLUTANTS)], axis=1)
+        record['output'] = water
+
+    with timer.stage('water.parquet_write') as record:
+        write_parquet(water, work_dir / 'water_quality_tidy_data.parquet')
+        record['output'] = water
+
+    if profile:
+        with timer.stage('water.profile') as record:
+            profile_report(water, work_dir / 'water_report.html', title="Water benchmark", cache_dir=work_dir / 'profiles')
+            record['output'] = water
+
+def livestock_stages(timer, livestock_paths, work_dir, profile, max_workers=None):
+    """
+    Run the livestock stages of processor.process_data and livestock_process on the SIAP files.
+    """
+    with timer.stage('livestock.read') as record:
+        files = read_livestock_files(livestock_paths, max_workers=max_workers, cache_dir=None)
+        record['output'] = files
+
+    with timer.stage('livestock.merge_filter') as record:
+        livestock = concat_livestock(files)
+        record['output'] = livestock
+
+    with timer.stage('livestock.numeric') as record:
+        livestock = clean_livestock(livestock)
+        record['output'] = livestock
+
+    with timer.stage('livestock.parquet_write') as record:
+        write_parquet_dataset(livestock, work_dir / 'livestock_tidy_data.parquet', LIVESTOCK_PARTITION_COLS)
+        record['output'] = livestock
+
+    if profile:
+        with timer.stage('livestock.profile') as record:
+            profile_report(livestock, work_dir / 'livestock_report.html', title="Livestock benchmark", cache_dir=work_dir / 'profiles')
+            record['output'] = livestock
+
+def git_commit():
+    """
+    Commit of the working tree and whether it has uncommitted changes, or (None, None) outside git.
+    """
+    try:
+        import git
+        repo = git.Repo(PROJ_ROOT)
+        return repo.head.commit.hexsha, repo.is_dirty()
+    except Exception:
+        return None, None
+
+def run_benchmark(scale=1, repeat=3, profile=True, max_workers=None, data_dir=SYNTHETIC_DATA_DIR, years=YEARS):
+    """
+    Time every stage of the pipeline on synthetic inputs.
+
+    Each repetition runs in a new working directory, so no stage reuses the caches of the
+    previous one (except water.read_cached, which measures the workbook cache).
+
+    Args:
+    - scale (float): Size of the synthetic inputs (1, 10, 100).
+    - repeat (int): Number of runs of every stage.
+    - profile (bool): Also time the profile reports.
+    - max_workers (int): Processes used to read the livestock files.
+    - data_dir (Path): Directory of the synthetic inputs.
+    - years (list of int): Years of the livestock files.
+
+    Returns:
+    - dict: Environment, inputs and the seconds of each stage (best and every run).
+    """
+    workbook_path, livestock_paths = generate(scale=scale, output_dir=data_dir, years=years)
+    timer = StageTimer()
+
+    for idx in range(repeat):
+        logger.info(f"Benchmark run {idx + 1} of {repeat} at scale {scale:g}x")
+        work_dir = Path(data_dir) / f"{scale:g}x" / 'run'
+        shutil.rmtree(work_dir, ignore_errors=True)
+        work_dir.mkdir(parents=True)
+
+        try:
+            water_stages(timer, workbook_path, work_dir, profile)
+            livestock_stages(timer, livestock_paths, work_dir, profile, max_workers=max_workers)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit, dirty = git_commit()
+    stages = {
+        name: {'seconds': min(stage['runs']), 'median': statistics.median(stage['runs']), **stage}
+        for name, stage in timer.stages.items()
+    }
+
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'scale': scale,
+        'repeat': repeat,
+        'environment': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'pyarrow': pa.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'inputs': {path.name: path.stat().st_size for path in [workbook_path, *livestock_paths]},
+        'stages': stages,
+        'total_seconds': sum(stage['seconds'] for stage in stages.values()),
+    }
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD, min_difference=MIN_DIFFERENCE):
+    """
+    Compare the stage times of two benchmark results.
+
+    Returns:
+    - pd.DataFrame: Seconds of each stage in both results, their ratio and a regression flag.
+    """
+    stages = sorted(set(baseline['stages']) | set(current['stages']))
+    comparison = pd.DataFrame({
+        'baseline': [baseline['stages'].get(name, {}).get('seconds') for name in stages],
+        'current': [current['stages'].get(name, {}).get('seconds') for name in stages],
+    }, index=pd.Index(stages, name='stage'), dtype='float64')
+    comparison['ratio'] = comparison['current'] / comparison['baseline']
+    comparison['regression'] = (comparison['ratio'] > 1 + threshold) & (comparison['current'] - comparison['baseline'] > min_difference)
+    return comparison
+
+@app.command()
+def run(
+    scale: float = typer.Option(1, help="Size of the synthetic inputs (1, 10, 100)"),
+    repeat: int = typer.Option(3, help="Number of runs of every stage. The best one is reported"),
+    profile: bool = typer.Option(True, help="Also time the profile reports"),
+    workers: int = typer.Option(None, help="Processes used to read the livestock files"),
+    output_dir: Path = typer.Option(BENCHMARK_DIR, help="Directory of the JSON results"),
+):
+    """
+    Time every stage of the pipeline on synthetic data and save the results as JSON.
+    """
+    result = run_benchmark(scale=scale, repeat=repeat, profile=profile, max_workers=workers)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    commit = (result['commit'] or 'nogit')[:8]
+    output_path = output_dir / f"{datetime.date.today():%Y%m%d}-{commit}-{scale:g}x.json"
+    with open(output_path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    for name, stage in result['stages'].items():
+        logger.info(f"{name:<25} {stage['seconds']:>9.3f} s {stage.get('rows', ''):>10}")
+    logger.success(f"Benchmark results saved to {output_path}")
+
+@app.command()
+def compare(
+    baseline: Path = typer.Argument(..., help="JSON results of the reference commit"),
+    current: Path = typer.Argument(..., help="JSON results to check"),
+    threshold: float = typer.Option(REGRESSION_THRESHOLD, help="Slowdown reported as a regression (0.1 is 10%)"),
+):
+    """
+    Compare two benchmark results and exit with an error if a stage got slower.
+    """
+    with open(baseline) as f, open(current) as g:
+        baseline_result, current_result = json.load(f), json.load(g)
+
+    if baseline_result['scale'] != current_result['scale']:
+        logger.warning(f"Comparing results of different scales ({baseline_result['scale']}x and {current_result['scale']}x)")
+
+    comparison = compare_results(baseline_result, current_result, threshold=threshold)
+    typer.echo(comparison.to_string(float_format='{:.3f}'.format))
+
+    regressions = comparison.index[comparison['regression']].tolist()
+    if regressions:
+        logger.error(f"Stages slower than the baseline: {', '.join(regressions)}")
+        raise typer.Exit(1)
+    logger.success("No regressions")
+
+if __name__ == "__main__":
+    app()
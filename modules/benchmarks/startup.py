@@ -0,0 +1,144 @@
+from pathlib import Path
+import os
+import subprocess
+import sys
+from typing import List, Optional
+import typer
+from loguru import logger
+from modules.config import PROJ_ROOT
+
+app = typer.Typer()
+
+# Entry points of the Makefile, their import time budget for a cold `--help` in milliseconds
+# (as reported by -X importtime) and the modules `--help` must not import
+ENTRY_POINTS = {
+    'data': {
+        'args': ['modules/dataset.py'],
+        'budget_ms': 400,
+        'forbidden': ['pandas', 'pyarrow', 'sklearn', 'git', 'requests', 'ydata_profiling'],
+    },
+    'download': {
+        'args': ['-m', 'dataset_modules.downloader'],
+        'budget_ms': 500,
+        'forbidden': ['pandas', 'pyarrow', 'sklearn', 'git', 'ydata_profiling'],
+    },
+    'dvc_setup': {
+        'args': ['modules/dvc_modules/dvc_manager.py'],
+        'budget_ms': 400,
+        'forbidden': ['pandas', 'pyarrow', 'sklearn', 'git', 'requests'],
+    },
+    'process': {
+        'args': ['-m', 'dataset_modules.processor'],
+        'budget_ms': 1000,
+        'forbidden': ['sklearn', 'git', 'ydata_profiling'],
+    },
+    'features': {
+        'args': ['modules/features.py'],
+        'budget_ms': 1000,
+        'forbidden': ['sklearn', 'git', 'ydata_profiling'],
+    },
+    'train': {
+        'args': ['modules/modeling/train.py'],
+        'budget_ms': 1100,
+        'forbidden': ['sklearn', 'git', 'ydata_profiling'],
+    },
+    'predict': {
+        'args': ['modules/modeling/predict.py'],
+        'budget_ms': 1100,
+        'forbidden': ['sklearn', 'git', 'ydata_profiling'],
+    },
+    'decompose': {
+        'args': ['-m', 'dataset_modules.timeseries'],
+        'budget_ms': 1000,
+        'forbidden': ['sklearn', 'statsmodels', 'git'],
+    },
+    'benchmark': {
+        'args': ['modules/benchmarks/pipeline.py'],
+        'budget_ms': 1100,
+        'forbidden': ['sklearn', 'git', 'ydata_profiling'],
+    },
+}
+# Top-level imports listed when an entry point is over its budget
+SLOWEST = 8
+
+def import_times(args, cwd=PROJ_ROOT):
+    """
+    Run `python -X importtime <args> --help` in a new interpreter.
+
+    Returns:
+    - dict: Cumulative import time in microseconds of each top-level module imported.
+    """
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(Path(cwd) / 'modules'), str(cwd)])}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args, '--help'],
+        cwd=cwd, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} --help failed:\n{result.stderr[-2000:]}")
+
+    times = {}
+    # Lines are "import time: self [us] | cumulative | imported package", nested imports are indented
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+def check_entry_point(name, entry, repeat=3):
+    """
+    Measure the imports of an entry point and compare them with its budget.
+
+    The best of `repeat` runs is kept, the first ones also warm the file system cache.
+
+    Returns:
+    - dict: Import time in ms, budget, forbidden modules imported and slowest top-level imports.
+    """
+    runs = [import_times(entry['args']) for _ in range(repeat)]
+    times = min(runs, key=lambda times: sum(times.values()))
+    total_ms = sum(times.values()) / 1000
+    imported = {module.split('.')[0] for run in runs for module in run}
+
+    return {
+        'entry_point': name,
+        'import_ms': round(total_ms, 1),
+        'budget_ms': entry['budget_ms'],
+        'forbidden': sorted(imported & set(entry['forbidden'])),
+        'slowest': sorted(times.items(), key=lambda item: -item[1])[:SLOWEST],
+    }
+
+@app.command()
+def main(
+    entry_point: Optional[List[str]] = typer.Option(None, help="Entry points to check (e.g. data). Default is all of them"),
+    repeat: int = typer.Option(3, help="Runs of every entry point. The best one is compared with the budget"),
+):
+    """
+    Check that a cold `--help` of every entry point stays under its import time budget and
+    does not import the heavy dependencies its commands load when they run.
+    """
+    names = entry_point or list(ENTRY_POINTS)
+    unknown = [name for name in names if name not in ENTRY_POINTS]
+    if unknown:
+        raise typer.BadParameter(f"Unknown entry points {unknown}. Use one of {list(ENTRY_POINTS)}")
+
+    failed = []
+    for name in names:
+        result = check_entry_point(name, ENTRY_POINTS[name], repeat=repeat)
+        over = result['import_ms'] > result['budget_ms']
+        logger.info(f"{name:<12} {result['import_ms']:>8.1f} ms (budget {result['budget_ms']} ms)")
+
+        if over:
+            slowest = ', '.join(f"{module} {us / 1000:.0f} ms" for module, us in result['slowest'])
+            logger.error(f"{name} imports take {result['import_ms']:.0f} ms, over its budget. Slowest: {slowest}")
+        if result['forbidden']:
+            logger.error(f"{name} --help imports {', '.join(result['forbidden'])}; import them inside the commands that use them")
+        if over or result['forbidden']:
+            failed.append(name)
+
+    if failed:
+        raise typer.Exit(1)
+    logger.success("All the entry points are within their import budget")
+
+if __name__ == "__main__":
+    app()
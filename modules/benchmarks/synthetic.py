@@ -0,0 +1,178 @@
+from pathlib import Path
+import json
+import numpy as np
+import pandas as pd
+import typer
+from loguru import logger
+from modules.config import INTERIM_DATA_DIR, POLLUTANTS, MUNICIPALITY, LIVESTOCK_MUNICIPALITY, LIVESTOCK_SPECIES
+
+app = typer.Typer()
+
+SYNTHETIC_DATA_DIR = INTERIM_DATA_DIR / 'benchmark'
+
+# Size of the inputs at scale 1, close to the real files: one SIAP file per year and the
+# sites and results sheets of the CONAGUA workbook
+LIVESTOCK_ROWS = 20_000
+WATER_SITES = 2_000
+WATER_RESULTS = 20_000
+YEARS = list(range(2013, 2024))
+
+# Share of the rows in the studied municipalities, the rest is filtered out by the pipeline
+STUDY_FRACTION = 0.05
+
+# Bump when the generated files change, so the cached ones are generated again
+GENERATOR_VERSION = 1
+
+# Other SIAP species and products, filtered out by LIVESTOCK_SPECIES
+OTHER_SPECIES = ['Ave', 'Guajolote', 'Abeja']
+PRODUCTS = [(1, 'Ganado en pie'), (2, 'Carne en canal'), (3, 'Leche'), (4, 'Lana'), (5, 'Huevo-plato'), (6, 'Miel')]
+
+# Parameters of the results sheet that are not used by the pipeline
+OTHER_PARAMETERS = ['SST_mg/L', 'CONDUCT_mS/cm', 'ALC_mg/L', 'DUR_mg/L', 'AS_TOT', 'CD_TOT', 'CR_TOT', 'HG_TOT', 'PB_TOT', 'NI_TOT']
+WATER_BODY_TYPES = ['LÓTICO', 'LÉNTICO', 'SUBTERRÁNEO', 'COSTERO']
+
+def amounts(rng, size, scale):
+    """
+    Lognormal amounts formatted as in the SIAP files ('1,234.50'), with a few empty values.
+    """
+    values = pd.Series(rng.lognormal(np.log(scale), 1.5, size)).map('{:,.2f}'.format)
+    return values.mask(rng.random(size) < 0.01, '')
+
+def livestock_frame(year, rows, rng):
+    """
+    Synthetic SIAP livestock file of a year (cierre_YYYY.csv columns).
+    """
+    study = rng.random(rows) < STUDY_FRACTION
+    other_municipalities = [f"Municipio {idx}" for idx in range(1, 2_400)]
+
+    municipality = np.where(
+        study,
+        rng.choice(LIVESTOCK_MUNICIPALITY, rows),
+        rng.choice(other_municipalities, rows),
+    )
+    species = rng.choice(LIVESTOCK_SPECIES + OTHER_SPECIES, rows)
+    product = rng.integers(0, len(PRODUCTS), rows)
+
+    return pd.DataFrame({
+        'Anio': year,
+        'Cveestado': np.where(study, 26, rng.integers(1, 33, rows)),
+        'Nomestado': np.where(study, 'Sonora', 'Otro estado'),
+        'Cveddr': rng.integers(100, 200, rows),
+        'Nomddr': 'DDR',
+        'Cvempio': rng.integers(1, 73, rows),
+        'Nommunicipio': municipality,
+        'Cveespecie': rng.integers(1, 8, rows),
+        'Nomespecie': species,
+        'Cveproducto': [PRODUCTS[idx][0] for idx in product],
+        'Nomproducto': [PRODUCTS[idx][1] for idx in product],
+        'Volumen': amounts(rng, rows, 500),
+        'Precio': amounts(rng, rows, 50),
+        'Valor': amounts(rng, rows, 25_000),
+    })
+
+def water_values(rng, size):
+    """
+    Results of a parameter as read from the workbook: numbers mixed with detection limits
+    ('<10', '>2400') and missing values.
+    """
+    values = pd.Series(np.round(rng.lognormal(2, 1.2, size), 3), dtype=object)
+    limits = rng.random(size)
+    values[limits < 0.05] = '<10'
+    values[(limits >= 0.05) & (limits < 0.07)] = '>2400'
+    values[limits > 0.7] = None
+    return values
+
+def water_sheets(sites, results, rng):
+    """
+    Synthetic CONAGUA workbook: sites, results and dictionary sheets.
+    """
+    study = rng.random(sites) < STUDY_FRACTION
+    site_keys = np.array([f"SIN-{idx:06d}" for idx in range(sites)])
+
+    df_site = pd.DataFrame({
+        'CLAVE SITIO': site_keys,
+        'NOMBRE DEL SITIO': [f"SITIO {idx}" for idx in range(sites)],
+        'ORGANISMO DE CUENCA': 'NOROESTE',
+        'ESTADO': np.where(study, 'SONORA', 'OTRO ESTADO'),
+        'MUNICIPIO': np.where(study, rng.choice(MUNICIPALITY, sites), 'OTRO MUNICIPIO'),
+        'ACUIFERO': 'ACUIFERO',
+        'CUERPO DE AGUA': np.where(study, 'RIO SONORA', 'OTRO'),
+        'TIPO CUERPO DE AGUA': rng.choice(WATER_BODY_TYPES, sites),
+        'SUBTIPO CUERPO AGUA': 'RIO',
+        'LATITUD': rng.uniform(28.5, 31.4, sites),
+        'LONGITUD': rng.uniform(-111.3, -109.7, sites),
+    })
+
+    # Excel serial dates between 2012 and 2023, as read by pyxlsb
+    df_result = pd.DataFrame({
+        'CLAVE SITIO': rng.choice(site_keys, results),
+        'CLAVE MONITOREO': np.arange(results),
+        'FECHA REALIZACIÓN': rng.uniform(40909, 45291, results).round(),
+    })
+    for parameter in POLLUTANTS + OTHER_PARAMETERS:
+        df_result[parameter] = water_values(rng, results)
+
+    df_dic = pd.DataFrame({
+        'CLAVE PARÁMETRO': POLLUTANTS + OTHER_PARAMETERS,
+        'PARÁMETRO': POLLUTANTS + OTHER_PARAMETERS,
+        'UNIDAD': 'mg/L',
+    })
+
+    return df_site, df_result, df_dic
+
+def generate(scale=1, output_dir=SYNTHETIC_DATA_DIR, years=YEARS, seed=0):
+    """
+    Generate the synthetic inputs of the pipeline at a scale, reusing the ones already generated.
+
+    The workbook is written as .xlsx since .xlsb files cannot be written from Python;
+    load_workbook reads both.
+
+    Args:
+    - scale (float): Multiplier of the number of rows (1, 10, 100).
+    - output_dir (Path): Directory of the generated inputs. A subdirectory per scale is used.
+    - years (list of int): Years of the livestock files.
+    - seed (int): Seed of the generator.
+
+    Returns:
+    - tuple (Path, list of Path): The water workbook and the livestock files.
+    """
+    output_dir = Path(output_dir) / f"{scale:g}x"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workbook_path = output_dir / 'water_quality_raw_data.xlsx'
+    livestock_paths = [output_dir / f"livestock_{year}_raw_data.csv" for year in years]
+
+    # Inputs generated by the same version of the generator with the same arguments are reused
+    spec = {'version': GENERATOR_VERSION, 'scale': scale, 'years': list(years), 'seed': seed}
+    spec_path = output_dir / 'spec.json'
+    if spec_path.exists() and json.loads(spec_path.read_text()) == spec and all(p.exists() for p in [workbook_path, *livestock_paths]):
+        logger.info(f"Using the synthetic inputs in {output_dir}")
+        return workbook_path, livestock_paths
+
+    rng = np.random.default_rng(seed)
+
+    for year, path in zip(years, livestock_paths):
+        livestock_frame(year, int(LIVESTOCK_ROWS * scale), rng).to_csv(path, index=False, encoding='ISO-8859-1')
+    logger.info(f"{len(livestock_paths)} livestock files of {int(LIVESTOCK_ROWS * scale)} rows written to {output_dir}")
+
+    sheets = water_sheets(int(WATER_SITES * scale), int(WATER_RESULTS * scale), rng)
+    with pd.ExcelWriter(workbook_path, engine='openpyxl') as writer:
+        for sheet, name in zip(sheets, ['SITIOS', 'RESULTADOS', 'DICCIONARIO']):
+            sheet.to_excel(writer, sheet_name=name, index=False)
+    logger.info(f"Water workbook with {len(sheets[1])} results written to {workbook_path}")
+
+    spec_path.write_text(json.dumps(spec))
+    return workbook_path, livestock_paths
+
+@app.command()
+def main(
+    scale: float = typer.Option(1, help="Multiplier of the number of rows (1, 10, 100)"),
+    output_dir: Path = typer.Option(SYNTHETIC_DATA_DIR, help="Directory of the generated inputs"),
+    seed: int = typer.Option(0, help="Seed of the generator"),
+):
+    """
+    Generate synthetic SIAP livestock files and a CONAGUA workbook.
+    """
+    generate(scale=scale, output_dir=output_dir, seed=seed)
+
+if __name__ == "__main__":
+    app()
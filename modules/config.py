@@ -1,20 +1,17 @@
 from pathlib import Path
+import functools
 import os
-from dotenv import load_dotenv
 from loguru import logger
 
-# Load environment variables from .env file if it exists
-load_dotenv()
-
 # Paths
 PROJ_ROOT = Path(__file__).resolve().parents[1]
-logger.info(f"PROJ_ROOT path is: {PROJ_ROOT}")
 
 DATA_DIR = PROJ_ROOT / "data"
 RAW_DATA_DIR = DATA_DIR / "raw"
 INTERIM_DATA_DIR = DATA_DIR / "interim"
 PROCESSED_DATA_DIR = DATA_DIR / "processed"
 EXTERNAL_DATA_DIR = DATA_DIR / "external"
+CACHE_DIR = INTERIM_DATA_DIR / "cache"
 
 MODELS_DIR = PROJ_ROOT / "models"
 
@@ -26,10 +23,19 @@ DOCS_DIR = PROJ_ROOT / "docs"
 
 DVC_ROOT = PROJ_ROOT / '.dvc'
 
-# Remote
-DVC_REMOTE = os.getenv("DVC_REMOTE")
-DVC_GDRIVE_CLIENT_ID = os.getenv("DVC_GDRIVE_CLIENT_ID")
-DVC_GDRIVE_CLIENT_SECRET = os.getenv("DVC_GDRIVE_CLIENT_SECRET")
+# Settings read from the environment (or the .env file) with their defaults. They are resolved
+# on first access (see __getattr__), so importing config does not read .env
+ENV_SETTINGS = {
+    # Remote
+    'DVC_REMOTE': None,
+    'DVC_GDRIVE_CLIENT_ID': None,
+    'DVC_GDRIVE_CLIENT_SECRET': None,
+    # Profile reports: 'minimal', 'sampled' (stratified by year/municipality) or 'full' (explorative)
+    'PROFILE_MODE': 'sampled',
+}
+
+# Rows of the stratified sample of the 'sampled' profile reports
+PROFILE_SAMPLE_ROWS = 10000
 
 #URLs
 URL_LIST = [
@@ -233,8 +239,30 @@ URL_LIST = [
 
 # Info
 POLLUTANTS = ['OD_mg/L', 'DBO_TOT', 'DQO_TOT', 'COLI_FEC', 'E_COLI', 'N_TOT', 'P_TOT', 'TOX_D_48_UT', 'TOX_FIS_SUP_15_UT']
+
 MUNICIPALITY = ['ARIZPE', 'BANÁMICHI', 'HUÉPAC', 'ACONCHI', 'SAN FELIPE', 'BAVIÁCORA', 'URES', 'CANANEA']
 
+# Livestock (SIAP names, 'Baviácora ' keeps the trailing space used in the source files)
+LIVESTOCK_MUNICIPALITY = ['Huepac', 'Ures', 'Aconchi', 'Arizpe', 'Banámichi', 'Baviácora ', 'Cananea', 'San Felipe de Jesús']
+LIVESTOCK_SPECIES = ['Bovino', 'Caprino', 'Porcino', 'Ovino']
+
+
+@functools.cache
+def load_environment():
+    """Load the variables of the .env file, if it exists, the first time a setting is read."""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+def __getattr__(name):
+    # Called only for names not defined above, e.g. `from modules.config import DVC_REMOTE`
+    if name not in ENV_SETTINGS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    load_environment()
+    value = os.getenv(name, ENV_SETTINGS[name])
+    globals()[name] = value
+    return value
+
 
 # If tqdm is installed, configure loguru with tqdm.write
 # https://github.com/Delgan/loguru/issues/135
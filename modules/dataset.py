@@ -1,16 +1,129 @@
+from functools import partial
 from pathlib import Path
+from typing import List, Optional
+import re
 import typer
 from loguru import logger
 from tqdm import tqdm
-from dataset_modules.downloader import download_file
-from dataset_modules.processor import process_data
-from dvc_modules.dvc_manager import check_dvc_repo, add_dvc_remote
-from modules.config import PROCESSED_DATA_DIR, RAW_DATA_DIR, URL_LIST
+from dataset_modules.dag import Dag
+from modules.metrics import PipelineMetrics
+from dvc_modules.dvc_manager import check_dvc_repo, add_dvc_remote, push_to_dvc_remote, DvcSession
+from modules.config import PROCESSED_DATA_DIR, RAW_DATA_DIR, DOCS_DIR, URL_LIST, PROFILE_MODE
 
 app = typer.Typer()
 
+def setup_dvc():
+    # Verificar si estamos en un repositorio DVC
+    check_dvc_repo()
+
+    # Check remote
+    add_dvc_remote()
+
+def build_dag(session, dvc_session, sources=URL_LIST, max_workers=4, refresh=False, force=False, publish=True, profile_mode=PROFILE_MODE, streaming=False):
+    """
+    Pipeline of dataset.py as a DAG: one node per source download, per processed output, per
+    profile report, and the DVC and GitHub publication at the end.
+
+    The water branch (workbook -> tidy water -> imputed water) and the livestock branch
+    (SIAP files -> tidy livestock) do not depend on each other, so they run at the same time.
+
+    Args:
+    - session (requests.Session): HTTP session shared by the downloads.
+    - dvc_session (DvcSession): Session collecting the files to add to DVC.
+    - sources (list of dict): Entries of URL_LIST.
+    - max_workers (int): Maximum number of nodes running at once, used to lay out the download bars.
+    - refresh (bool): Download again the sources that changed.
+    - force (bool): Rebuild the outputs even if their inputs did not change.
+    - publish (bool): Create the profile reports and push them to GitHub.
+    - profile_mode (str): Mode of the profile reports.
+    - streaming (bool): Read the water results sheet in blocks of rows, keeping only the studied sites.
+
+    Returns:
+    - Dag: The pipeline.
+    """
+    from dataset_modules.downloader import download_file
+    from dataset_modules.processor import (
+        water_stage, impute_stage, livestock_stage, yearly_stage, profile_output, upload_report,
+        WATER_RAW_FILE, LIVESTOCK_FILE_PATTERN, WATER_OUTPUT_FILE, IMPUTED_OUTPUT_FILE, LIVESTOCK_OUTPUT_FILE, YEARLY_OUTPUT_FILE, REPORTS,
+    )
+
+    dag = Dag()
+    # DVC is set up with any target, since the selected outputs are added to it at the end
+    dag.add('dvc.setup', setup_dvc, always=True)
+
+    downloads = {}
+    for idx, source in enumerate(sources):
+        input_path = Path(RAW_DATA_DIR) / source['file']
+        downloads[source['file']] = f"download.{source['file']}"
+        dag.add(
+            downloads[source['file']],
+            partial(
+                download_file, url=source['url'], info=source['info'], input_path=input_path, session=session,
+                position=idx % max_workers, refresh=refresh, dvc_session=dvc_session,
+            ),
+            outputs=[input_path],
+        )
+
+    if WATER_RAW_FILE in downloads:
+        dag.add(
+            'water', partial(water_stage, force=force, dvc_session=dvc_session, report=False, streaming=streaming),
+            deps=[downloads[WATER_RAW_FILE]], inputs=[RAW_DATA_DIR / WATER_RAW_FILE], outputs=[PROCESSED_DATA_DIR / WATER_OUTPUT_FILE],
+        )
+        dag.add(
+            'impute', partial(impute_stage, force=force, dvc_session=dvc_session),
+            deps=['water'], inputs=[PROCESSED_DATA_DIR / WATER_OUTPUT_FILE], outputs=[PROCESSED_DATA_DIR / IMPUTED_OUTPUT_FILE],
+        )
+
+    livestock_files = [Path(RAW_DATA_DIR) / name for name in downloads if re.match(LIVESTOCK_FILE_PATTERN, name)]
+    if livestock_files:
+        dag.add(
+            'livestock', partial(livestock_stage, livestock_files, force=force, dvc_session=dvc_session, report=False),
+            deps=[downloads[path.name] for path in livestock_files], inputs=livestock_files, outputs=[PROCESSED_DATA_DIR / LIVESTOCK_OUTPUT_FILE],
+        )
+
+    if 'water' in dag.nodes and 'livestock' in dag.nodes:
+        dag.add(
+            'yearly', partial(yearly_stage, force=force, dvc_session=dvc_session),
+            deps=['water', 'livestock'], outputs=[PROCESSED_DATA_DIR / YEARLY_OUTPUT_FILE],
+        )
+
+    # New raw files and processed outputs are added to DVC (and pushed) once, after every
+    # selected node finished. It also runs when some of them failed, so the outputs of the
+    # nodes that completed (already recorded in the build manifest) reach DVC
+    builds = [name for name in dag.nodes if name != 'dvc.setup']
+    dag.add('publish.dvc', dvc_session.flush, deps=['dvc.setup'] + builds, always=True)
+
+    # Profile reports of the outputs that changed, pushed to GitHub in a single commit (none if
+    # no report was created again)
+    if publish:
+        profiles = []
+        for name in REPORTS:
+            if name in dag.nodes:
+                dag.add(
+                    f"profile.{name}", partial(profile_output, name, mode=profile_mode, force=force),
+                    deps=[name], outputs=[DOCS_DIR / REPORTS[name][1]],
+                )
+                profiles.append(name)
+
+        dag.add(
+            'publish.reports', partial(upload_report, [DOCS_DIR / REPORTS[name][1] for name in profiles]),
+            deps=[f"profile.{name}" for name in profiles] + ['publish.dvc'],
+        )
+
+    return dag
+
 @app.command()
 def main(
+    workers: int = typer.Option(4, help="Maximum number of nodes (downloads, processing, reports) running at once"),
+    refresh: bool = typer.Option(False, help="Download again the sources that changed since the last download"),
+    force: bool = typer.Option(False, help="Rebuild the processed outputs even if their inputs did not change"),
+    publish: bool = typer.Option(True, help="Create the profile reports and push reports and data to GitHub and DVC"),
+    publish_only: bool = typer.Option(False, help="Only publish the reports and data already processed"),
+    profile_mode: str = typer.Option(PROFILE_MODE, help="Profile reports mode: minimal, sampled or full"),
+    profile: bool = typer.Option(False, help="Profile the run with cProfile and save it next to the stage metrics"),
+    target: Optional[List[str]] = typer.Option(None, help="Build only this node and the ones it depends on (e.g. water). Can be repeated"),
+    dry_run: bool = typer.Option(False, help="Show the nodes that would run, in order, without running them"),
+    streaming: bool = typer.Option(False, help="Read the water results sheet in blocks of rows, keeping only the studied sites (lower memory)"),
     #url: str = typer.Option(None, help="URL of the dataset to download"),
     #file: str = typer.Option(None, help="File name to save the dataset (optional)"),
     #input_path: Path = typer.Option(None, help="Optional path to save the dataset"),
@@ -22,23 +135,37 @@ def main(
     #         raise typer.Exit()
     #     input_path = RAW_DATA_DIR / file
 
-    # Verificar si estamos en un repositorio DVC
-    check_dvc_repo()
-
-    # Check remote
-    add_dvc_remote()   
-    
-    # Download files
-    if URL_LIST:
-        for url in URL_LIST:
-            input_path = RAW_DATA_DIR / url['file']
-            download_file(url=url['url'], info=url['info'], input_path=input_path)
-        logger.success(f"All files have been downloaded successfully !")
-    else:
+    if not URL_LIST:
         logger.error(f"URL_LIST is empty")
-    
-    # Process data
-    process_data()
+        raise typer.Exit(1)
+
+    # pandas, pyarrow and requests are imported here rather than at the top, so --help starts fast
+    from dataset_modules.downloader import create_session
+    from dataset_modules.processor import publish_outputs
+    from dataset_modules.publisher import PublishQueue
+
+    # Wall time, CPU time, memory, rows and bytes of every stage are appended to reports/metrics
+    with PipelineMetrics(profile=profile):
+        if publish_only:
+            setup_dvc()
+            with PublishQueue(profile_mode=profile_mode) as publisher:
+                publish_outputs(publisher)
+            push_to_dvc_remote()
+            return
+
+        with create_session(pool_size=workers) as session:
+            dvc_session = DvcSession(push=publish)
+            dag = build_dag(
+                session, dvc_session, max_workers=workers, refresh=refresh, force=force,
+                publish=publish, profile_mode=profile_mode, streaming=streaming,
+            )
+
+            if dry_run:
+                for name, deps in dag.select(target).items():
+                    typer.echo(f"{name}" + (f" <- {', '.join(deps)}" if deps else ""))
+                return
+
+            dag.run(targets=target, max_workers=workers)
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,166 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+from loguru import logger
+from modules.metrics import stage, current_stage, profiled
+
+class Node:
+    """
+    Step of the pipeline: a function without arguments, the nodes it depends on and the
+    files it reads and writes.
+
+    Args:
+    - name (str): Name of the node, used by --target.
+    - func (callable): Function run by the node.
+    - deps (list of str): Nodes that must finish before this one.
+    - inputs (list of Path): Files read by the node (informative).
+    - outputs (list of Path): Files written by the node (informative).
+    - always (bool): Run the node with any target, once the selected nodes it depends on
+      finished, even if some of them failed (e.g. pushing to DVC the outputs of the nodes
+      that completed).
+    """
+    def __init__(self, name, func, deps=(), inputs=(), outputs=(), always=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.always = always
+
+class Dag:
+    """
+    Run the nodes of a pipeline in a pool of threads, each one as soon as the nodes it
+    depends on finished.
+
+    The heavy work of the nodes runs in pandas/pyarrow, in worker processes or in
+    subprocesses, so threads are enough to run independent branches at the same time.
+    When a node fails, the nodes that depend on it are skipped (except the `always` ones) and
+    the rest keep running.
+
+    Usage:
+        dag = Dag()
+        dag.add('download', download)
+        dag.add('process', process, deps=['download'])
+        dag.run(targets=['process'], max_workers=4)
+    """
+    def __init__(self):
+        self.nodes = {}
+
+    def add(self, name, func, deps=(), inputs=(), outputs=(), always=False):
+        if name in self.nodes:
+            raise ValueError(f"Node {name} already exists")
+        self.nodes[name] = Node(name, func, deps=deps, inputs=inputs, outputs=outputs, always=always)
+        return self.nodes[name]
+
+    def ancestors(self, targets):
+        """
+        The targets and all the nodes they depend on.
+        """
+        selected = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in selected:
+                continue
+            if name not in self.nodes:
+                raise ValueError(f"Unknown node {name}. Nodes: {', '.join(self.nodes)}")
+            selected.add(name)
+            pending.extend(self.nodes[name].deps)
+        return selected
+
+    def select(self, targets=None):
+        """
+        Nodes needed to build the targets (all the nodes if None) and their dependencies
+        within the selection, in topological order.
+
+        Returns:
+        - dict: Dependencies of each selected node, by node name.
+        """
+        if not targets:
+            selected = set(self.nodes)
+        else:
+            selected = self.ancestors(targets)
+            # Nodes run with any target, limited to the selected nodes they depend on
+            selected |= {name for name, node in self.nodes.items() if node.always}
+
+        graph = {name: [dep for dep in self.nodes[name].deps if dep in selected] for name in self.nodes if name in selected}
+
+        for name, node in self.nodes.items():
+            missing = [dep for dep in node.deps if dep not in self.nodes]
+            if missing:
+                raise ValueError(f"Node {name} depends on unknown nodes {missing}")
+
+        # Topological order (Kahn), which also detects cycles
+        ordered = []
+        remaining = {name: set(deps) for name, deps in graph.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Cycle between the nodes {sorted(remaining)}")
+            for name in ready:
+                ordered.append(name)
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+        return {name: graph[name] for name in ordered}
+
+    def run_node(self, name, parent=None):
+        start = time.perf_counter()
+        logger.info(f"Running node {name}")
+        with stage(f"node.{name}", parent=parent), profiled():
+            self.nodes[name].func()
+        logger.success(f"Node {name} completed in {time.perf_counter() - start:.1f} s")
+
+    def run(self, targets=None, max_workers=4):
+        """
+        Run the nodes needed to build the targets.
+
+        Args:
+        - targets (list of str): Nodes to build. Default is all the nodes.
+        - max_workers (int): Maximum number of nodes running at the same time.
+
+        Returns:
+        - dict: Status of each selected node: 'done', 'failed' or 'skipped'.
+
+        Raises:
+        - RuntimeError: If a node failed, once all the nodes that could run finished.
+        """
+        graph = self.select(targets)
+        status = {}
+        running = {}
+        # Nodes run in other threads, which do not see the stage running in this one
+        parent = current_stage()
+        logger.info(f"Running {len(graph)} nodes with up to {max_workers} at once: {', '.join(graph)}")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while len(status) < len(graph):
+                for name, deps in graph.items():
+                    if name in status or name in running.values():
+                        continue
+                    if self.nodes[name].always:
+                        if all(dep in status for dep in deps):
+                            running[executor.submit(self.run_node, name, parent)] = name
+                    elif any(status.get(dep) in ('failed', 'skipped') for dep in deps):
+                        logger.warning(f"Skipping node {name}: a node it depends on did not complete")
+                        status[name] = 'skipped'
+                    elif all(status.get(dep) == 'done' for dep in deps):
+                        running[executor.submit(self.run_node, name, parent)] = name
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        status[name] = 'done'
+                    except Exception as e:
+                        logger.error(f"Node {name} failed: {e}")
+                        status[name] = 'failed'
+
+        failed = [name for name, value in status.items() if value == 'failed']
+        if failed:
+            raise RuntimeError(f"{len(failed)} node(s) failed: {', '.join(failed)}")
+
+        return status
@@ -3,81 +3,359 @@ import typer
 from loguru import logger
 from tqdm import tqdm
 import os
-import urllib.request
+import json
 import requests
 import datetime
-from dvc_modules.dvc_manager import add_file_to_dvc, push_to_dvc_remote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from modules.metrics import stage
+from dvc_modules.dvc_manager import add_file_to_dvc, push_to_dvc_remote, DvcSession
+from modules.config import RAW_DATA_DIR, URL_LIST
 
 app = typer.Typer()
 
-def download_file(url: str, info: str, input_path: Path):
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = (10, 60)
+# Status codes of servers that do not answer HEAD requests
+HEAD_NOT_SUPPORTED = (403, 405, 501)
+
+def create_session(pool_size=8, retries=3):
+    """
+    Create an HTTP session with a connection pool shared by all the downloads.
+
+    Args:
+    - pool_size (int): Maximum number of connections kept per host.
+    - retries (int): Number of retries on connection errors and 5xx responses.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=1, status_forcelist=[500, 502, 503, 504]),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def download_file(url: str, info: str, input_path: Path, session=None, track=True, chunk_size=CHUNK_SIZE, position=None, refresh=False, dvc_session=None):
     """
     Main command to download a dataset from a URL and save it to the specified file name.
 
+    The body is streamed once to a temporary `.part` file, resumed with an HTTP Range request
+    if the transfer is interrupted, and renamed to its final name when complete.
+
     Args:
     - url: URL from which to download the dataset.
+    - info: Dataset additional information, saved in the info file.
     - input_path: The path to save the downloaded dataset as.
+    - session: requests.Session to reuse. A new one is created if not provided.
+    - track: Add the downloaded file to DVC and push it. Default is True.
+    - chunk_size: Number of bytes written on each iteration.
+    - position: Position of the progress bar when several downloads run at once.
+    - refresh: Download the file again if the source changed since the last download. Default is False.
+    - dvc_session: DvcSession collecting the files to add to DVC. If not provided, the file is added and pushed at once.
+
+    Returns:
+    - bool: True if the file was downloaded, False if it already existed or did not change.
     """
     
     SOURCE = url
-    INPUT_PATH = input_path
+    INPUT_PATH = Path(input_path)
     SUBDIR = INPUT_PATH.parent
     FILE_NAME = INPUT_PATH.name
+    PART_PATH = SUBDIR / (FILE_NAME + '.part')
 
-    logger.info(f"Starting download from {SOURCE}")
-    response = requests.get(SOURCE, stream=True)
-    total_size = int(response.headers.get('content-length', 0))    
+    if session is None:
+        session = create_session()
 
     # Check if the file already exists
-    if not os.path.exists(INPUT_PATH):
-        logger.info(f"File {FILE_NAME} not found. Starting download...")
-
-        # Create subdirectory if it does not exist
-        if not os.path.exists(SUBDIR):
-            os.makedirs(SUBDIR)
-            logger.info(f"Created directory {SUBDIR}")
-
-        # Download the file from the link provided
-        urllib.request.urlretrieve(SOURCE, INPUT_PATH)
-        logger.success(f"Download completed: {INPUT_PATH}")
-
-        with open(INPUT_PATH, 'wb') as file, tqdm(
-            desc="Downloading",
-            total=total_size,
-            unit='B',
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as bar:
-            for data in response.iter_content(1024):
-                bar.update(len(data))
-                file.write(data)
-
-        logger.success(f"Download completed: {INPUT_PATH}")
-
-        # Create info file with dataset details
-        INFO_FILE_NAME = FILE_NAME.split('.')[0] + ".txt"
-        INFO_FILE_PATH = os.path.join(SUBDIR, INFO_FILE_NAME)
-        logger.info(f"Creating {INFO_FILE_NAME} file with dataset details")
-
-        with open(INFO_FILE_PATH, 'w') as f:
-            f.write("Information from water quality monitoring sites operated by Conagua throughout the country\n\n")
-            # info = info
-            f.write(info + '\n')
-            f.write("Downloaded on " + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\n")
-            f.write("From: " + SOURCE + "\n")
-            f.write("Name: " + FILE_NAME + "\n")
-        logger.success(f"Info file {INFO_FILE_NAME} created at {SUBDIR}")
-        
-        # Create the data profile report and save the report as an HTML file
-        handle_dvc(input_path)
+    if INPUT_PATH.exists():
+        if not refresh:
+            logger.info(f"File {FILE_NAME} already exists in the directory {SUBDIR}. Skipping download. ")
+            return False
+
+        if not source_changed(session, SOURCE, INPUT_PATH):
+            logger.info(f"File {FILE_NAME} is up to date. Skipping download. ")
+            return False
 
+        logger.info(f"Source of {FILE_NAME} changed. Starting download from {SOURCE}")
+
+        # A partial file of the previous version cannot be resumed
+        PART_PATH.unlink(missing_ok=True)
     else:
-        logger.info(f"File {FILE_NAME} already exists in the directory {SUBDIR}. Skipping download. ")
+        logger.info(f"File {FILE_NAME} not found. Starting download from {SOURCE}")
+
+    # Create subdirectory if it does not exist
+    if not SUBDIR.exists():
+        SUBDIR.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Created directory {SUBDIR}")
+
+    with stage('download', file=FILE_NAME) as record:
+        headers = fetch(session, SOURCE, PART_PATH, chunk_size=chunk_size, position=position)
+        record.wrote(PART_PATH)
+
+    # The file only gets its final name once it is complete
+    os.replace(PART_PATH, INPUT_PATH)
+    logger.success(f"Download completed: {INPUT_PATH}")
+
+    write_info_file(INPUT_PATH, SOURCE, info)
+    write_metadata(INPUT_PATH, SOURCE, headers)
+
+    if track:
+        handle_dvc(INPUT_PATH, dvc_session=dvc_session)
+
+    return True
+
+def fetch(session, url, part_path, chunk_size=CHUNK_SIZE, max_attempts=5, position=None):
+    """
+    Stream a URL into a `.part` file, resuming from the bytes already written.
+
+    Args:
+    - session: requests.Session used for the requests.
+    - url: URL of the file.
+    - part_path: Temporary file where the body is written.
+    - chunk_size: Number of bytes written on each iteration.
+    - max_attempts: Number of times the transfer is resumed before giving up.
+    - position: Position of the progress bar.
+
+    Returns:
+    - dict: Headers of the last response.
+    """
+    part_path = Path(part_path)
+
+    for attempt in range(1, max_attempts + 1):
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=TIMEOUT) as response:
+                if response.status_code == 416:
+                    # The partial file does not match the remote one anymore, start over
+                    logger.warning(f"Cannot resume {part_path.name}, restarting download")
+                    part_path.unlink()
+                    continue
+
+                response.raise_for_status()
+
+                if offset and response.status_code == 206:
+                    logger.info(f"Resuming {part_path.name} from byte {offset}")
+                    mode = 'ab'
+                else:
+                    # The server ignored the Range header and sent the whole body
+                    offset = 0
+                    mode = 'wb'
+
+                length = response.headers.get('content-length')
+                total_size = offset + int(length) if length is not None else None
 
-def handle_dvc(file_path, remote='origin'):
+                with open(part_path, mode) as file, tqdm(
+                    desc=f"Downloading {part_path.stem}",
+                    initial=offset,
+                    total=total_size,
+                    unit='B',
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    position=position,
+                    leave=position is None,
+                ) as bar:
+                    for data in response.iter_content(chunk_size):
+                        file.write(data)
+                        bar.update(len(data))
+
+            size = part_path.stat().st_size
+            if total_size is not None and size < total_size:
+                raise requests.exceptions.ChunkedEncodingError(f"Received {size} of {total_size} bytes")
+            return response.headers
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            logger.warning(f"Download of {url} interrupted (attempt {attempt}/{max_attempts}): {e}")
+
+    raise RuntimeError(f"Failed to download {url} after {max_attempts} attempts")
+
+def write_info_file(input_path, url, info):
     """
-        Create the data profile report and save the report as an HTML file
+    Create info file with dataset details next to the downloaded file.
     """
+    INPUT_PATH = Path(input_path)
+    SUBDIR = INPUT_PATH.parent
+    FILE_NAME = INPUT_PATH.name
+    INFO_FILE_NAME = FILE_NAME.split('.')[0] + ".txt"
+    INFO_FILE_PATH = SUBDIR / INFO_FILE_NAME
+    logger.info(f"Creating {INFO_FILE_NAME} file with dataset details")
+
+    with open(INFO_FILE_PATH, 'w') as f:
+        f.write("Information from water quality monitoring sites operated by Conagua throughout the country\n\n")
+        f.write(info + '\n')
+        f.write("Downloaded on " + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\n")
+        f.write("From: " + url + "\n")
+        f.write("Name: " + FILE_NAME + "\n")
+    logger.success(f"Info file {INFO_FILE_NAME} created at {SUBDIR}")
+
+def get_metadata_path(input_path):
+    """
+    Path of the metadata file of a dataset, next to its info file.
+    """
+    INPUT_PATH = Path(input_path)
+    return INPUT_PATH.parent / (INPUT_PATH.name.split('.')[0] + ".meta.json")
+
+def read_metadata(input_path):
+    """
+    Read the ETag, Last-Modified and Content-Length recorded for a dataset.
+
+    Returns:
+    - dict: The recorded metadata, empty if there is none.
+    """
+    META_PATH = get_metadata_path(input_path)
+    if not META_PATH.exists():
+        return {}
+    with open(META_PATH) as f:
+        return json.load(f)
+
+def write_metadata(input_path, url, headers):
+    """
+    Record the validators sent by the server for a downloaded dataset.
+
+    Args:
+    - input_path (Path): Path of the downloaded dataset.
+    - url (str): URL of the dataset.
+    - headers (dict): Headers of the response.
+    """
+    INPUT_PATH = Path(input_path)
+    metadata = {
+        'url': url,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_length': INPUT_PATH.stat().st_size,
+        'checked_on': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(get_metadata_path(INPUT_PATH), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+def source_changed(session, url, input_path):
+    """
+    Check if the source of a downloaded dataset changed, without downloading its body.
+
+    A conditional HEAD request is sent with the recorded ETag and Last-Modified. Servers that
+    do not support HEAD get the same conditional GET, closed as soon as the headers arrive. If
+    the server ignores the conditions, the validators and the size in the response are compared
+    with the recorded ones. Files downloaded before the metadata existed are compared by size only.
+
+    If the check fails (network error, error status), the source is considered unchanged and the
+    downloaded file is kept.
+
+    Args:
+    - session: requests.Session used for the request.
+    - url (str): URL of the dataset.
+    - input_path (Path): Path of the downloaded dataset.
+
+    Returns:
+    - bool: True if the dataset has to be downloaded again.
+    """
+    metadata = read_metadata(input_path)
+    headers = {}
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+
+    try:
+        response = session.head(url, headers=headers, allow_redirects=True, timeout=TIMEOUT)
+
+        if response.status_code in HEAD_NOT_SUPPORTED:
+            logger.info(f"HEAD not supported by {url} ({response.status_code}). Checking it with GET")
+            # Only the headers are read, the body is never downloaded
+            response = session.get(url, headers=headers, allow_redirects=True, timeout=TIMEOUT, stream=True)
+            response.close()
+
+        if response.status_code == 304:
+            return False
+
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning(f"Could not check if {url} changed: {e}. Keeping {Path(input_path).name}")
+        return False
+
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    length = response.headers.get('content-length')
+    size = int(length) if length is not None else None
+
+    if metadata.get('etag') and etag:
+        changed = etag != metadata['etag']
+    elif metadata.get('last_modified') and last_modified:
+        changed = last_modified != metadata['last_modified']
+    else:
+        changed = size is None or size != Path(input_path).stat().st_size
+
+    if not changed and not metadata:
+        # Start tracking the validators of files downloaded before the metadata existed
+        write_metadata(input_path, url, response.headers)
+
+    return changed
+
+def download_all(sources, raw_dir=RAW_DATA_DIR, max_workers=4, track=True, refresh=False, dvc_session=None):
+    """
+    Download several datasets at once with a bounded pool of workers sharing one HTTP session.
+
+    Files are added to DVC once all the downloads have finished, since DVC does not allow
+    concurrent operations on the same repository.
+
+    Args:
+    - sources (list of dict): Entries with 'url', 'info' and 'file' keys, as in URL_LIST.
+    - raw_dir (Path): Directory where the files are saved.
+    - max_workers (int): Maximum number of simultaneous downloads.
+    - track (bool): Add the downloaded files to DVC and push them. Default is True.
+    - refresh (bool): Download again the files whose source changed. Default is False.
+    - dvc_session (DvcSession): Session collecting the files to add to DVC. If not provided, each file is added and pushed.
+
+    Returns:
+    - list of Path: Files that were downloaded.
+    """
+    downloaded = []
+    errors = []
+
+    with create_session(pool_size=max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                download_file,
+                url=source['url'],
+                info=source['info'],
+                input_path=Path(raw_dir) / source['file'],
+                session=session,
+                track=False,
+                position=idx % max_workers,
+                refresh=refresh,
+            ): Path(raw_dir) / source['file']
+            for idx, source in enumerate(sources)
+        }
+
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                if future.result():
+                    downloaded.append(path)
+            except Exception as e:
+                logger.error(f"Error downloading {path.name}: {e}")
+                errors.append(path)
+
+    if track:
+        for path in downloaded:
+            handle_dvc(path, dvc_session=dvc_session)
+
+    if errors:
+        raise RuntimeError(f"Failed to download {len(errors)} file(s): {', '.join(p.name for p in errors)}")
+
+    return downloaded
+
+def handle_dvc(file_path, remote='origin', dvc_session=None):
+    """
+        Add the downloaded file to DVC and push it, or register it in the DVC session if provided
+    """
+    if dvc_session is not None:
+        dvc_session.track(file_path)
+        return
+
     # Add the downloaded file to DVC
     add_file_to_dvc(file_path)
 
@@ -93,5 +371,16 @@ def download(url: str = typer.Argument(help="URL of the dataset to download"),
     """
     download_file(url, info, input_path)
 
+@app.command()
+def download_sources(
+    workers: int = typer.Option(4, help="Maximum number of simultaneous downloads"),
+    refresh: bool = typer.Option(False, help="Download again the files whose source changed"),
+):
+    """
+    Download all the files in URL_LIST concurrently.
+    """
+    with DvcSession() as dvc_session:
+        download_all(URL_LIST, max_workers=workers, refresh=refresh, dvc_session=dvc_session)
+
 if __name__ == "__main__":
     app()
\ No newline at end of file
@@ -0,0 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import os
+import joblib
+import numpy as np
+import pandas as pd
+from loguru import logger
+from modules.config import POLLUTANTS
+
+# Kilometres equivalent to one day when comparing samples: two samples of the same site taken
+# 30 days apart are as far as two sites 15 km apart sampled on the same day
+KM_PER_DAY = 0.5
+KM_PER_DEGREE = 111.32
+N_NEIGHBORS = 5
+
+class NeighborImputer:
+    """
+    Impute missing pollutant values with the nearest samples in space and time.
+
+    For each water body type and pollutant, a BallTree is built over the (latitude, longitude,
+    date) of the samples where the pollutant was measured. A missing value is the inverse
+    distance weighted mean, in log scale, of its nearest measured samples. Samples of the same
+    site are at distance 0 in space, so its closest measurements in time come first.
+
+    The fitted trees are saved with `save`, so new samples are imputed with `transform` without
+    building them again.
+
+    Args:
+    - columns (list of str): Columns to impute.
+    - group_column (str): Samples are only compared with samples of the same group.
+    - n_neighbors (int): Number of measured samples used for each missing value.
+    - km_per_day (float): Weight of the time distance, in km per day.
+    - max_workers (int): Threads used to build and query the trees of the columns.
+    """
+    def __init__(self, columns=POLLUTANTS, group_column='TIPO CUERPO DE AGUA', n_neighbors=N_NEIGHBORS,
+                 km_per_day=KM_PER_DAY, max_workers=None):
+        self.columns = list(columns)
+        self.group_column = group_column
+        self.n_neighbors = n_neighbors
+        self.km_per_day = km_per_day
+        self.max_workers = max_workers
+
+    def get_params(self):
+        return {
+            'columns': self.columns,
+            'group_column': self.group_column,
+            'n_neighbors': self.n_neighbors,
+            'km_per_day': self.km_per_day,
+        }
+
+    def coordinates(self, df):
+        """
+        Position of each sample in km: latitude, longitude (scaled by the latitude of the
+        fitted data) and date. Rows without location or date are NaN.
+        """
+        days = (df['FECHA REALIZACIÓN'] - pd.Timestamp('2000-01-01')).dt.days
+        return np.column_stack([
+            df['LATITUD'].astype('float64') * KM_PER_DEGREE,
+            df['LONGITUD'].astype('float64') * KM_PER_DEGREE * self.lon_scale_,
+            days.astype('float64') * self.km_per_day,
+        ])
+
+    def fit(self, df):
+        """
+        Build the trees of every group and column from the measured values.
+        """
+        # scikit-learn is only needed to fit; processor.py imports this module on every command
+        from sklearn.neighbors import BallTree
+
+        self.lon_scale_ = float(np.cos(np.radians(df['LATITUD'].astype('float64').mean())))
+        coords = self.coordinates(df)
+        located = ~np.isnan(coords).any(axis=1)
+        groups = df[self.group_column].astype(object).to_numpy()
+
+        def fit_column(column):
+            values = df[column].to_numpy(dtype='float64')
+            trees = {}
+            for group in pd.unique(groups[located]):
+                known = located & (groups == group) & ~np.isnan(values)
+                if known.any():
+                    trees[group] = (BallTree(coords[known]), np.log1p(values[known]))
+            return column, trees
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.trees_ = dict(executor.map(fit_column, self.columns))
+
+        logger.info(f"Imputer fitted on {len(df)} samples, {sum(len(t) for t in self.trees_.values())} trees")
+        return self
+
+    def transform(self, df):
+        """
+        Impute the missing values of the columns.
+
+        Returns:
+        - tuple (pd.DataFrame, pd.DataFrame): A copy of df with the imputed values and a boolean
+          mask of the imputed values, one column per imputed column.
+        """
+        coords = self.coordinates(df)
+        located = ~np.isnan(coords).any(axis=1)
+        groups = df[self.group_column].astype(object).to_numpy()
+
+        def transform_column(column):
+            values = df[column].to_numpy(dtype='float64').copy()
+            imputed = np.zeros(len(df), dtype=bool)
+
+            for group, (tree, known) in self.trees_[column].items():
+                rows = np.flatnonzero(located & (groups == group) & np.isnan(values))
+                if not len(rows):
+                    continue
+
+                distances, idx = tree.query(coords[rows], k=min(self.n_neighbors, len(known)))
+                weights = 1 / (distances + 1e-6)
+                values[rows] = np.expm1((weights * known[idx]).sum(axis=1) / weights.sum(axis=1))
+                imputed[rows] = True
+
+            return column, values, imputed
+
+        result = df.copy()
+        mask = pd.DataFrame(index=df.index)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for column, values, imputed in executor.map(transform_column, self.columns):
+                result[column] = values
+                mask[column] = imputed
+
+        logger.info(f"{int(mask.to_numpy().sum())} values imputed in {len(df)} samples")
+        return result, mask
+
+    def save(self, path):
+        """
+        Save the fitted imputer, replacing the previous one only when complete.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        joblib.dump(self, tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
+
+def impute_incremental(df, previous, imputer, keys=('CLAVE SITIO', 'FECHA REALIZACIÓN')):
+    """
+    Impute only the samples that are new or changed since the previous imputed output.
+
+    Samples of the previous output whose measured values did not change keep their imputed
+    values; the others are imputed with the already fitted imputer.
+
+    Args:
+    - df (pd.DataFrame): Current tidy water data.
+    - previous (pd.DataFrame): Previous imputed output, with the <column>_imputed flags.
+    - imputer (NeighborImputer): Fitted imputer.
+    - keys (tuple of str): Columns identifying a sample. Repeated keys are numbered in order.
+
+    Returns:
+    - tuple (pd.DataFrame, pd.DataFrame): Imputed data and mask of imputed values, in the order of df.
+    """
+    keys = list(keys)
+    columns = imputer.columns
+
+    def with_row_key(frame):
+        return frame.assign(_n=frame.groupby(keys, dropna=False).cumcount())
+
+    current = with_row_key(df.reset_index(drop=True))
+    flags = [f"{column}_imputed" for column in columns]
+    old = with_row_key(previous)[keys + ['_n'] + columns + flags]
+
+    # Measured values of the previous output: the imputed ones are removed
+    for column in columns:
+        old[f"{column}_measured"] = old[column].mask(old[f"{column}_imputed"])
+
+    merged = current[keys + ['_n'] + columns].merge(old, on=keys + ['_n'], how='left', suffixes=('', '_old'), indicator=True)
+    unchanged = merged['_merge'].eq('both').to_numpy()
+    for column in columns:
+        same = (merged[column] == merged[f"{column}_measured"]) | (merged[column].isna() & merged[f"{column}_measured"].isna())
+        unchanged &= same.to_numpy()
+
+    logger.info(f"{int((~unchanged).sum())} new or changed samples of {len(df)}")
+
+    result = df.reset_index(drop=True).copy()
+    mask = pd.DataFrame(False, index=result.index, columns=columns)
+
+    for column in columns:
+        result.loc[unchanged, column] = merged.loc[unchanged, f"{column}_old"].to_numpy()
+        mask.loc[unchanged, column] = merged.loc[unchanged, f"{column}_imputed"].to_numpy(dtype=bool)
+
+    if (~unchanged).any():
+        new_values, new_mask = imputer.transform(result[~unchanged])
+        result.loc[~unchanged, columns] = new_values[columns]
+        mask.loc[~unchanged, columns] = new_mask[columns]
+
+    return result, mask
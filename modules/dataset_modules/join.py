@@ -0,0 +1,151 @@
+import re
+import unicodedata
+import pandas as pd
+from loguru import logger
+from modules.config import REFERENCES_DIR, POLLUTANTS
+
+MUNICIPALITY_DIM_FILE = REFERENCES_DIR / 'municipality_dimension.csv'
+KEYS = ['Clave_INEGI', 'Año']
+
+def normalize_name(name):
+    """
+    Normalize a municipality name so the spellings of CONAGUA and SIAP compare equal.
+
+    Accents are removed, the text is uppercased and the whitespace is collapsed:
+    'HUÉPAC', 'Huepac' and 'Huépac ' all become 'HUEPAC'.
+    """
+    if pd.isna(name):
+        return None
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r'\s+', ' ', text).strip().upper()
+
+def load_municipalities(path=MUNICIPALITY_DIM_FILE):
+    """
+    Read the municipality dimension table.
+
+    Args:
+    - path (Path): CSV with Clave_INEGI, Clave_Estado, Clave_Municipio, Nombre_Municipio and
+      Alias (alternative spellings separated by '|').
+
+    Returns:
+    - pd.DataFrame: One row per municipality, with Clave_INEGI as index.
+    """
+    municipalities = pd.read_csv(path, dtype={'Alias': str}, keep_default_na=False)
+    return municipalities.set_index('Clave_INEGI')
+
+def alias_lookup(municipalities):
+    """
+    Map every normalized spelling (canonical name and aliases) to its INEGI code.
+    """
+    lookup = {}
+    for code, row in municipalities.iterrows():
+        names = [row['Nombre_Municipio']] + [alias for alias in row['Alias'].split('|') if alias]
+        for name in names:
+            key = normalize_name(name)
+            if lookup.get(key, code) != code:
+                raise ValueError(f"Alias {name} is used by the municipalities {lookup[key]} and {code}")
+            lookup[key] = code
+    return lookup
+
+def municipality_codes(names, municipalities):
+    """
+    INEGI code of each municipality name.
+
+    The names are normalized once per distinct value, so categorical and repeated columns are
+    resolved with a dictionary lookup instead of a string comparison per row.
+
+    Args:
+    - names (pd.Series): Municipality names in any of the known spellings.
+    - municipalities (pd.DataFrame): Dimension table from load_municipalities.
+
+    Returns:
+    - pd.Series: Int64 codes, <NA> for the names that are not in the dimension table.
+    """
+    lookup = alias_lookup(municipalities)
+    distinct = pd.Series(pd.unique(names.dropna()))
+    mapping = dict(zip(distinct, distinct.map(lambda name: lookup.get(normalize_name(name)))))
+
+    unknown = [name for name, code in mapping.items() if pd.isna(code)]
+    if unknown:
+        logger.warning(f"Municipalities not in {MUNICIPALITY_DIM_FILE.name}: {unknown}")
+
+    return names.astype(object).map(mapping).astype('Int64')
+
+def water_yearly(water, municipalities, pollutants=POLLUTANTS):
+    """
+    Aggregate the water quality samples by municipality and year.
+
+    Returns:
+    - pd.DataFrame: Number of sites and samples, and mean and max of each pollutant, by Clave_INEGI and Año.
+    """
+    water = water.assign(Clave_INEGI=municipality_codes(water['MUNICIPIO'], municipalities))
+    water = water.dropna(subset=KEYS)
+    grouped = water.groupby(KEYS)
+
+    yearly = grouped.agg(
+        Sitios=('CLAVE SITIO', 'nunique'),
+        Muestras=('CLAVE SITIO', 'size'),
+    )
+    stats = grouped[pollutants].agg(['mean', 'max'])
+    stats.columns = [f"{pollutant}_{stat}" for pollutant, stat in stats.columns]
+
+    return yearly.join(stats)
+
+def livestock_yearly(livestock, municipalities):
+    """
+    Aggregate the livestock production by municipality and year.
+
+    SIAP files carry the state and municipality codes, so the INEGI code is built from them
+    and the names are only used for the rows without codes.
+
+    Returns:
+    - pd.DataFrame: Volumen of each species and product (Volumen_<species>_<product>) and the
+      total Valor Total, by Clave_INEGI and Año.
+    """
+    codes = (livestock['Clave_Estado'] * 1000 + livestock['Clave_Municipio']).astype('Int64')
+    by_name = municipality_codes(livestock['Nombre_Municipio'], municipalities)
+    livestock = livestock.assign(Clave_INEGI=codes.where(codes.isin(municipalities.index), by_name))
+    livestock = livestock.dropna(subset=KEYS)
+
+    volume = livestock.pivot_table(
+        index=KEYS,
+        columns=['Nombre_Especie', 'Nombre_Producto'],
+        values='Volumen',
+        aggfunc='sum',
+        observed=True,
+    )
+    volume.columns = [
+        f"Volumen_{species}_{product}".replace(' ', '_') for species, product in volume.columns
+    ]
+    value = livestock.groupby(KEYS)['Valor Total'].sum(min_count=1).rename('Valor_Total')
+
+    return volume.join(value, how='outer')
+
+def build_water_livestock_yearly(water, livestock, municipalities=None):
+    """
+    Build the water-livestock fact table: one row per municipality and year.
+
+    Both sides are aggregated to Clave_INEGI and Año before joining, so the join is on two
+    integer keys. The join is outer, years with only water or only livestock data are kept.
+
+    Args:
+    - water (pd.DataFrame): Water quality tidy data (MUNICIPIO, Año, CLAVE SITIO and the pollutants).
+    - livestock (pd.DataFrame): Livestock tidy data.
+    - municipalities (pd.DataFrame): Dimension table. Default is the one in references/.
+
+    Returns:
+    - pd.DataFrame: Fact table sorted by Clave_INEGI and Año, with Nombre_Municipio.
+    """
+    municipalities = load_municipalities() if municipalities is None else municipalities
+
+    yearly = water_yearly(water, municipalities).join(
+        livestock_yearly(livestock, municipalities), how='outer'
+    ).sort_index().reset_index()
+
+    yearly['Clave_INEGI'] = yearly['Clave_INEGI'].astype('int64')
+    yearly['Año'] = yearly['Año'].astype('int64')
+    yearly[['Sitios', 'Muestras']] = yearly[['Sitios', 'Muestras']].astype('Int64')
+    yearly.insert(1, 'Nombre_Municipio', yearly['Clave_INEGI'].map(municipalities['Nombre_Municipio']))
+
+    return yearly
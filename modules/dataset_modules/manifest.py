@@ -0,0 +1,131 @@
+from pathlib import Path
+import datetime
+import hashlib
+import json
+import os
+import threading
+import yaml
+from loguru import logger
+from .workbook import file_md5
+from modules.config import PROCESSED_DATA_DIR, PROJ_ROOT
+
+MANIFEST_PATH = PROCESSED_DATA_DIR / 'build_manifest.json'
+
+_lock = threading.Lock()
+
+def config_hash(config):
+    """
+    Hash of a stage configuration (lists of pollutants, municipalities, species...).
+
+    Args:
+    - config (dict): JSON serializable configuration of the stage.
+    """
+    text = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def relative_path(path):
+    """
+    Path relative to the project root when possible, so the manifest does not depend on the checkout.
+    """
+    try:
+        return str(Path(path).resolve().relative_to(PROJ_ROOT))
+    except ValueError:
+        return str(path)
+
+def load_manifest(path=MANIFEST_PATH):
+    """
+    Read the build manifest. Returns an empty manifest if it does not exist.
+    """
+    if not Path(path).exists():
+        return {'stages': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def is_tracked(output):
+    """
+    Check that the current version of an output was added to DVC.
+
+    Files must have the md5 recorded in their .dvc file. For directories (Parquet datasets)
+    the total size and number of files recorded by DVC are compared instead.
+
+    Args:
+    - output (Path): File or directory tracked by DVC.
+    """
+    output = Path(output)
+    dvc_file = output.with_name(output.name + '.dvc')
+
+    if not output.exists() or not dvc_file.exists():
+        return False
+
+    with open(dvc_file) as f:
+        outs = [out for out in (yaml.safe_load(f) or {}).get('outs', []) if out.get('path') == output.name]
+
+    if not outs:
+        return False
+
+    if output.is_dir():
+        files = [f for f in output.rglob('*') if f.is_file()]
+        return outs[0].get('nfiles') == len(files) and outs[0].get('size') == sum(f.stat().st_size for f in files)
+
+    return outs[0].get('md5') == file_md5(output)
+
+def is_up_to_date(stage, inputs, config, outputs, path=MANIFEST_PATH, tracked=True):
+    """
+    Check if a stage was already built with the same inputs and configuration.
+
+    Stages are recorded as soon as they are built, while their outputs are added to DVC at the
+    end of the run. An output that did not reach DVC (e.g. the run failed before) is therefore
+    built again, so it is added and pushed by the next run.
+
+    Args:
+    - stage (str): Name of the stage.
+    - inputs (dict): md5 of each input file, by file name.
+    - config (dict): Configuration of the stage.
+    - outputs (list of Path): Files produced by the stage. All of them must exist.
+    - tracked (bool): Also require the outputs to be added to DVC. Default is True.
+    """
+    entry = load_manifest(path)['stages'].get(stage)
+
+    if entry is None:
+        return False
+
+    if entry.get('inputs') != inputs or entry.get('config') != config_hash(config):
+        return False
+
+    if not all(Path(output).exists() for output in outputs):
+        return False
+
+    untracked = [Path(output).name for output in outputs if tracked and not is_tracked(output)]
+    if untracked:
+        logger.warning(f"Outputs of stage {stage} not added to DVC: {', '.join(untracked)}. Building them again")
+        return False
+
+    return True
+
+def record_stage(stage, inputs, config, outputs, path=MANIFEST_PATH):
+    """
+    Save in the manifest the inputs and configuration a stage was built with.
+
+    Args:
+    - stage (str): Name of the stage.
+    - inputs (dict): md5 of each input file, by file name.
+    - config (dict): Configuration of the stage.
+    - outputs (list of Path): Files produced by the stage.
+    """
+    path = Path(path)
+
+    with _lock:
+        manifest = load_manifest(path)
+        manifest['stages'][stage] = {
+            'inputs': inputs,
+            'config': config_hash(config),
+            'outputs': [relative_path(output) for output in outputs],
+            'built_on': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    logger.info(f"Stage {stage} recorded in {path.name}")
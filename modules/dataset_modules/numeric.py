@@ -0,0 +1,139 @@
+from pathlib import Path
+import time
+import pandas as pd
+import typer
+from loguru import logger
+from modules.config import RAW_DATA_DIR
+
+app = typer.Typer()
+
+# Thousands separators in SIAP amounts ('1,234.50 '). Leading and trailing whitespace is always
+# removed, while inner whitespace ('1 234') is rejected like any other malformed value
+LIVESTOCK_STRIP = r','
+# Detection limit symbols in CONAGUA results ('<0.5', '>2400')
+WATER_STRIP = r'[<>]'
+
+def parse_numeric(series, strip=LIVESTOCK_STRIP):
+    """
+    Convert a column to float64 in a single vectorized pass.
+
+    The characters matching `strip` and the surrounding whitespace are removed and the rest
+    is parsed with pd.to_numeric.
+    Values that cannot be parsed become NaN and are reported in the rejected mask.
+
+    Args:
+    - series (pd.Series): Column to convert.
+    - strip (str): Regular expression of the characters to remove before parsing.
+
+    Returns:
+    - tuple (pd.Series, pd.Series): The float64 values and a boolean mask of rejected values.
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('float64'), pd.Series(False, index=series.index)
+
+    cleaned = series.astype('string').str.replace(strip, '', regex=True).str.strip()
+    values = pd.to_numeric(cleaned, errors='coerce').astype('float64')
+
+    # Empty strings and the text 'nan' are missing values, not rejected ones
+    rejected = cleaned.notna() & (cleaned != '') & (cleaned.str.lower() != 'nan') & values.isna()
+
+    return values, rejected.fillna(False).astype(bool)
+
+def parse_numeric_columns(df, columns, strip=LIVESTOCK_STRIP, flags=False):
+    """
+    Convert several columns of a DataFrame to float64 in place.
+
+    Args:
+    - df (pd.DataFrame): DataFrame with the columns to convert.
+    - columns (list of str): Columns to convert. Columns not in df are ignored.
+    - strip (str): Regular expression of the characters to remove before parsing.
+    - flags (bool): Also add to df a <column>_rejected flag of the values that could not be
+      converted, so they can be told apart from missing values. Flags already in df (e.g. set
+      when the column was converted by blocks of rows) are kept. Default is False.
+
+    Returns:
+    - pd.DataFrame: Boolean mask of rejected values, one column per converted column.
+    """
+    rejected = pd.DataFrame(index=df.index)
+
+    for column in columns:
+        if column not in df.columns:
+            continue
+
+        df[column], rejected[column] = parse_numeric(df[column], strip=strip)
+
+        if rejected[column].any():
+            logger.warning(f"{rejected[column].sum()} values of {column} could not be converted to numbers")
+
+        if flags:
+            flag = f"{column}_rejected"
+            df[flag] = df[flag] | rejected[column] if flag in df.columns else rejected[column]
+
+    return rejected
+
+def parse_excel_dates(series):
+    """
+    Convert Excel serial dates (days since 1899-12-30, as read by pyxlsb) to datetime64.
+
+    Columns that are already datetime are returned as they are. Values that are not serial
+    dates become NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+
+    serial = pd.to_numeric(series, errors='coerce')
+    return pd.to_datetime(serial, origin='1899-12-30', unit='D', errors='coerce')
+
+def legacy_parse(series):
+    """
+    Previous per-cell conversion of livestock_process, kept for the benchmark.
+    """
+    def clean_value(value):
+        if isinstance(value, str):
+            return value.replace(',', '').strip()
+        return value
+
+    def safe_float_conversion(value):
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return value
+
+    return series.apply(clean_value).apply(safe_float_conversion)
+
+@app.command()
+def benchmark(
+    input_dir: Path = typer.Option(RAW_DATA_DIR, help="Directory with the livestock CSV files"),
+    repeat: int = typer.Option(3, help="Number of runs of each method"),
+):
+    """
+    Compare the per-cell conversion with parse_numeric on the national livestock files.
+    """
+    columns = ['Volumen', 'Precio', 'Valor']
+    files = sorted(Path(input_dir).glob('livestock_*_raw_data.csv'))
+
+    if not files:
+        logger.error(f"No livestock files found in {input_dir}")
+        raise typer.Exit(1)
+
+    livestock = pd.concat(
+        [pd.read_csv(f, encoding='ISO-8859-1', usecols=columns, dtype=str) for f in files],
+        ignore_index=True,
+    )
+    logger.info(f"Loaded {len(livestock)} rows from {len(files)} files")
+
+    timings = {}
+    for name, method in [('apply', legacy_parse), ('vectorized', lambda s: parse_numeric(s)[0])]:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for column in columns:
+                method(livestock[column])
+            runs.append(time.perf_counter() - start)
+        timings[name] = min(runs)
+        logger.info(f"{name}: {timings[name]:.3f} s")
+
+    logger.success(f"Speedup: {timings['apply'] / timings['vectorized']:.1f}x")
+
+if __name__ == "__main__":
+    app()
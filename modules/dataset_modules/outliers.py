@@ -0,0 +1,120 @@
+import os
+import numpy as np
+import pandas as pd
+from loguru import logger
+from modules.config import POLLUTANTS
+from .pool import process_pool
+
+# Robust z-score above which a value is an outlier (Iglewicz and Hoaglin)
+MAD_THRESHOLD = 3.5
+IQR_FACTOR = 1.5
+# Sites with fewer measurements of a pollutant are not flagged
+MIN_SAMPLES = 5
+# Fraction of outliers expected by IsolationForest, as used in the cleaning notebooks
+CONTAMINATION = 0.01
+
+def robust_flags(df, columns=POLLUTANTS, group='CLAVE SITIO', mad_threshold=MAD_THRESHOLD, iqr_factor=IQR_FACTOR, min_samples=MIN_SAMPLES):
+    """
+    Flag the outliers of each pollutant within each site with the median/MAD and IQR rules.
+
+    All the statistics of all the sites and pollutants are computed in grouped vectorized
+    operations, on log1p of the values since the concentrations are very skewed.
+
+    Args:
+    - df (pd.DataFrame): Water quality data.
+    - columns (list of str): Pollutant columns.
+    - group (str): Column defining the groups (the site).
+    - mad_threshold (float): Robust z-score above which a value is an outlier.
+    - iqr_factor (float): Values further than iqr_factor * IQR from the quartiles are outliers.
+    - min_samples (int): Groups with fewer values are not flagged (<NA>).
+
+    Returns:
+    - pd.DataFrame: <pollutant>_outlier_mad and <pollutant>_outlier_iqr boolean columns, with
+      <NA> for missing values and small groups.
+    """
+    values = np.log1p(df[columns].astype('float64').clip(lower=0))
+    keys = df[group]
+    grouped = values.groupby(keys)
+
+    median = grouped.transform('median')
+    deviation = (values - median).abs()
+    # 1.4826 * MAD estimates the standard deviation; sites with MAD 0 (many repeated values,
+    # e.g. detection limits) use the mean absolute deviation instead
+    scale = 1.4826 * deviation.groupby(keys).transform('median')
+    scale = scale.mask(scale == 0, 1.2533 * deviation.groupby(keys).transform('mean'))
+    robust_z = (deviation / scale.replace(0, np.nan)).fillna(0)
+
+    q1 = grouped.quantile(0.25).reindex(keys).set_axis(df.index)
+    q3 = grouped.quantile(0.75).reindex(keys).set_axis(df.index)
+    iqr = q3 - q1
+
+    valid = values.notna() & (grouped.transform('count') >= min_samples)
+    mad_flags = (robust_z > mad_threshold).astype('boolean').where(valid, pd.NA)
+    iqr_flags = ((values < q1 - iqr_factor * iqr) | (values > q3 + iqr_factor * iqr)).astype('boolean').where(valid, pd.NA)
+
+    return pd.concat([
+        mad_flags.add_suffix('_outlier_mad'),
+        iqr_flags.add_suffix('_outlier_iqr'),
+    ], axis=1)[[f"{column}_outlier_{rule}" for column in columns for rule in ['mad', 'iqr']]]
+
+def isolation_forest_group(values, contamination=CONTAMINATION, random_state=0):
+    """
+    Fit an IsolationForest on the samples of a group and return the outlier flag of each sample.
+    """
+    from sklearn.ensemble import IsolationForest
+
+    # Missing values are replaced by the median of the group, so every sample is scored
+    values = np.where(np.isnan(values), np.nanmedian(values, axis=0), values)
+    values = np.nan_to_num(values)
+    model = IsolationForest(contamination=contamination, n_estimators=100, random_state=random_state)
+    return model.fit_predict(values) == -1
+
+def isolation_forest_flags(df, columns=POLLUTANTS, group='CLAVE SITIO', min_samples=MIN_SAMPLES, contamination=CONTAMINATION, max_workers=None):
+    """
+    Flag the samples that are outliers of their site, considering all the pollutants together,
+    with one IsolationForest per site fitted in a process pool.
+
+    Returns:
+    - pd.Series: outlier_if boolean flag, <NA> for the sites with fewer than min_samples samples.
+    """
+    values = np.log1p(df[columns].astype('float64').clip(lower=0))
+    groups = [(key, idx) for key, idx in df.groupby(group).indices.items() if len(idx) >= min_samples]
+    flags = pd.Series(pd.NA, index=df.index, dtype='boolean', name='outlier_if')
+
+    if not groups:
+        return flags
+
+    # Workers are spawned when the water stage runs in a thread of the DAG runner
+    with process_pool(max_workers=max_workers) as executor:
+        results = executor.map(
+            isolation_forest_group,
+            [values.to_numpy()[idx] for _, idx in groups],
+            [contamination] * len(groups),
+            # Most sites have few samples, so several sites are sent to each worker at once
+            chunksize=max(1, len(groups) // (4 * (max_workers or os.cpu_count() or 1))),
+        )
+        for (_, idx), group_flags in zip(groups, results):
+            flags.iloc[idx] = group_flags
+
+    logger.info(f"IsolationForest fitted on {len(groups)} sites")
+    return flags
+
+def outlier_flags(df, columns=POLLUTANTS, group='CLAVE SITIO', isolation_forest=False, max_workers=None):
+    """
+    Outlier flags of the water quality data: robust rules per site and pollutant, an
+    IsolationForest flag per sample when isolation_forest is True, and the number of
+    pollutants flagged by any rule in each sample (outlier_count).
+    """
+    flags = robust_flags(df, columns=columns, group=group)
+
+    if isolation_forest:
+        flags['outlier_if'] = isolation_forest_flags(df, columns=columns, group=group, max_workers=max_workers)
+
+    per_pollutant = pd.concat(
+        [flags[f"{column}_outlier_mad"].fillna(False) | flags[f"{column}_outlier_iqr"].fillna(False) for column in columns],
+        axis=1,
+    )
+    flags['outlier_count'] = per_pollutant.sum(axis=1).astype('int8')
+
+    logger.info(f"{int((flags['outlier_count'] > 0).sum())} of {len(df)} samples with outliers")
+    return flags
@@ -0,0 +1,25 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+
+def process_pool(max_workers=None, spawn=None):
+    """
+    Create a pool of worker processes that is safe to use while other threads are running.
+
+    Forking copies the locks held by the other threads (e.g. the one of the logger, while a node
+    of the DAG runner or a download is logging) into the workers, where they are never released.
+    Spawned workers start a new interpreter instead, which is slower but does not inherit them.
+
+    Args:
+    - max_workers (int): Maximum number of processes. Default is the number of CPUs.
+    - spawn (bool): Spawn the workers instead of forking them. Default is to spawn them only
+      when the pool is created outside the main thread.
+
+    Returns:
+    - ProcessPoolExecutor: The pool.
+    """
+    if spawn is None:
+        spawn = threading.current_thread() is not threading.main_thread()
+
+    mp_context = multiprocessing.get_context('spawn') if spawn else None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
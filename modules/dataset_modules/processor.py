@@ -5,19 +5,126 @@ import re
 import pyarrow as pa
 import pyarrow.parquet as pq
 import typer
-import git
 from loguru import logger
 from tqdm import tqdm
-from ydata_profiling import ProfileReport
-from .uploader import write_parquet, write_csv
-from dvc_modules.dvc_manager import add_file_to_dvc, push_to_dvc_remote
-from modules.config import PROCESSED_DATA_DIR, RAW_DATA_DIR, INTERIM_DATA_DIR, REFERENCES_DIR, DOCS_DIR, URL_LIST, MUNICIPALITY, POLLUTANTS
+from .uploader import write_parquet, write_csv, write_parquet_dataset, read_parquet_dataset
+from .workbook import load_workbook, read_sheet, iter_sheet, file_md5
+from .manifest import config_hash, is_up_to_date, record_stage, load_manifest
+from .join import build_water_livestock_yearly, MUNICIPALITY_DIM_FILE
+from .outliers import outlier_flags
+from .imputer import NeighborImputer, impute_incremental, N_NEIGHBORS, KM_PER_DAY
+from .numeric import parse_numeric_columns, parse_excel_dates, LIVESTOCK_STRIP, WATER_STRIP
+from .profiler import profile_report
+from .pool import process_pool
+from dvc_modules.dvc_manager import add_file_to_dvc, push_to_dvc_remote, DvcSession
+from modules.metrics import stage, timed
+from modules.config import MODELS_DIR, PROCESSED_DATA_DIR, RAW_DATA_DIR, INTERIM_DATA_DIR, CACHE_DIR, REFERENCES_DIR, DOCS_DIR, URL_LIST, MUNICIPALITY, POLLUTANTS, LIVESTOCK_MUNICIPALITY, LIVESTOCK_SPECIES, PROFILE_MODE
 
 app = typer.Typer()
 
-def process_data():
-    livestock_list = []
-    WATER_QUALITY_DATA = 'water_quality_raw_data.xlsb'
+# Columns read from the SIAP livestock files and their types. The other columns are never loaded.
+LIVESTOCK_DTYPES = {
+    'Anio': 'Int64',
+    'Cveestado': 'Int64',
+    'Nomestado': 'category',
+    'Cvempio': 'Int64',
+    'Nommunicipio': 'category',
+    'Nomespecie': 'category',
+    'Cveproducto': 'Int64',
+    'Nomproducto': 'category',
+    'Volumen': str,
+    'Precio': str,
+    'Valor': str,
+}
+
+WATER_RAW_FILE = 'water_quality_raw_data.xlsb'
+LIVESTOCK_FILE_PATTERN = r'^livestock_\d{4}.*\.csv$'
+WATER_OUTPUT_FILE = 'water_quality_tidy_data.parquet'
+LIVESTOCK_OUTPUT_FILE = 'livestock_tidy_data.parquet'
+YEARLY_OUTPUT_FILE = 'water_livestock_yearly.parquet'
+IMPUTED_OUTPUT_FILE = 'water_quality_imputed_data.parquet'
+IMPUTER_FILE = MODELS_DIR / 'neighbor_imputer.joblib'
+WATER_REPORT_FILE = 'water_report.html'
+WATER_REPORT_TITLE = "Data Profile Report: Data Quality"
+LIVESTOCK_REPORT_FILE = 'livestock_report.html'
+LIVESTOCK_REPORT_TITLE = "Data Profile Report: Livestock Data"
+# Output, report and title of the profile report of each dataset
+REPORTS = {
+    'water': (WATER_OUTPUT_FILE, WATER_REPORT_FILE, WATER_REPORT_TITLE),
+    'livestock': (LIVESTOCK_OUTPUT_FILE, LIVESTOCK_REPORT_FILE, LIVESTOCK_REPORT_TITLE),
+}
+LIVESTOCK_CACHE_DIR = CACHE_DIR / 'livestock'
+# Add 'Nombre_Municipio' to also split each year by municipality
+LIVESTOCK_PARTITION_COLS = ['Año']
+
+# Also flag the outliers of each site with an IsolationForest per site (slower)
+WATER_ISOLATION_FOREST = False
+
+# Read the results sheet of the water workbook in blocks of rows, keeping only the samples of
+# the studied sites, instead of loading and merging the whole national sheet. Same output, with
+# a peak memory that follows the Sonora subset (the workbook cache is not used)
+WATER_STREAMING = False
+WATER_CHUNK_ROWS = 50_000
+WATER_RESULT_COLUMNS = ['CLAVE SITIO', 'FECHA REALIZACIÓN'] + POLLUTANTS
+
+# Bump when the transformation of a stage changes, so its outputs are rebuilt
+WATER_VERSION = 4
+LIVESTOCK_VERSION = 2
+YEARLY_VERSION = 1
+IMPUTE_VERSION = 1
+
+def water_config():
+    """
+    Configuration the water quality output depends on.
+    """
+    return {
+        'version': WATER_VERSION,
+        'pollutants': POLLUTANTS,
+        'municipality': MUNICIPALITY,
+        'isolation_forest': WATER_ISOLATION_FOREST,
+    }
+
+def livestock_config():
+    """
+    Configuration the livestock output depends on.
+    """
+    return {
+        'version': LIVESTOCK_VERSION,
+        'municipality': LIVESTOCK_MUNICIPALITY,
+        'species': LIVESTOCK_SPECIES,
+        'dtypes': LIVESTOCK_DTYPES,
+    }
+
+def impute_config():
+    """
+    Configuration the imputed water quality output depends on.
+    """
+    return {'version': IMPUTE_VERSION, 'pollutants': POLLUTANTS, 'n_neighbors': N_NEIGHBORS, 'km_per_day': KM_PER_DAY}
+
+def yearly_config():
+    """
+    Configuration the water-livestock yearly table depends on.
+    """
+    return {'version': YEARLY_VERSION, 'pollutants': POLLUTANTS}
+
+@timed('process_data')
+def process_data(max_workers=None, force=False, dvc_session=None, publisher=None, streaming=WATER_STREAMING):
+    """
+    Processes all downloaded files found in the URL_LIST list.
+
+    Stages whose raw inputs (md5 of their content) and configuration did not change since
+    the last build, as recorded in the build manifest, are skipped. The raw files are hashed
+    instead of reading the md5 of their .dvc files, which are only updated when the outputs
+    are added to DVC at the end of the run and can be older than a file downloaded again.
+
+    Args:
+    - max_workers (int): Number of processes used to read the livestock files. Default is the number of CPUs.
+    - force (bool): Rebuild every stage even if it is up to date. Default is False.
+    - dvc_session (DvcSession): Session collecting the outputs to add to DVC. If not provided, each output is added and pushed.
+    - publisher (PublishQueue): Queue running the profile reports in the background. If not provided, they run inline.
+    - streaming (bool): Read the water results sheet in blocks of rows (see WATER_STREAMING).
+    """
+    livestock_files = []
 
     if URL_LIST:    
         for f in URL_LIST:
@@ -29,130 +136,308 @@ def process_data():
                 logger.warning(f"File {FILE_NAME} not found. Download it first")
                 raise RuntimeError("File not found. Download it first")
 
-            if FILE_NAME == WATER_QUALITY_DATA:
-                water_process(FILE_NAME)
-            elif re.match(r'^livestock_\d{4}.*\.csv$', FILE_NAME):
-                RAW_LIVESTOCK_DATA_DIR = RAW_DATA_DIR / FILE_NAME
-                logger.info(f"Starting reading file {FILE_NAME}")
-                
-                with tqdm(total=len(URL_LIST)-1, desc="Processing files", unit="file") as pbar:
-                    livestock = pd.read_csv(RAW_LIVESTOCK_DATA_DIR, encoding='ISO-8859-1')
-                    if not livestock.empty:
-                        livestock_list.append(livestock)
-                    logger.success(f"Reading file {FILE_NAME} completed")
-                    pbar.update(1)
-                
-        if livestock_list:
-            livestock_process(livestock_list)                
+            if FILE_NAME == WATER_RAW_FILE:
+                water_stage(force=force, dvc_session=dvc_session, publisher=publisher, streaming=streaming)
+                impute_stage(force=force, dvc_session=dvc_session)
+            elif re.match(LIVESTOCK_FILE_PATTERN, FILE_NAME):
+                livestock_files.append(INPUT_PATH)
+
+        if livestock_files:
+            livestock_stage(livestock_files, max_workers=max_workers, force=force, dvc_session=dvc_session, publisher=publisher)
+
+        yearly_stage(force=force, dvc_session=dvc_session)
 
         logger.success(f"Data processing completed")
     else:
         logger.warning(f"URL_LIST is empty")
 
+def water_stage(force=False, dvc_session=None, publisher=None, report=True, streaming=WATER_STREAMING):
+    """
+    Build the water quality output when the raw workbook or the configuration changed since the last build.
+
+    Args:
+    - force (bool): Rebuild even if it is up to date.
+    - dvc_session (DvcSession): Session collecting the outputs to add to DVC.
+    - publisher (PublishQueue): Queue running the profile report in the background.
+    - report (bool): Create the profile report. Default is True.
+    - streaming (bool): Read the results sheet in blocks of rows (see WATER_STREAMING).
+    """
+    INPUT_PATH = Path(RAW_DATA_DIR) / WATER_RAW_FILE
+    inputs = {WATER_RAW_FILE: file_md5(INPUT_PATH)}
+    outputs = [PROCESSED_DATA_DIR / WATER_OUTPUT_FILE]
 
-def water_process(file):
-    FILE_NAME = file
-    OUTPUT_FILE = 'water_quality_tidy_data.parquet'
-    WATER_RAW_DATA_DIR = RAW_DATA_DIR / FILE_NAME
-    WATER_PROCESSED_DATA_DIR = PROCESSED_DATA_DIR / OUTPUT_FILE 
-    WATER_RAW_DATA_REFERENCES_FILE = 'water_quality_raw_data_references.csv'
-    WATER_PROCESSED_DATA_REFERENCES_FILE = 'water_quality_tidy_data_references.csv'
-    WATER_RAW_DATA_REFERENCES_DIR = REFERENCES_DIR / WATER_RAW_DATA_REFERENCES_FILE
-    WATER_PROCESSED_DATA_REFERENCES_DIR = REFERENCES_DIR / WATER_PROCESSED_DATA_REFERENCES_FILE
-    WATER_DOC_DIR = DOCS_DIR / 'water_report.html'
-
-    excel_file = pd.ExcelFile(WATER_RAW_DATA_DIR, engine='pyxlsb')
-    sheet_names = excel_file.sheet_names
-    df_water_site = pd.DataFrame()
-    df_water_result = pd.DataFrame()
-    df_water_dic = pd.DataFrame()
-
-    logger.info(f"Starting reading file {FILE_NAME}")
-
-    # Separate the sheets in DataFrame
-    with tqdm(total=len(sheet_names), desc="Reading sheets", unit="sheet") as pbar:
-        for sheet in range(len(sheet_names)):
-            if sheet == 0:
-                df_water_site = pd.read_excel(WATER_RAW_DATA_DIR, engine='pyxlsb', sheet_name=sheet)
-            elif sheet == 1:
-                df_water_result = pd.read_excel(WATER_RAW_DATA_DIR, engine='pyxlsb', sheet_name=sheet)
-            elif sheet == 2:
-                df_water_dic = pd.read_excel(WATER_RAW_DATA_DIR, engine='pyxlsb', sheet_name=sheet)
-            pbar.update(1)
+    if not force and is_up_to_date('water', inputs, water_config(), outputs):
+        logger.info(f"Inputs of {WATER_OUTPUT_FILE} did not change. Skipping")
+        return
 
-    logger.success(f"Reading file {FILE_NAME} completed")
-    logger.info(f"Starting data processing: merging data frames, filtering according to established criteria, selection, cleaning and conversion of columns")
+    water_process(WATER_RAW_FILE, dvc_session=dvc_session, publisher=publisher, report=report, streaming=streaming)
+    record_stage('water', inputs, water_config(), outputs)
+
+def livestock_stage(livestock_files, max_workers=None, force=False, dvc_session=None, publisher=None, report=True):
+    """
+    Build the livestock output when a raw file or the configuration changed since the last build.
+
+    Args:
+    - livestock_files (list of Path): SIAP livestock files.
+    - max_workers (int): Number of processes used to read the files.
+    - force (bool): Rebuild even if it is up to date.
+    - dvc_session (DvcSession): Session collecting the outputs to add to DVC.
+    - publisher (PublishQueue): Queue running the profile report in the background.
+    - report (bool): Create the profile report. Default is True.
+    """
+    inputs = {path.name: file_md5(path) for path in livestock_files}
+    outputs = [PROCESSED_DATA_DIR / LIVESTOCK_OUTPUT_FILE]
+
+    if not force and is_up_to_date('livestock', inputs, livestock_config(), outputs):
+        logger.info(f"Inputs of {LIVESTOCK_OUTPUT_FILE} did not change. Skipping")
+        return
+
+    with stage('livestock.read') as record:
+        livestock_list = read_livestock_files(livestock_files, max_workers=max_workers, md5s=inputs)
+        record.read(*livestock_files)
+        record.rows_out = sum(len(livestock) for livestock in livestock_list)
+
+    livestock_process(livestock_list, dvc_session=dvc_session, publisher=publisher, report=report)
+    record_stage('livestock', inputs, livestock_config(), outputs)
+
+def impute_stage(force=False, dvc_session=None):
+    """
+    Impute the missing pollutants of the water quality output when it changed since the last build.
+    """
+    stages = load_manifest()['stages']
+    if 'water' not in stages:
+        logger.warning(f"The water quality output is required to build {IMPUTED_OUTPUT_FILE}. Skipping")
+        return
+
+    inputs = {WATER_OUTPUT_FILE: config_hash(stages['water'])}
+    outputs = [PROCESSED_DATA_DIR / IMPUTED_OUTPUT_FILE, IMPUTER_FILE]
+
+    if not force and is_up_to_date('impute', inputs, impute_config(), outputs):
+        logger.info(f"Inputs of {IMPUTED_OUTPUT_FILE} did not change. Skipping")
+        return
+
+    # The imputer is fitted again only if its configuration changed or the build is forced
+    previous = stages.get('impute', {})
+    refit = force or previous.get('config') != config_hash(impute_config())
+
+    impute_process(refit=refit, dvc_session=dvc_session)
+    record_stage('impute', inputs, impute_config(), outputs)
+
+def yearly_stage(force=False, dvc_session=None):
+    """
+    Build the water-livestock yearly table when the water or livestock output or the
+    municipality dimension table changed since it was last built.
+    """
+    stages = load_manifest()['stages']
+    if 'water' not in stages or 'livestock' not in stages:
+        logger.warning(f"Water and livestock outputs are required to build {YEARLY_OUTPUT_FILE}. Skipping")
+        return
+
+    # The upstream outputs change only when their stages are rebuilt
+    inputs = {
+        WATER_OUTPUT_FILE: config_hash(stages['water']),
+        LIVESTOCK_OUTPUT_FILE: config_hash(stages['livestock']),
+        MUNICIPALITY_DIM_FILE.name: file_md5(MUNICIPALITY_DIM_FILE),
+    }
+    outputs = [PROCESSED_DATA_DIR / YEARLY_OUTPUT_FILE]
+
+    if not force and is_up_to_date('yearly', inputs, yearly_config(), outputs):
+        logger.info(f"Inputs of {YEARLY_OUTPUT_FILE} did not change. Skipping")
+        return
+
+    yearly_process(dvc_session=dvc_session)
+    record_stage('yearly', inputs, yearly_config(), outputs)
+
+def read_livestock_file(path):
+    """
+    Read a SIAP livestock file keeping only the rows of the studied municipalities and species.
 
-    # Merging df_water_site and df_water_result DataFrames using 'CLAVE SITIO' as the key.
+    Only the columns in LIVESTOCK_DTYPES are read, with their types fixed beforehand.
+
+    Args:
+    - path (Path): Path of the livestock CSV file.
+
+    Returns:
+    - pd.DataFrame: Filtered rows of the file.
+    """
+    livestock = pd.read_csv(
+        path,
+        encoding='ISO-8859-1',
+        usecols=list(LIVESTOCK_DTYPES),
+        dtype=LIVESTOCK_DTYPES,
+    )
+
+    # Filter before concatenating, so only the rows of interest are kept in memory
+    livestock = livestock[
+        livestock['Nommunicipio'].isin(LIVESTOCK_MUNICIPALITY) &
+        livestock['Nomespecie'].isin(LIVESTOCK_SPECIES)
+    ]
+
+    return livestock
+
+def read_livestock_files(paths, max_workers=None, md5s=None, cache_dir=LIVESTOCK_CACHE_DIR):
+    """
+    Read the livestock files in parallel, one process per file.
+
+    The filtered rows of each file are cached as a Parquet partition keyed by the md5 of the
+    file and the livestock configuration, so only the years that changed are read again.
+
+    Args:
+    - paths (list of Path): Paths of the livestock CSV files.
+    - max_workers (int): Maximum number of processes. Default is the number of CPUs.
+    - md5s (dict): md5 of each file by file name. Computed if not provided.
+    - cache_dir (Path): Directory of the cached partitions. None disables the cache.
+
+    Returns:
+    - list of pd.DataFrame: Filtered rows of each file that has data, in the order of paths.
+    """
+    md5s = md5s or {path.name: file_md5(path) for path in paths}
+    key = config_hash(livestock_config())[:8]
+    partitions = {}
+
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for path in paths:
+            partition = cache_dir / f"{path.stem}-{md5s[path.name]}-{key}.parquet"
+            if partition.exists():
+                partitions[path] = pd.read_parquet(partition)
+                logger.info(f"File {path.name} did not change. Using cached partition")
+
+    pending = [path for path in paths if path not in partitions]
+
+    if pending:
+        logger.info(f"Starting reading {len(pending)} livestock files")
+        # Workers are spawned when the stage runs in a thread of the DAG runner
+        with process_pool(max_workers=max_workers) as executor, \
+                tqdm(total=len(pending), desc="Processing files", unit="file") as pbar:
+            for path, livestock in zip(pending, executor.map(read_livestock_file, pending)):
+                partitions[path] = livestock
+                logger.success(f"Reading file {path.name} completed")
+                pbar.update(1)
+
+                if cache_dir is not None:
+                    for old in cache_dir.glob(f"{path.stem}-*.parquet"):
+                        old.unlink()
+                    livestock.to_parquet(cache_dir / f"{path.stem}-{md5s[path.name]}-{key}.parquet")
+
+    return [partitions[path] for path in paths if not partitions[path].empty]
+
+def concat_livestock(file_list):
+    """
+    Concatenate the livestock files, keeping the categorical columns as categories.
+    """
+    category_columns = [column for column, dtype in LIVESTOCK_DTYPES.items() if dtype == 'category']
+    livestock_merged = pd.concat(file_list, ignore_index=True)
+
+    for column in category_columns:
+        livestock_merged[column] = livestock_merged[column].astype('category').cat.remove_unused_categories()
+
+    return livestock_merged
+
+def filter_water(df_water_site, df_water_result):
+    """
+    Merge the sites and results sheets of the CONAGUA workbook and keep the samples of the
+    studied columns, municipalities and water bodies.
+
+    Args:
+    - df_water_site (pd.DataFrame): First sheet, monitoring sites.
+    - df_water_result (pd.DataFrame): Second sheet, monitoring results.
+
+    Returns:
+    - pd.DataFrame: Samples of the non coastal water bodies of the affected municipalities of Sonora.
+    """
+    # The filters only use columns of the sites sheet, so the sites are filtered before the merge.
+    # The inner merge keeps the order of the sites, so the rows are the same as filtering after it.
     df_water_merged = pd.merge(
-        df_water_site, 
+        filter_water_sites(df_water_site), 
         df_water_result, 
         on='CLAVE SITIO', 
         how='inner'
     )
 
-    # Select the columns required for the study
-    df_water_merged_filtered = df_water_merged[
-        ['CLAVE SITIO', 'ESTADO', 'MUNICIPIO', 'CUERPO DE AGUA', 'TIPO CUERPO DE AGUA', 'SUBTIPO CUERPO AGUA', 'LATITUD', 'LONGITUD'] + 
-        POLLUTANTS
+    # Select the columns required for the study, and the flags of the values that were not numbers
+    # when the results were converted while streaming
+    df_water_filtered_sonora = df_water_merged[
+        ['CLAVE SITIO', 'ESTADO', 'MUNICIPIO', 'CUERPO DE AGUA', 'TIPO CUERPO DE AGUA', 'SUBTIPO CUERPO AGUA', 'LATITUD', 'LONGITUD', 'FECHA REALIZACIÓN'] + 
+        POLLUTANTS +
+        [f"{pollutant}_rejected" for pollutant in POLLUTANTS if f"{pollutant}_rejected" in df_water_merged.columns]
     ]
-    
-    # Filter the DataFrame to obtain only the records of the water bodies that are not "COASTAL" of the affected municipalities of the state of Sonora.
-    df_water_filtered_sonora = df_water_merged_filtered[
-        (df_water_merged['ESTADO'] == 'SONORA') &
-        (df_water_merged['MUNICIPIO'].isin(MUNICIPALITY))   
+
+    return df_water_filtered_sonora
+
+def filter_water_sites(df_water_site):
+    """
+    Monitoring sites of the water bodies that are not "COASTAL" of the affected municipalities of the state of Sonora.
+    """
+    df_water_site_sonora = df_water_site[
+        (df_water_site['ESTADO'] == 'SONORA') &
+        (df_water_site['MUNICIPIO'].isin(MUNICIPALITY))   
     ]
-    df_water_filtered_sonora = df_water_filtered_sonora[
-        ~df_water_filtered_sonora['TIPO CUERPO DE AGUA'].str.contains('COSTERO', na=False)
+    return df_water_site_sonora[
+        ~df_water_site_sonora['TIPO CUERPO DE AGUA'].str.contains('COSTERO', na=False)
     ]
 
-    # Clean the columns of pollutants by removing the '>' and '<' symbols and converting them to numeric
-    for column in POLLUTANTS:
-        if column in df_water_filtered_sonora.columns:
-            df_water_filtered_sonora[column] = df_water_filtered_sonora[column].astype(str)
-            df_water_filtered_sonora[column] = (
-                df_water_filtered_sonora[column]
-                .str.replace('<', '', regex=False)
-                .str.replace('>', '', regex=False)
-            )
-            df_water_filtered_sonora[column] = pd.to_numeric(df_water_filtered_sonora[column], errors='coerce')
+def read_water_streaming(file, chunk_rows=WATER_CHUNK_ROWS):
+    """
+    Read the CONAGUA workbook keeping only the results of the studied sites.
 
-    # Save new DataFrame to a Parquet file
-    logger.info(f"Saving file {OUTPUT_FILE}")
-    write_parquet(df_water_filtered_sonora, WATER_PROCESSED_DATA_DIR, 10)
-    
-    logger.info(f"Saving dictionaries")
+    The sites sheet is filtered first, and the results sheet is then read in blocks of rows,
+    keeping the rows of those sites and the studied columns, with the pollutants of each block
+    converted to float64. Only one block of the national sheet is in memory at a time.
 
-    # Save dictionary of original data
-    write_csv(df_water_dic, WATER_RAW_DATA_REFERENCES_DIR, 5)
-    
-    # Save dictionary of new DataFrame
-    df_water_tidy_dic = df_water_dic[df_water_dic['CLAVE PARÁMETRO'].isin(POLLUTANTS)]
-    write_csv(df_water_tidy_dic, WATER_PROCESSED_DATA_REFERENCES_DIR, 5)
+    Args:
+    - file (Path): Path of the workbook.
+    - chunk_rows (int): Rows of the results sheet read at once.
 
-    # Create the data profile report and save the report as an HTML file
-    handle_dvc(WATER_PROCESSED_DATA_DIR)
-    
-    # Create the data profile report and upload to GitHub
-    logger.info(f"Creating data profile report and pushing to GitHub")
-    profile_data(df_water_filtered_sonora, WATER_DOC_DIR, title="Data Profile Report: Data Quality")
-    upload_report(WATER_DOC_DIR)
+    Returns:
+    - tuple (pd.DataFrame, pd.DataFrame, pd.DataFrame): Studied sites, their results and the dictionary sheet.
+    """
+    df_water_site = filter_water_sites(read_sheet(file, 0))
+    site_keys = set(df_water_site['CLAVE SITIO'])
 
-    logger.success(f"Tasks successfully completed for file {WATER_DOC_DIR}")
+    chunks = []
+    rows = 0
+    for chunk in iter_sheet(file, 1, columns=WATER_RESULT_COLUMNS, chunk_rows=chunk_rows):
+        rows += len(chunk)
+        chunk = chunk[chunk['CLAVE SITIO'].isin(site_keys)].copy()
+        parse_numeric_columns(chunk, POLLUTANTS, strip=WATER_STRIP, flags=True)
+        chunks.append(chunk)
 
-  
-def livestock_process(file_list):
-    # FILE_NAME = file
-    # RAW_LIVESTOCK_DATA_DIR = RAW_DATA_DIR / FILE_NAME
-    OUTPUT_FILE = 'livestock_tidy_data.parquet'
-    LIVESTOCK_RAW_DATA_DIR = RAW_DATA_DIR / OUTPUT_FILE 
-    LIVESTOCK_PROCESSED_DATA_DIR = PROCESSED_DATA_DIR / OUTPUT_FILE
-    LIVESTOCK_RAW_DATA_REFERENCES_FILE = 'livestock_raw_data_references.csv'
-    LIVESTOCK_RAW_DATA_REFERENCES_DIR = REFERENCES_DIR / LIVESTOCK_RAW_DATA_REFERENCES_FILE
-    LIVESTOCK_DOC_DIR = DOCS_DIR / 'livestock_report.html'
+    df_water_result = pd.concat(chunks, ignore_index=True)
+    logger.info(f"{len(df_water_result)} of {rows} results belong to the {len(site_keys)} studied sites")
 
-    valores_cmun = ['Huepac', 'Ures', 'Aconchi', 'Arizpe', 'Banámichi', 'Baviácora ', 'Cananea', 'San Felipe de Jesús']
-    especies_permitidas = ['Bovino', 'Caprino', 'Porcino', 'Ovino']
+    return df_water_site, df_water_result, read_sheet(file, 2)
+
+def clean_water(df_water_filtered_sonora):
+    """
+    Convert the pollutants to numbers and the sampling date to datetime, and add the year.
+
+    Returns:
+    - pd.DataFrame: A copy of the samples with a new RangeIndex.
+    """
+    # Clean the columns of pollutants by removing the '>' and '<' symbols and converting them to numeric,
+    # flagging the values that are not numbers (<pollutant>_rejected)
+    df_water_filtered_sonora = df_water_filtered_sonora.copy()
+    parse_numeric_columns(df_water_filtered_sonora, POLLUTANTS, strip=WATER_STRIP, flags=True)
+
+    # Convert the sampling date from Excel serial numbers and add the year
+    df_water_filtered_sonora['FECHA REALIZACIÓN'] = parse_excel_dates(df_water_filtered_sonora['FECHA REALIZACIÓN'])
+    df_water_filtered_sonora.insert(
+        df_water_filtered_sonora.columns.get_loc('FECHA REALIZACIÓN') + 1,
+        'Año',
+        df_water_filtered_sonora['FECHA REALIZACIÓN'].dt.year.astype('Int64'),
+    )
+
+    return df_water_filtered_sonora.reset_index(drop=True)
+
+def clean_livestock(livestock_filtered):
+    """
+    Rename the SIAP columns and convert the amounts to numbers and the keys to integers, in place.
+
+    Returns:
+    - pd.DataFrame: The same DataFrame.
+    """
     nuevos_nombres = {
         'Anio': 'Año',
         'Cveestado': 'Clave_Estado',
@@ -168,42 +453,12 @@ def livestock_process(file_list):
         'Valor': 'Valor Total'
     }
 
-    livestock_merged = pd.concat(file_list, ignore_index=True)
-
-    # Filtrar la tabla donde CMUN está en la lista especificada
-    livestock_filtered = livestock_merged[livestock_merged['Nommunicipio'].isin(valores_cmun)]
-
-    # Mantener solo las especies permitidas
-    livestock_filtered = livestock_filtered[livestock_filtered['Nomespecie'].isin(especies_permitidas)]
-
-    # Eliminar las columnas especificadas
-    livestock_filtered = livestock_filtered.drop(columns=['Cveddr', 'Cveespecie', 'Peso', 'Asacrificado', 'Nomddr'])
-
     # Rename columns and change data types for better handling
     livestock_filtered.rename(columns=nuevos_nombres, inplace=True)
 
-    # Reemplazar comas y espacios en blanco, pero mantener el formato
-    def clean_value(value):
-        if isinstance(value, str):
-            return value.replace(',', '').strip()  # Limpiar comas y espacios
-        return value
-
-    # Aplicar la limpieza a las columnas
-    livestock_filtered['Volumen'] = livestock_filtered['Volumen'].apply(clean_value)
-    livestock_filtered['Precio'] = livestock_filtered['Precio'].apply(clean_value)
-    livestock_filtered['Valor Total'] = livestock_filtered['Valor Total'].apply(clean_value)
-
-    # Convertir a float, pero manejar los errores
-    def safe_float_conversion(value):
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return value  # Mantener el valor original si no se puede convertir
-
-    # Aplicar la conversión
-    livestock_filtered['Volumen'] = livestock_filtered['Volumen'].apply(safe_float_conversion)
-    livestock_filtered['Precio'] = livestock_filtered['Precio'].apply(safe_float_conversion)
-    livestock_filtered['Valor Total'] = livestock_filtered['Valor Total'].apply(safe_float_conversion)
+    # Quitar comas y espacios y convertir a float; los valores no convertibles quedan como NaN
+    # y se marcan en <columna>_rejected
+    parse_numeric_columns(livestock_filtered, ['Volumen', 'Precio', 'Valor Total'], strip=LIVESTOCK_STRIP, flags=True)
 
     # Cambiar tipos de datos a int
     livestock_filtered['Año'] = livestock_filtered['Año'].astype(int)
@@ -211,31 +466,260 @@ def livestock_process(file_list):
     livestock_filtered['Clave_Municipio'] = livestock_filtered['Clave_Municipio'].astype(int)
     livestock_filtered['Clave_Producto'] = livestock_filtered['Clave_Producto'].astype(int)
 
+    return livestock_filtered
+
+@timed('water')
+def water_process(file, dvc_session=None, publisher=None, report=True, streaming=WATER_STREAMING):
+    FILE_NAME = file
+    OUTPUT_FILE = WATER_OUTPUT_FILE
+    WATER_RAW_DATA_DIR = RAW_DATA_DIR / FILE_NAME
+    WATER_PROCESSED_DATA_DIR = PROCESSED_DATA_DIR / OUTPUT_FILE 
+    WATER_RAW_DATA_REFERENCES_FILE = 'water_quality_raw_data_references.csv'
+    WATER_PROCESSED_DATA_REFERENCES_FILE = 'water_quality_tidy_data_references.csv'
+    WATER_RAW_DATA_REFERENCES_DIR = REFERENCES_DIR / WATER_RAW_DATA_REFERENCES_FILE
+    WATER_PROCESSED_DATA_REFERENCES_DIR = REFERENCES_DIR / WATER_PROCESSED_DATA_REFERENCES_FILE
+    WATER_DOC_DIR = DOCS_DIR / WATER_REPORT_FILE
+
+    # Read all the sheets at once, from the cache when the file has not changed, or only the
+    # results of the studied sites in streaming mode
+    with stage('water.read', streaming=streaming) as record:
+        if streaming:
+            df_water_site, df_water_result, df_water_dic = read_water_streaming(WATER_RAW_DATA_DIR)
+        else:
+            df_water_site, df_water_result, df_water_dic = load_workbook(WATER_RAW_DATA_DIR)[:3]
+        record.read(WATER_RAW_DATA_DIR)
+        record.rows_out = len(df_water_result)
+
+    logger.success(f"Reading file {FILE_NAME} completed")
+    logger.info(f"Starting data processing: merging data frames, filtering according to established criteria, selection, cleaning and conversion of columns")
+
+    with stage('water.merge_filter') as record:
+        df_water_filtered_sonora = filter_water(df_water_site, df_water_result)
+        record.rows_in = len(df_water_result)
+        record.rows_out = len(df_water_filtered_sonora)
+
+    with stage('water.clean') as record:
+        df_water_filtered_sonora = clean_water(df_water_filtered_sonora)
+        record.rows_in = record.rows_out = len(df_water_filtered_sonora)
+
+    # Flag the outliers of each site and pollutant, so they are not detected again on every load
+    with stage('water.outliers') as record:
+        df_water_filtered_sonora = pd.concat(
+            [df_water_filtered_sonora, outlier_flags(df_water_filtered_sonora, POLLUTANTS, isolation_forest=WATER_ISOLATION_FOREST)],
+            axis=1,
+        )
+        record.rows_in = record.rows_out = len(df_water_filtered_sonora)
+
+    # Save new DataFrame to a Parquet file
+    logger.info(f"Saving file {OUTPUT_FILE}")
+    with stage('water.write') as record:
+        write_parquet(df_water_filtered_sonora, WATER_PROCESSED_DATA_DIR)
+        record.rows_out = len(df_water_filtered_sonora)
+        record.wrote(WATER_PROCESSED_DATA_DIR)
+    
+    logger.info(f"Saving dictionaries")
+
+    # Save dictionary of original data
+    write_csv(df_water_dic, WATER_RAW_DATA_REFERENCES_DIR)
+    
+    # Save dictionary of new DataFrame
+    df_water_tidy_dic = df_water_dic[df_water_dic['CLAVE PARÁMETRO'].isin(POLLUTANTS)]
+    write_csv(df_water_tidy_dic, WATER_PROCESSED_DATA_REFERENCES_DIR)
+
+    # Create the data profile report and save the report as an HTML file
+    handle_dvc(WATER_PROCESSED_DATA_DIR, dvc_session=dvc_session)
+    
+    # Create the data profile report and upload to GitHub
+    if report:
+        with stage('water.profile') as record:
+            publish_report(df_water_filtered_sonora, WATER_DOC_DIR, WATER_REPORT_TITLE, publisher=publisher)
+            record.rows_in = len(df_water_filtered_sonora)
+
+    logger.success(f"Tasks successfully completed for file {WATER_DOC_DIR}")
+
+  
+@timed('livestock')
+def livestock_process(file_list, dvc_session=None, publisher=None, report=True):
+    # FILE_NAME = file
+    # RAW_LIVESTOCK_DATA_DIR = RAW_DATA_DIR / FILE_NAME
+    OUTPUT_FILE = LIVESTOCK_OUTPUT_FILE
+    LIVESTOCK_RAW_DATA_DIR = RAW_DATA_DIR / OUTPUT_FILE 
+    LIVESTOCK_PROCESSED_DATA_DIR = PROCESSED_DATA_DIR / OUTPUT_FILE
+    LIVESTOCK_RAW_DATA_REFERENCES_FILE = 'livestock_raw_data_references.csv'
+    LIVESTOCK_RAW_DATA_REFERENCES_DIR = REFERENCES_DIR / LIVESTOCK_RAW_DATA_REFERENCES_FILE
+    LIVESTOCK_DOC_DIR = DOCS_DIR / LIVESTOCK_REPORT_FILE
+
+    # The files are already filtered by municipality and species when they are read
+    with stage('livestock.clean') as record:
+        livestock_filtered = clean_livestock(concat_livestock(file_list))
+        record.rows_in = sum(len(livestock) for livestock in file_list)
+        record.rows_out = len(livestock_filtered)
+
     # Save new DataFrame to a Parquet file
     logger.info(f"Saving file {OUTPUT_FILE}")
-    write_parquet(livestock_filtered, LIVESTOCK_PROCESSED_DATA_DIR, 100)
+    with stage('livestock.write') as record:
+        write_parquet_dataset(livestock_filtered, LIVESTOCK_PROCESSED_DATA_DIR, LIVESTOCK_PARTITION_COLS)
+        record.rows_out = len(livestock_filtered)
+        record.wrote(LIVESTOCK_PROCESSED_DATA_DIR)
 
     # Create the data profile report and save the report as an HTML file
-    handle_dvc(LIVESTOCK_PROCESSED_DATA_DIR)
+    handle_dvc(LIVESTOCK_PROCESSED_DATA_DIR, dvc_session=dvc_session)
 
     # Create the data profile report and upload to GitHub
-    logger.info(f"Creating data profile report and pushing to GitHub")
-    profile_data(livestock_filtered, LIVESTOCK_DOC_DIR, title="Data Profile Report: Livestock Data")
-    upload_report(LIVESTOCK_DOC_DIR)
+    if report:
+        with stage('livestock.profile') as record:
+            publish_report(livestock_filtered, LIVESTOCK_DOC_DIR, LIVESTOCK_REPORT_TITLE, publisher=publisher)
+            record.rows_in = len(livestock_filtered)
 
     logger.success(f"Tasks successfully completed for file {LIVESTOCK_DOC_DIR}.")
 
-def profile_data(df, path, title):
-    # Create the data profile report
-    profile = ProfileReport(df, title=title, explorative=True)
+@timed('impute')
+def impute_process(refit=True, dvc_session=None):
+    OUTPUT_FILE = IMPUTED_OUTPUT_FILE
+    IMPUTED_PROCESSED_DATA_DIR = PROCESSED_DATA_DIR / OUTPUT_FILE
+
+    water = read_parquet_dataset(PROCESSED_DATA_DIR / WATER_OUTPUT_FILE)
+
+    if not refit and IMPUTER_FILE.exists() and IMPUTED_PROCESSED_DATA_DIR.exists():
+        # Only the new or changed samples are imputed, with the persisted imputer
+        logger.info(f"Imputing new samples with {IMPUTER_FILE.name}")
+        imputer = NeighborImputer.load(IMPUTER_FILE)
+        previous = read_parquet_dataset(IMPUTED_PROCESSED_DATA_DIR)
+        imputed, mask = impute_incremental(water, previous, imputer)
+    else:
+        logger.info(f"Fitting the pollutant imputer on {len(water)} samples")
+        imputer = NeighborImputer(columns=POLLUTANTS, n_neighbors=N_NEIGHBORS, km_per_day=KM_PER_DAY).fit(water)
+        imputer.save(IMPUTER_FILE)
+        imputed, mask = imputer.transform(water)
+
+    # Flag of the imputed values next to the pollutants
+    for column in POLLUTANTS:
+        imputed[f"{column}_imputed"] = mask[column].to_numpy(dtype=bool)
+
+    logger.info(f"Saving file {OUTPUT_FILE}")
+    write_parquet(imputed, IMPUTED_PROCESSED_DATA_DIR)
+
+    handle_dvc(IMPUTED_PROCESSED_DATA_DIR, dvc_session=dvc_session)
+    handle_dvc(IMPUTER_FILE, dvc_session=dvc_session)
 
-    # Save the report as an HTML file
-    profile.to_file(path)
+    logger.success(f"Tasks successfully completed for file {OUTPUT_FILE}")
 
+@timed('yearly')
+def yearly_process(dvc_session=None):
+    OUTPUT_FILE = YEARLY_OUTPUT_FILE
+    YEARLY_PROCESSED_DATA_DIR = PROCESSED_DATA_DIR / OUTPUT_FILE
+
+    logger.info(f"Joining water quality and livestock data by municipality and year")
+
+    # Only the columns needed by the join are read
+    water = read_parquet_dataset(
+        PROCESSED_DATA_DIR / WATER_OUTPUT_FILE,
+        columns=['CLAVE SITIO', 'MUNICIPIO', 'Año'] + POLLUTANTS,
+    )
+    livestock = read_parquet_dataset(
+        PROCESSED_DATA_DIR / LIVESTOCK_OUTPUT_FILE,
+        columns=['Año', 'Clave_Estado', 'Clave_Municipio', 'Nombre_Municipio', 'Nombre_Especie', 'Nombre_Producto', 'Volumen', 'Valor Total'],
+    )
+
+    yearly = build_water_livestock_yearly(water, livestock)
+
+    # Sorted by Clave_INEGI and Año, so the Parquet statistics work as an index
+    logger.info(f"Saving file {OUTPUT_FILE}")
+    write_parquet(yearly, YEARLY_PROCESSED_DATA_DIR)
+
+    handle_dvc(YEARLY_PROCESSED_DATA_DIR, dvc_session=dvc_session)
+
+    logger.success(f"Tasks successfully completed for file {OUTPUT_FILE}")
+
+def publish_report(df, path, title, publisher=None):
+    """
+    Create the data profile report of an output and upload it to GitHub.
+
+    Args:
+    - df (pd.DataFrame): Processed data.
+    - path (Path): Path of the HTML report.
+    - title (str): Title of the report.
+    - publisher (PublishQueue): If provided, the report is queued and created in the background.
+    """
+    if publisher is not None:
+        publisher.submit_report(df, path, title)
+        return
+
+    logger.info(f"Creating data profile report and pushing to GitHub")
+    profile_data(df, path, title=title)
+    upload_report(path)
+
+def profile_output(name, mode=PROFILE_MODE, force=False):
+    """
+    Create the profile report of a processed output already on disk.
+
+    The report is recorded in the build manifest as stage `profile.<name>`, and it is only
+    created again when the output was rebuilt or the mode of the report changed.
+
+    Args:
+    - name (str): Dataset in REPORTS ('water' or 'livestock').
+    - mode (str): Mode of the profile report.
+    - force (bool): Create the report even if it is up to date. Default is False.
+
+    Returns:
+    - Path: Path of the report.
+    """
+    output_file, report_file, title = REPORTS[name]
+    report_path = DOCS_DIR / report_file
+
+    # The output changes only when its stage is rebuilt
+    inputs = {output_file: config_hash(load_manifest()['stages'].get(name, {}))}
+    config = {'mode': mode, 'title': title}
+
+    # Reports are published to GitHub, not to DVC
+    if not force and is_up_to_date(f"profile.{name}", inputs, config, [report_path], tracked=False):
+        logger.info(f"{output_file} did not change since {report_file} was created. Skipping")
+        return report_path
+
+    profile_data(read_parquet_dataset(PROCESSED_DATA_DIR / output_file), report_path, title, mode=mode)
+    record_stage(f"profile.{name}", inputs, config, [report_path])
+    return report_path
+
+def publish_outputs(publisher):
+    """
+    Queue the profile reports of the processed outputs already on disk, without processing them again.
+
+    Args:
+    - publisher (PublishQueue): Queue running the profile reports.
+    """
+    for output_file, report_file, title in REPORTS.values():
+        output_path = PROCESSED_DATA_DIR / output_file
+        if not output_path.exists():
+            logger.warning(f"File {output_path.name} not found. Process the data first")
+            continue
+        publisher.submit_report(read_parquet_dataset(output_path), DOCS_DIR / report_file, title)
+
+@timed('profile_report')
+def profile_data(df, path, title, mode=PROFILE_MODE):
+    # Create the data profile report and save the report as an HTML file
+    profile_report(df, path, title=title, mode=mode)
+
+@timed('git.push_reports')
 def upload_report(path):
+    """
+    Commit the reports in docs/ and push them to GitHub.
+
+    Args:
+    - path (Path or list of Path): Report or reports to upload. All of them are published in a single commit.
+    """
     try:
-        repo_path = Path(path).parent.parent
+        # GitPython is only imported when reports are published
+        import git
+
+        paths = [path] if isinstance(path, (str, Path)) else list(path)
+        repo_path = Path(paths[0]).parent.parent
         repo = git.Repo(repo_path)
+
+        # Reports that were not created again leave docs/ unchanged, there is nothing to commit
+        if not repo.is_dirty(untracked_files=True, path='docs/'):
+            logger.info(f"Reports in docs/ did not change. Nothing to upload")
+            return
+
         repo.git.add('docs/')
         repo.index.commit(f"chore: update data profile report")
         origin = repo.remote(name='origin')
@@ -246,7 +730,12 @@ def upload_report(path):
     except Exception as e:
         logger.error(f"An error occurred while creating or uploading the report: {e}")
 
-def handle_dvc(file_path, remote='origin'):
+def handle_dvc(file_path, remote='origin', dvc_session=None):
+    # Register the file in the DVC session, it is added and pushed at the end of the run
+    if dvc_session is not None:
+        dvc_session.track(file_path)
+        return
+
     # Add the downloaded file to DVC
     add_file_to_dvc(file_path)
 
@@ -254,11 +743,21 @@ def handle_dvc(file_path, remote='origin'):
     push_to_dvc_remote(remote_name=remote)
 
 @app.command()
-def process():
+def process(
+    workers: int = typer.Option(None, help="Number of processes used to read the livestock files"),
+    force: bool = typer.Option(False, help="Rebuild the outputs even if their inputs did not change"),
+    publish: bool = typer.Option(True, help="Create the profile reports and push reports and data to GitHub and DVC"),
+    profile: bool = typer.Option(False, help="Profile the run with cProfile and save it next to the stage metrics"),
+    streaming: bool = typer.Option(WATER_STREAMING, help="Read the water results sheet in blocks of rows, keeping only the studied sites (lower memory)"),
+):
     """
     Processes all downloaded files found in the URL_LIST list.
     """
-    process_data()
+    from .publisher import PublishQueue
+    from modules.metrics import PipelineMetrics
+
+    with PipelineMetrics(profile=profile), PublishQueue(enabled=publish) as publisher, DvcSession(push=publish) as dvc_session:
+        process_data(max_workers=workers, force=force, dvc_session=dvc_session, publisher=publisher, streaming=streaming)
 
 if __name__ == "__main__":
     app()
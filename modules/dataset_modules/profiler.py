@@ -0,0 +1,161 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import pandas as pd
+from loguru import logger
+from modules.config import CACHE_DIR, PROFILE_MODE, PROFILE_SAMPLE_ROWS
+
+PROFILE_MODES = ['minimal', 'sampled', 'full']
+PROFILE_CACHE_DIR = CACHE_DIR / 'profiles'
+
+# Columns used to stratify the sample, when present in the data
+STRATA = ['Año', 'MUNICIPIO', 'Nombre_Municipio']
+
+def column_hash(series):
+    """
+    Hash of the content, name and type of a column.
+    """
+    md5 = hashlib.md5(f"{series.name}|{series.dtype}".encode('utf-8'))
+    md5.update(pd.util.hash_pandas_object(series, index=False).values.tobytes())
+    return md5.hexdigest()
+
+def sample_frame(df, max_rows=PROFILE_SAMPLE_ROWS, strata=STRATA, random_state=0):
+    """
+    Stratified sample of a DataFrame, keeping at least one row of every stratum.
+
+    Args:
+    - df (pd.DataFrame): Data to sample.
+    - max_rows (int): Approximate number of rows of the sample.
+    - strata (list of str): Columns used to stratify. The ones not in df are ignored.
+    - random_state (int): Seed of the sample, so reruns profile the same rows.
+    """
+    if len(df) <= max_rows:
+        return df
+
+    columns = [column for column in strata if column in df.columns]
+    fraction = max_rows / len(df)
+
+    if not columns:
+        return df.sample(n=max_rows, random_state=random_state)
+
+    grouped = df.groupby(columns, observed=True, dropna=False)
+    sample = grouped.sample(frac=fraction, random_state=random_state)
+
+    # Keep at least one row of every stratum
+    keep = sample.index.union(grouped.head(1).index)
+    return df[df.index.isin(keep)]
+
+def column_summary(series):
+    """
+    Statistics of a column computed on the full data.
+    """
+    summary = {
+        'dtype': str(series.dtype),
+        'count': int(series.count()),
+        'missing': int(series.isna().sum()),
+        'distinct': int(series.nunique()),
+    }
+
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        stats = series.describe(percentiles=[0.05, 0.25, 0.5, 0.75, 0.95])
+        summary.update({key: None if pd.isna(value) else float(value) for key, value in stats.drop('count').items()})
+    else:
+        summary['top'] = {str(key): int(value) for key, value in series.value_counts().head(10).items()}
+
+    return summary
+
+def column_summaries(df, cache_dir=PROFILE_CACHE_DIR):
+    """
+    Statistics of every column, reusing the cached ones of the columns whose content did not change.
+
+    The cached statistics of columns that are no longer in df are deleted, so each cache_dir
+    holds the columns of a single DataFrame.
+
+    Returns:
+    - tuple (dict, dict): The statistics and the hash of each column, by column name.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    summaries = {}
+    hashes = {}
+    computed = 0
+
+    for column in df.columns:
+        key = column_hash(df[column])
+        cache_path = cache_dir / f"column-{key}.json"
+        hashes[str(column)] = key
+
+        if cache_path.exists():
+            with open(cache_path) as f:
+                summaries[str(column)] = json.load(f)
+        else:
+            summaries[str(column)] = column_summary(df[column])
+            with open(cache_path, 'w') as f:
+                json.dump(summaries[str(column)], f, ensure_ascii=False)
+            computed += 1
+
+    # Remove the statistics of the columns that changed or were dropped
+    for cache_path in cache_dir.glob('column-*.json'):
+        if cache_path.stem[len('column-'):] not in hashes.values():
+            cache_path.unlink()
+
+    logger.info(f"Column statistics: {computed} computed, {len(df.columns) - computed} from cache")
+    return summaries, hashes
+
+def profile_report(df, path, title, mode=PROFILE_MODE, cache_dir=PROFILE_CACHE_DIR):
+    """
+    Create the data profile report of a DataFrame.
+
+    Modes:
+    - minimal: ydata_profiling minimal report (no correlations or interactions) on the full data.
+    - sampled: minimal report on a sample stratified by year/municipality.
+    - full: explorative report on the full data, with all the correlations and interactions.
+
+    Exact statistics of every column on the full data are saved next to the report
+    (<report>.stats.json). Only these statistics are cached by column content, in a directory
+    of cache_dir per report. The HTML report is not created again when no column, the mode
+    or the title changed, but any change creates the whole report again.
+
+    Args:
+    - df (pd.DataFrame): Data to profile.
+    - path (Path): Path of the HTML report.
+    - title (str): Title of the report.
+    - mode (str): One of PROFILE_MODES.
+    - cache_dir (Path): Directory of the cached statistics of all the reports.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode}. Use one of {PROFILE_MODES}")
+
+    path = Path(path)
+    stats_path = path.with_suffix('.stats.json')
+    summaries, hashes = column_summaries(df, cache_dir=Path(cache_dir) / path.stem)
+
+    report_key = hashlib.md5(
+        json.dumps({'columns': hashes, 'mode': mode, 'title': title}, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+    key_path = Path(cache_dir) / f"report-{path.stem}.key"
+
+    if path.exists() and key_path.exists() and key_path.read_text() == report_key:
+        logger.info(f"Data of {path.name} did not change. Keeping the existing report")
+        return
+
+    with open(stats_path, 'w') as f:
+        json.dump({'title': title, 'rows': len(df), 'columns': summaries}, f, indent=2, ensure_ascii=False)
+
+    from ydata_profiling import ProfileReport
+
+    if mode == 'full':
+        profile = ProfileReport(df, title=title, explorative=True)
+    else:
+        data = sample_frame(df) if mode == 'sampled' else df
+        if len(data) < len(df):
+            title = f"{title} (sample of {len(data)} of {len(df)} rows)"
+            logger.info(f"Profiling a sample of {len(data)} of {len(df)} rows")
+        profile = ProfileReport(data, title=title, minimal=True)
+
+    # Save the report as an HTML file
+    tmp_path = path.with_name(path.stem + '.tmp.html')
+    profile.to_file(tmp_path)
+    os.replace(tmp_path, path)
+    key_path.write_text(report_key)
@@ -0,0 +1,85 @@
+from loguru import logger
+from modules.config import PROFILE_MODE
+from .pool import process_pool
+from .processor import profile_data, upload_report
+
+class PublishQueue:
+    """
+    Run the side effects of the pipeline (profile reports and their git push) in the background.
+
+    The reports are created in a pool of worker processes while the pipeline keeps running.
+    The workers are spawned, since they start when the first report is submitted, while other
+    threads may be running. When the queue is closed, all the reports that were created are
+    committed and pushed to GitHub together in a single commit, unless the block failed.
+
+    Usage:
+        with PublishQueue() as publisher:
+            publisher.submit_report(df, DOCS_DIR / 'water_report.html', title)
+        # Reports are committed and pushed when the block ends without errors
+    """
+
+    def __init__(self, max_workers=2, enabled=True, push=True, profile_mode=PROFILE_MODE):
+        """
+        Args:
+        - max_workers (int): Number of reports created at the same time.
+        - enabled (bool): If False, the reports are skipped (--no-publish).
+        - push (bool): Commit and push the reports to GitHub. Default is True.
+        - profile_mode (str): Mode of the profile reports: 'minimal', 'sampled' or 'full'.
+        """
+        self.enabled = enabled
+        self.profile_mode = profile_mode
+        self.push = push
+        self.executor = process_pool(max_workers=max_workers, spawn=True) if enabled else None
+        self.futures = {}
+
+    def submit_report(self, df, path, title):
+        """Queue the profile report of a DataFrame."""
+        if not self.enabled:
+            logger.info(f"Publishing disabled. Skipping report {path}")
+            return
+
+        logger.info(f"Queueing data profile report {path}")
+        self.futures[self.executor.submit(profile_data, df, path, title, self.profile_mode)] = path
+
+    def close(self, publish=True):
+        """
+        Wait for the queued reports and publish the ones that were created in a single commit.
+
+        Args:
+        - publish (bool): Commit and push the reports. If False, the reports not started yet
+          are cancelled and nothing is pushed. Default is True.
+        """
+        if self.executor is None:
+            return
+
+        if not publish:
+            logger.warning(f"Pipeline failed. Cancelling the pending reports, nothing is pushed to GitHub")
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+            self.futures = {}
+            return
+
+        created = []
+        for future, path in self.futures.items():
+            try:
+                future.result()
+                created.append(path)
+                logger.success(f"Data profile report {path} created")
+            except Exception as e:
+                logger.error(f"An error occurred while creating the report {path}: {e}")
+
+        self.executor.shutdown()
+        self.executor = None
+        self.futures = {}
+
+        if created and self.push:
+            logger.info(f"Pushing {len(created)} reports to GitHub")
+            upload_report(created)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not publish the reports of a failed run
+        self.close(publish=exc_type is None)
+        return False
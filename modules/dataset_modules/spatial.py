@@ -0,0 +1,276 @@
+from pathlib import Path
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import typer
+from loguru import logger
+from scipy.spatial import cKDTree
+from .workbook import file_md5
+from .uploader import read_parquet_dataset, write_parquet
+from modules.config import PROJ_ROOT, CACHE_DIR, PROCESSED_DATA_DIR
+
+app = typer.Typer()
+
+RIVER_SHAPEFILE = PROJ_ROOT / 'notebooks' / 'river' / 'red_hidrografica_250k.shp'
+SPATIAL_CACHE_DIR = CACHE_DIR / 'spatial'
+SITE_SNAP_FILE = 'site_river_snap.parquet'
+
+# Bounding box (lon/lat) of the Sonora and Bacanuchi river basins, used to clip the national network
+BASIN_BOUNDS = (-111.3, 28.5, -109.7, 31.4)
+
+# Columns of the INEGI hydrographic network: segments are digitized from FNODE_ to TNODE_ (flow direction)
+SEGMENT_COLUMNS = ['NOMBRE', 'FNODE_', 'TNODE_']
+
+def shapefile_md5(path):
+    """
+    md5 of the files of a shapefile that define its geometries and attributes.
+    """
+    path = Path(path)
+    md5 = hashlib.md5()
+    for suffix in ['.shp', '.dbf', '.prj']:
+        part = path.with_suffix(suffix)
+        if part.exists():
+            md5.update(file_md5(part).encode('utf-8'))
+    return md5.hexdigest()
+
+class RiverNetwork:
+    """
+    River segments of the basin with an STRtree for nearest segment queries.
+
+    Coordinates are kept in the projected CRS of the shapefile (metres), so distances are in metres.
+
+    Args:
+    - segments (pd.DataFrame): NOMBRE, FNODE_, TNODE_ and geometry (shapely lines) of each segment.
+    - crs (str): WKT of the CRS of the segments.
+    """
+    def __init__(self, segments, crs):
+        self.segments = segments.reset_index(drop=True)
+        self.crs = crs
+        self.geometries = np.asarray(self.segments['geometry'])
+        self.tree = shapely.STRtree(self.geometries)
+
+        # Next segment downstream: the one that starts at the end node of each segment
+        starts = pd.Series(self.segments.index, index=self.segments['FNODE_']).groupby(level=0).first()
+        self.downstream = self.segments['TNODE_'].map(starts).to_numpy(dtype='float64')
+        self.distance_to_outlet = self.outlet_distances()
+        self._transformer = None
+
+    @classmethod
+    def from_shapefile(cls, path=RIVER_SHAPEFILE, bounds=BASIN_BOUNDS):
+        """
+        Read the river network, keeping the segments that intersect the basin bounds.
+        """
+        import geopandas as gpd
+
+        logger.info(f"Reading river network {Path(path).name}")
+        rivers = gpd.read_file(path)
+        basin = gpd.GeoSeries([shapely.box(*bounds)], crs='EPSG:4326').to_crs(rivers.crs).iloc[0]
+        rivers = rivers[rivers.intersects(basin)]
+
+        segments = pd.DataFrame(rivers[SEGMENT_COLUMNS])
+        segments['geometry'] = np.asarray(rivers.geometry.intersection(basin))
+        segments = segments[~shapely.is_empty(np.asarray(segments['geometry']))]
+
+        logger.info(f"{len(segments)} river segments in the basin")
+        return cls(segments, rivers.crs.to_wkt())
+
+    @classmethod
+    def load(cls, path=RIVER_SHAPEFILE, cache_dir=SPATIAL_CACHE_DIR, bounds=BASIN_BOUNDS):
+        """
+        Load the basin network from the cache of this version of the shapefile, building it
+        the first time. Only the STRtree is built again, which takes milliseconds.
+        """
+        key = hashlib.md5(f"{shapefile_md5(path)}|{bounds}".encode('utf-8')).hexdigest()
+        cache_path = Path(cache_dir) / f"{Path(path).stem}-{key}.parquet"
+
+        if cache_path.exists():
+            table = pq.read_table(cache_path)
+            segments = table.to_pandas()
+            segments['geometry'] = shapely.from_wkb(segments['geometry'])
+            return cls(segments, table.schema.metadata[b'crs'].decode('utf-8'))
+
+        network = cls.from_shapefile(path, bounds=bounds)
+        network.save(cache_path)
+        return network
+
+    def save(self, path):
+        """
+        Save the segments as WKB in a Parquet file, with the CRS in the metadata.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Remove the caches of previous versions of the shapefile
+        for old in path.parent.glob(f"{path.stem.rsplit('-', 1)[0]}-*.parquet"):
+            old.unlink()
+
+        segments = self.segments.assign(geometry=shapely.to_wkb(self.geometries))
+        table = pa.Table.from_pandas(segments, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'crs': self.crs.encode('utf-8')})
+
+        tmp_path = path.with_name(path.name + '.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        logger.success(f"River network cached in {path}")
+
+    def outlet_distances(self):
+        """
+        Length in metres from the start of each segment to the last segment downstream in the basin.
+
+        Each segment is visited once: the walk downstream stops at the first segment whose
+        distance is already known.
+        """
+        lengths = shapely.length(self.geometries)
+        downstream = self.downstream
+        distances = np.full(len(self.segments), np.nan)
+
+        for first in range(len(self.segments)):
+            # Walk downstream until a segment with a known distance, then fill the path backwards
+            path = []
+            visited = set()
+            idx = first
+            while not np.isnan(idx) and np.isnan(distances[int(idx)]) and int(idx) not in visited:
+                path.append(int(idx))
+                visited.add(int(idx))
+                idx = downstream[int(idx)]
+
+            # Outlet of the basin, or a loop in the network
+            total = 0.0 if np.isnan(idx) or int(idx) in visited else distances[int(idx)]
+            for segment in reversed(path):
+                total += lengths[segment]
+                distances[segment] = total
+
+        return distances
+
+    @property
+    def transformer(self):
+        if self._transformer is None:
+            from pyproj import Transformer
+            self._transformer = Transformer.from_crs('EPSG:4326', self.crs, always_xy=True)
+        return self._transformer
+
+    def project(self, longitude, latitude):
+        """
+        Convert longitude/latitude to the coordinates of the network, in metres.
+        """
+        x, y = self.transformer.transform(np.asarray(longitude, dtype='float64'), np.asarray(latitude, dtype='float64'))
+        return np.column_stack([x, y])
+
+    def nearest_segments(self, longitude, latitude, max_distance=None):
+        """
+        Nearest river segment of each point, in a single STRtree query.
+
+        Returns:
+        - pd.DataFrame: Segment index, NOMBRE, distance in metres, position along the segment
+          and distance to the outlet of each point. Points further than max_distance get <NA>.
+        """
+        coords = self.project(longitude, latitude)
+        points = shapely.points(coords)
+        (point_idx, segment_idx), distances = self.tree.query_nearest(
+            points, max_distance=max_distance, return_distance=True, all_matches=False
+        )
+
+        result = pd.DataFrame(index=range(len(points)))
+        result['segment'] = pd.Series(segment_idx, index=point_idx).reindex(result.index).astype('Int64')
+        result['distance_m'] = pd.Series(distances, index=point_idx).reindex(result.index)
+
+        found = point_idx
+        lines = self.geometries[segment_idx]
+        position = shapely.line_locate_point(lines, points[found])
+        result['NOMBRE'] = pd.Series(self.segments['NOMBRE'].to_numpy()[segment_idx], index=found).reindex(result.index)
+        result['position_m'] = pd.Series(position, index=found).reindex(result.index)
+        result['outlet_distance_m'] = pd.Series(
+            self.distance_to_outlet[segment_idx] - position, index=found
+        ).reindex(result.index)
+
+        return result
+
+    def snap_sites(self, sites, max_distance=None):
+        """
+        Snap the monitoring sites to their nearest river segment.
+
+        Args:
+        - sites (pd.DataFrame): CLAVE SITIO, LATITUD and LONGITUD, one row per site.
+        - max_distance (float): Sites further than this distance in metres are not snapped.
+
+        Returns:
+        - pd.DataFrame: The sites with their segment, river name, distance to the river and
+          distance to the outlet. Sites on the same river are upstream of the ones with a
+          smaller outlet_distance_m.
+        """
+        sites = sites.reset_index(drop=True)
+        snapped = self.nearest_segments(sites['LONGITUD'], sites['LATITUD'], max_distance=max_distance)
+        return pd.concat([sites[['CLAVE SITIO', 'LATITUD', 'LONGITUD']], snapped], axis=1)
+
+    def is_upstream(self, segment, other):
+        """
+        Check if a segment is upstream of another, following the flow direction of the network.
+        """
+        seen = set()
+        idx = float(segment)
+        while not np.isnan(idx) and idx not in seen:
+            if idx == other:
+                return True
+            seen.add(idx)
+            idx = self.downstream[int(idx)]
+        return False
+
+class SiteIndex:
+    """
+    KD-tree over the projected coordinates of the monitoring sites, for radius and nearest site queries.
+
+    Args:
+    - sites (pd.DataFrame): CLAVE SITIO, LATITUD and LONGITUD, one row per site.
+    - network (RiverNetwork): Network whose CRS is used to project the sites.
+    """
+    def __init__(self, sites, network):
+        self.sites = sites.dropna(subset=['LATITUD', 'LONGITUD']).reset_index(drop=True)
+        self.network = network
+        self.tree = cKDTree(network.project(self.sites['LONGITUD'], self.sites['LATITUD']))
+
+    def within(self, longitude, latitude, radius_m):
+        """
+        CLAVE SITIO of the sites within radius_m metres of each point.
+        """
+        coords = self.network.project(np.atleast_1d(longitude), np.atleast_1d(latitude))
+        return [self.sites['CLAVE SITIO'].to_numpy()[idx].tolist() for idx in self.tree.query_ball_point(coords, r=radius_m)]
+
+    def nearest(self, longitude, latitude, k=1):
+        """
+        CLAVE SITIO and distance in metres of the k nearest sites of each point.
+        """
+        coords = self.network.project(np.atleast_1d(longitude), np.atleast_1d(latitude))
+        distances, idx = self.tree.query(coords, k=k)
+        return self.sites['CLAVE SITIO'].to_numpy()[idx], distances
+
+def site_locations(water):
+    """
+    One row per monitoring site with its coordinates.
+    """
+    sites = water[['CLAVE SITIO', 'LATITUD', 'LONGITUD']].dropna(subset=['LATITUD', 'LONGITUD'])
+    return sites.drop_duplicates('CLAVE SITIO')
+
+@app.command()
+def snap(
+    shapefile: Path = typer.Option(RIVER_SHAPEFILE, help="River network shapefile"),
+    water_path: Path = typer.Option(PROCESSED_DATA_DIR / 'water_quality_tidy_data.parquet', help="Tidy water quality data"),
+    output_path: Path = typer.Option(PROCESSED_DATA_DIR / SITE_SNAP_FILE, help="Snapped sites"),
+):
+    """
+    Snap the monitoring sites to the river network and save them ordered from upstream to downstream.
+    """
+    network = RiverNetwork.load(shapefile)
+    sites = site_locations(read_parquet_dataset(water_path, columns=['CLAVE SITIO', 'LATITUD', 'LONGITUD']))
+
+    snapped = network.snap_sites(sites)
+    snapped = snapped.sort_values(['NOMBRE', 'outlet_distance_m'], ascending=[True, False])
+
+    write_parquet(snapped, output_path)
+    logger.success(f"{len(snapped)} sites snapped to the river network")
+
+if __name__ == "__main__":
+    app()
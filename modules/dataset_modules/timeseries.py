@@ -0,0 +1,207 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+import typer
+from loguru import logger
+from .pool import process_pool
+from .uploader import read_parquet_dataset, write_parquet
+from modules.config import PROCESSED_DATA_DIR, POLLUTANTS
+
+app = typer.Typer()
+
+DECOMPOSITION_FILE = 'pollutant_decomposition.parquet'
+DECOMPOSITION_INDEX = 'pollutant_decomposition.json'
+
+# Monthly grid with a yearly season
+FREQUENCY = 'MS'
+PERIOD = 12
+# Longest gap, in months, filled by interpolation. Series with longer gaps are split and
+# only their longest part is decomposed.
+MAX_GAP = 6
+SERIES_KEYS = ['CLAVE SITIO', 'CONTAMINANTE']
+
+def long_series(water, pollutants=POLLUTANTS):
+    """
+    Measured values of every site and pollutant in long format: CLAVE SITIO, CONTAMINANTE,
+    FECHA REALIZACIÓN and VALOR.
+    """
+    series = water.melt(
+        id_vars=['CLAVE SITIO', 'FECHA REALIZACIÓN'],
+        value_vars=pollutants,
+        var_name='CONTAMINANTE',
+        value_name='VALOR',
+    )
+    return series.dropna(subset=['FECHA REALIZACIÓN', 'VALOR'])
+
+def series_hashes(series):
+    """
+    Hash of the observations of each series, to detect the series that changed since the last run.
+    """
+    series = series.sort_values(SERIES_KEYS + ['FECHA REALIZACIÓN'])
+    row_hashes = pd.util.hash_pandas_object(series[['FECHA REALIZACIÓN', 'VALOR']], index=False)
+
+    hashes = {}
+    for (site, pollutant), idx in series.groupby(SERIES_KEYS).indices.items():
+        hashes[f"{site}|{pollutant}"] = hashlib.md5(row_hashes.to_numpy()[idx].tobytes()).hexdigest()
+    return hashes
+
+def regular_grid(dates, values, frequency=FREQUENCY, max_gap=MAX_GAP):
+    """
+    Resample an irregular series to a regular grid: mean of each period and linear interpolation
+    of the gaps up to max_gap periods. Returns the longest run without missing periods.
+    """
+    monthly = pd.Series(values, index=pd.DatetimeIndex(dates)).resample(frequency).mean()
+    monthly = monthly.interpolate(method='linear', limit=max_gap, limit_area='inside')
+
+    # Longest run of consecutive periods with values
+    missing = monthly.isna().to_numpy()
+    run_ids = np.cumsum(missing)
+    valid_runs = pd.Series(run_ids[~missing]).value_counts()
+    if valid_runs.empty:
+        return monthly.iloc[:0]
+    longest = valid_runs.idxmax()
+    return monthly[(run_ids == longest) & ~missing]
+
+def decompose_series(key, dates, values, period=PERIOD, model='additive'):
+    """
+    Resample a series and decompose it into trend, seasonal and residual components.
+
+    Returns:
+    - pd.DataFrame: One row per period with the observed value and the components, or None if
+      the series is shorter than two seasons.
+    """
+    from statsmodels.tsa.seasonal import seasonal_decompose
+
+    monthly = regular_grid(dates, values)
+    if len(monthly) < 2 * period:
+        return None
+
+    result = seasonal_decompose(monthly, model=model, period=period)
+    site, pollutant = key.split('|', 1)
+    return pd.DataFrame({
+        'CLAVE SITIO': site,
+        'CONTAMINANTE': pollutant,
+        'FECHA': monthly.index,
+        'observed': result.observed.to_numpy(),
+        'trend': result.trend.to_numpy(),
+        'seasonal': result.seasonal.to_numpy(),
+        'resid': result.resid.to_numpy(),
+    })
+
+def decompose_all(series, keys, max_workers=None):
+    """
+    Decompose the selected series in a process pool, spawned when called from a thread (e.g. a
+    node of the DAG, see process_pool).
+
+    Args:
+    - series (pd.DataFrame): Long format series from long_series.
+    - keys (list of str): Series to decompose, as 'CLAVE SITIO|CONTAMINANTE'.
+    - max_workers (int): Number of processes. Default is the number of CPUs.
+
+    Returns:
+    - list of pd.DataFrame: Components of each series that could be decomposed.
+    """
+    indices = series.groupby(SERIES_KEYS).indices
+    dates = series['FECHA REALIZACIÓN'].to_numpy()
+    values = series['VALOR'].to_numpy(dtype='float64')
+    tasks = [(key, indices[tuple(key.split('|', 1))]) for key in keys]
+
+    workers = max_workers or os.cpu_count() or 1
+    with process_pool(max_workers=max_workers) as executor:
+        results = executor.map(
+            decompose_series,
+            [key for key, _ in tasks],
+            [dates[idx] for _, idx in tasks],
+            [values[idx] for _, idx in tasks],
+            # Each decomposition takes milliseconds, so several are sent to each worker at once
+            chunksize=max(1, len(tasks) // (4 * workers)),
+        )
+        return [result for result in results if result is not None]
+
+def load_index(path):
+    if not Path(path).exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_index(index, path):
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def update_decompositions(water, output_dir=PROCESSED_DATA_DIR, pollutants=POLLUTANTS, max_workers=None, force=False):
+    """
+    Decompose the pollutant series of every site, computing again only the series whose
+    observations changed since the last run.
+
+    The components are saved in pollutant_decomposition.parquet and the hash of the
+    observations of each series in pollutant_decomposition.json.
+
+    Args:
+    - water (pd.DataFrame): Tidy water quality data.
+    - output_dir (Path): Directory of the output files.
+    - pollutants (list of str): Pollutants to decompose.
+    - max_workers (int): Number of processes.
+    - force (bool): Decompose all the series again.
+
+    Returns:
+    - pd.DataFrame: The components of all the series.
+    """
+    output_path = Path(output_dir) / DECOMPOSITION_FILE
+    index_path = Path(output_dir) / DECOMPOSITION_INDEX
+
+    series = long_series(water, pollutants)
+    hashes = series_hashes(series)
+    previous = {} if force or not output_path.exists() else load_index(index_path)
+
+    changed = [key for key, value in hashes.items() if previous.get(key) != value]
+    removed = [key for key in previous if key not in hashes]
+    logger.info(f"{len(changed)} of {len(hashes)} series changed and {len(removed)} were removed since the last run")
+
+    kept = None
+    if output_path.exists() and not force:
+        kept = read_parquet_dataset(output_path)
+        keys = kept['CLAVE SITIO'].astype(str) + '|' + kept['CONTAMINANTE'].astype(str)
+        # Series that did not change keep their components; removed series are dropped
+        unchanged = {key for key in hashes if key not in changed}
+        kept = kept[keys.isin(unchanged)]
+
+    if not changed and not removed and kept is not None:
+        logger.info("No series changed. Keeping the existing decompositions")
+        return kept
+
+    parts = ([kept] if kept is not None and not kept.empty else []) + (decompose_all(series, changed, max_workers) if changed else [])
+    if not parts:
+        if kept is None:
+            logger.warning("No series long enough to decompose")
+            return pd.DataFrame()
+        # All the series were removed, the file is written again without them
+        parts = [kept]
+
+    components = pd.concat(parts, ignore_index=True).sort_values(SERIES_KEYS + ['FECHA'])
+    write_parquet(components, output_path)
+    save_index(hashes, index_path)
+
+    return components
+
+@app.command()
+def decompose(
+    water_path: Path = typer.Option(PROCESSED_DATA_DIR / 'water_quality_tidy_data.parquet', help="Tidy water quality data"),
+    output_dir: Path = typer.Option(PROCESSED_DATA_DIR, help="Directory of the decompositions"),
+    workers: int = typer.Option(None, help="Number of processes"),
+    force: bool = typer.Option(False, help="Decompose all the series again"),
+):
+    """
+    Seasonal decomposition of the pollutant series of every monitoring site.
+    """
+    water = read_parquet_dataset(water_path, columns=['CLAVE SITIO', 'FECHA REALIZACIÓN'] + POLLUTANTS)
+    components = update_decompositions(water, output_dir=output_dir, max_workers=workers, force=force)
+    logger.success(f"Decompositions saved to {Path(output_dir) / DECOMPOSITION_FILE} ({len(components)} rows)")
+
+if __name__ == "__main__":
+    app()
@@ -1,85 +1,258 @@
+from pathlib import Path
+import io
+import os
+import shutil
 import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 import pyarrow as pa
 import pandas as pd
 from tqdm import tqdm
 from loguru import logger
 
-def write_parquet(df, output_path, chunk_size=100):
+ROW_GROUP_SIZE = 256 * 1024
+ROW_GROUP_BYTES = 64 * 1024 * 1024
+CSV_BUFFER_BYTES = 8 * 1024 * 1024
+
+def iter_tables(data, schema=None):
     """
-    Function to save a DataFrame to a Parquet file.
+    Function to iterate over the data to be written as Arrow tables.
 
     Args:
-    df (pd.DataFrame): The DataFrame to be saved.
-    output_path (str): Full path of the Parquet file where the DataFrame will be saved.
-    chunk_size (int): Size of the chunk to write the Parquet in parts. Default is 100 rows
+    data: A pd.DataFrame, a pa.Table, a pa.RecordBatch or an iterable of any of them.
+    schema (pa.Schema): Schema used to convert the DataFrames. Default is the schema of the first chunk.
     """
+    if isinstance(data, (pd.DataFrame, pa.Table, pa.RecordBatch)):
+        data = [data]
+
+    for chunk in data:
+        if isinstance(chunk, pd.DataFrame):
+            chunk = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        elif isinstance(chunk, pa.RecordBatch):
+            chunk = pa.Table.from_batches([chunk])
+
+        if schema is None:
+            schema = chunk.schema
+
+        yield chunk
+
+def write_parquet(data, output_path, row_group_bytes=ROW_GROUP_BYTES, compression='zstd'):
+    """
+    Function to save data to a Parquet file as it arrives.
+
+    Chunks are buffered until they reach row_group_bytes and then written as one row group,
+    so the size of the row groups does not depend on the size of the chunks. Chunks larger
+    than row_group_bytes (e.g. a whole DataFrame) are split into several row groups. The file
+    is written to a temporary path and renamed when complete.
+
+    Args:
+    data: A pd.DataFrame, a pa.Table or an iterable of DataFrames, Tables or RecordBatches.
+    output_path (str): Full path of the Parquet file where the data will be saved.
+    row_group_bytes (int): Target size of each row group in memory. Default is 64 MiB
+    compression (str): Parquet compression codec. Default is zstd
+    """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    total_rows = len(data) if isinstance(data, (pd.DataFrame, pa.Table, pa.RecordBatch)) else None
+    writer = None
 
     try:
-        # Convertir el DataFrame a una tabla de Arrow
-        table = pa.Table.from_pandas(df)
-        total_rows = len(df)
-        
-        logger.info(f"Starting to write Parquet file to {output_path} with {total_rows} rows.")
-
-        # Create the Parquet writer
-        with pq.ParquetWriter(output_path, table.schema) as writer:
-            # Start progress bar
-            with tqdm(total=total_rows, desc="Writing Parquet", unit="rows") as bar:
-                for start in range(0, total_rows, chunk_size):
-                    end = min(start + chunk_size, total_rows)
-                    
-                    # Create a data chunk
-                    chunk = table.slice(start, end - start)
-                    
-                    # Write the chunk to the Parquet file
-                    writer.write_table(chunk)
-                    
-                    # Update progress bar
-                    bar.update(end - start)
-
-                    logger.debug(f"Written rows {start} to {end} to Parquet.")
-
-        logger.success(f"Parquet file successfully written to {output_path}.")
-    
+        logger.info(f"Starting to write Parquet file to {output_path}.")
+
+        buffer = []
+        buffer_bytes = 0
+        written_rows = 0
+
+        with tqdm(total=total_rows, desc="Writing Parquet", unit="rows") as bar:
+            for table in iter_tables(data):
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, table.schema, compression=compression)
+
+                buffer.append(table)
+                buffer_bytes += table.nbytes
+
+                if buffer_bytes >= row_group_bytes:
+                    written_rows += write_row_group(writer, buffer, row_group_bytes)
+                    bar.update(written_rows - bar.n)
+                    buffer, buffer_bytes = [], 0
+
+            if writer is None:
+                raise ValueError("No data to write")
+
+            if buffer:
+                written_rows += write_row_group(writer, buffer, row_group_bytes)
+                bar.update(written_rows - bar.n)
+
+            writer.close()
+
+        os.replace(tmp_path, output_path)
+        logger.success(f"Parquet file successfully written to {output_path} with {written_rows} rows.")
+
     except Exception as e:
+        # The file must be closed before removing it (required on Windows)
+        if writer is not None:
+            writer.close()
+        if tmp_path.exists():
+            tmp_path.unlink()
         logger.error(f"Error while writing Parquet file: {str(e)}")
         raise
 
-def write_csv(df, output_path, chunk_size=100):
+def write_row_group(writer, tables, row_group_bytes=ROW_GROUP_BYTES):
+    """
+    Function to write a list of Arrow tables as a single row group, or as row groups of about
+    row_group_bytes when together they are larger.
+
+    Returns:
+    int: Number of rows written.
+    """
+    table = pa.concat_tables(tables)
+    rows = table.num_rows
+
+    # Rows of about row_group_bytes, estimated with the average size of a row
+    if table.nbytes > row_group_bytes:
+        rows = row_group_bytes * table.num_rows // table.nbytes
+
+    writer.write_table(table, row_group_size=max(rows, 1))
+    return table.num_rows
+
+def write_csv(data, output_path, buffer_bytes=CSV_BUFFER_BYTES):
     """
-    Function to save a DataFrame to a CSV file.
+    Function to save data to a CSV file as it arrives.
+
+    The chunks are converted to text in memory and written to disk every buffer_bytes. The
+    file is written to a temporary path and renamed when complete.
 
     Args:
-    df (pd.DataFrame): The DataFrame to be saved.
-    output_path (str): Full path of the CSV file where the DataFrame will be saved.
-    chunk_size (int): Size of the chunk to write the CSV in parts. Default is 100 rows
+    data: A pd.DataFrame or an iterable of DataFrames or RecordBatches with the same columns.
+    output_path (str): Full path of the CSV file where the data will be saved.
+    buffer_bytes (int): Size of the text buffer written to disk at once. Default is 8 MiB
     """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
 
     try:
-        total_rows = len(df)
-        logger.info(f"Starting to write CSV file to {output_path} with {total_rows} rows.")
-
-        # Abrir el archivo CSV
-        with open(output_path, 'w') as f:
-            # Escribir los encabezados (header)
-            df.head(0).to_csv(f, index=False)
-            
-            # Barra de progreso para el proceso
-            with tqdm(total=total_rows, desc="Writing CSV", unit="rows") as bar:
-                for start in range(0, total_rows, chunk_size):
-                    end = min(start + chunk_size, total_rows)
-                    
-                    # Escribir un chunk (parte) del DataFrame
-                    df.iloc[start:end].to_csv(f, header=False, index=False)
-                    
-                    # Actualizar la barra de progreso
-                    bar.update(end - start)
-                    
-                    logger.debug(f"Written rows {start} to {end} to CSV.")
-
-        logger.success(f"CSV file successfully written to {output_path}.")
-    
+        logger.info(f"Starting to write CSV file to {output_path}.")
+
+        written_rows = 0
+        header = True
+        buffer = io.StringIO()
+
+        with open(tmp_path, 'w') as f, tqdm(desc="Writing CSV", unit="rows") as bar:
+            for chunk in chunks:
+                if isinstance(chunk, (pa.RecordBatch, pa.Table)):
+                    chunk = chunk.to_pandas()
+
+                # Write the header only with the first chunk
+                chunk.to_csv(buffer, header=header, index=False)
+                header = False
+                written_rows += len(chunk)
+                bar.update(len(chunk))
+
+                if buffer.tell() >= buffer_bytes:
+                    f.write(buffer.getvalue())
+                    buffer = io.StringIO()
+
+            f.write(buffer.getvalue())
+
+        os.replace(tmp_path, output_path)
+        logger.success(f"CSV file successfully written to {output_path} with {written_rows} rows.")
+
     except Exception as e:
+        if tmp_path.exists():
+            tmp_path.unlink()
         logger.error(f"Error while writing CSV file: {str(e)}")
         raise
 
+def write_parquet_dataset(df, output_path, partition_cols, row_group_size=ROW_GROUP_SIZE, compression='zstd'):
+    """
+    Function to save a DataFrame as a hive-partitioned Parquet dataset (e.g. Año=2020/part-0.parquet).
+
+    The dataset is written to a temporary directory and then moved to output_path, replacing
+    the previous version.
+
+    Args:
+    df (pd.DataFrame): The DataFrame to be saved.
+    output_path (str): Directory of the dataset.
+    partition_cols (list of str): Columns used to partition the dataset, in order.
+    row_group_size (int): Maximum number of rows per row group. Default is 262144 rows
+    compression (str): Parquet compression codec. Default is zstd
+    """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    old_path = output_path.with_name(output_path.name + '.old')
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        logger.info(f"Starting to write Parquet dataset to {output_path} with {len(df)} rows partitioned by {partition_cols}.")
+
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        ds.write_dataset(
+            table,
+            tmp_path,
+            format='parquet',
+            partitioning=partition_cols,
+            partitioning_flavor='hive',
+            basename_template='part-{i}.parquet',
+            file_options=ds.ParquetFileFormat().make_write_options(compression=compression, use_dictionary=True),
+            max_rows_per_group=row_group_size,
+            min_rows_per_group=min(row_group_size, len(df)) or 1,
+        )
+
+        # Replace the previous version, which may be a single file or a dataset. A .old left by
+        # an interrupted run would make the rename fail
+        if output_path.is_dir():
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(output_path, old_path)
+        elif output_path.exists():
+            output_path.unlink()
+        os.replace(tmp_path, output_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        logger.success(f"Parquet dataset successfully written to {output_path}.")
+
+    except Exception as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.error(f"Error while writing Parquet dataset: {str(e)}")
+        raise
+
+def open_dataset(path):
+    """
+    Function to open a Parquet file or hive-partitioned dataset as an Arrow dataset.
+
+    pyarrow infers the type of the partition columns from the directory names (int32 for
+    Año=2020), so the integer ones are opened as int64, the type they were written with.
+
+    Args:
+    path (str): Parquet file or directory of the dataset.
+
+    Returns:
+    ds.Dataset: The dataset. Only the metadata is read.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    partitions = dataset.partitioning.schema if dataset.partitioning is not None else pa.schema([])
+
+    if not any(pa.types.is_integer(field.type) for field in partitions):
+        return dataset
+
+    schema = pa.schema([pa.field(field.name, pa.int64()) if pa.types.is_integer(field.type) else field for field in partitions])
+    return ds.dataset(path, format='parquet', partitioning=ds.partitioning(schema, flavor='hive'))
+
+def read_parquet_dataset(path, filters=None, columns=None):
+    """
+    Function to read a Parquet file or hive-partitioned dataset, pushing the filters down.
+
+    Filters on partition columns only open the matching partitions, and filters on other
+    columns skip the row groups whose statistics do not match. Integer partition columns are
+    read as int64 (see open_dataset); pd.read_parquet would read them as categories.
+
+    Args:
+    path (str): Parquet file or directory of the dataset.
+    filters (list of tuple): Filters in pandas/pyarrow format, e.g. [('Año', '=', 2020)].
+    columns (list of str): Columns to read. Default is all the columns.
+
+    Returns:
+    pd.DataFrame: The selected rows and columns.
+    """
+    dataset = open_dataset(path)
+    expression = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
@@ -0,0 +1,246 @@
+from pathlib import Path
+import hashlib
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from loguru import logger
+from tqdm import tqdm
+from modules.config import CACHE_DIR
+
+WORKBOOK_CACHE_DIR = CACHE_DIR / 'workbooks'
+# Rows of a sheet converted to a DataFrame at once by iter_sheet
+CHUNK_ROWS = 50_000
+
+def get_dvc_md5(file_path):
+    """
+    Get the md5 of a file as recorded in its .dvc file.
+
+    The hash is only trusted if the size stored in the .dvc file matches the file on disk and
+    the file was not modified after the .dvc file was written. Otherwise the file was replaced
+    after the last `dvc add` (e.g. downloaded again with --refresh, since the outputs are only
+    added to DVC at the end of the run) and None is returned.
+
+    Args:
+    - file_path (Path): Path of the file tracked by DVC.
+    """
+    file_path = Path(file_path)
+    dvc_file = file_path.with_name(file_path.name + '.dvc')
+
+    if not dvc_file.exists():
+        return None
+
+    with open(dvc_file) as f:
+        outs = (yaml.safe_load(f) or {}).get('outs', [])
+
+    for out in outs:
+        if out.get('path') == file_path.name:
+            if file_path.exists():
+                stat = file_path.stat()
+                if out.get('size') not in (None, stat.st_size) or stat.st_mtime_ns > dvc_file.stat().st_mtime_ns:
+                    logger.warning(f"{dvc_file.name} is out of date with {file_path.name}")
+                    return None
+            return out.get('md5')
+
+    return None
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    """
+    Compute the md5 of a file reading it in chunks.
+
+    Args:
+    - file_path (Path): Path of the file.
+    - chunk_size (int): Number of bytes read on each iteration.
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def get_md5(file_path):
+    """
+    Get the md5 of a file, using the .dvc file when it is up to date and hashing the file otherwise.
+    """
+    return get_dvc_md5(file_path) or file_md5(file_path)
+
+def load_workbook(file_path, cache_dir=WORKBOOK_CACHE_DIR, use_cache=True):
+    """
+    Read every sheet of an Excel workbook, using a Parquet cache keyed by the md5 of the file.
+
+    The workbook is opened only once. On a cache hit the Excel engine is not used at all. The
+    sheets are returned as they are stored in the cache (see to_arrow) also on a miss or without
+    the cache, so the result does not depend on whether the cache was warm.
+
+    Args:
+    - file_path (Path): Path of the workbook (.xlsb, .xlsx).
+    - cache_dir (Path): Directory where the cached sheets are stored.
+    - use_cache (bool): Read and write the cache. Default is True.
+
+    Returns:
+    - list of pd.DataFrame: One DataFrame per sheet, in workbook order.
+    """
+    file_path = Path(file_path)
+    cache_path = Path(cache_dir) / f"{file_path.stem}-{get_md5(file_path)}" if use_cache else None
+
+    if cache_path is not None and cache_path.exists():
+        logger.info(f"Reading {file_path.name} from cache {cache_path}")
+        return [pd.read_parquet(sheet) for sheet in sorted(cache_path.glob('sheet_*.parquet'))]
+
+    engine = excel_engine(file_path)
+    tables = []
+
+    logger.info(f"Starting reading file {file_path.name}")
+    with pd.ExcelFile(file_path, engine=engine) as excel_file:
+        with tqdm(total=len(excel_file.sheet_names), desc="Reading sheets", unit="sheet") as pbar:
+            for sheet_name in excel_file.sheet_names:
+                tables.append(to_arrow(excel_file.parse(sheet_name)))
+                pbar.update(1)
+
+    if cache_path is not None:
+        write_cache(tables, cache_path)
+
+    return [table.to_pandas() for table in tables]
+
+def excel_engine(file_path):
+    """
+    pandas engine of a workbook: pyxlsb for .xlsb files, the default one for the others.
+    """
+    return 'pyxlsb' if Path(file_path).suffix == '.xlsb' else None
+
+def read_sheet(file_path, sheet):
+    """
+    Read a single sheet of a workbook, without the cache of load_workbook.
+
+    Args:
+    - file_path (Path): Path of the workbook.
+    - sheet (int): Position of the sheet, starting at 0.
+    """
+    return pd.read_excel(file_path, sheet_name=sheet, engine=excel_engine(file_path))
+
+def cell_value(value):
+    # Whole numbers are read as int, as pandas does
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def sheet_rows(file_path, sheet):
+    """
+    Iterate the rows of a sheet as tuples of values, without loading the whole sheet.
+
+    .xlsb files are read with pyxlsb and the others with openpyxl in read-only mode.
+
+    Args:
+    - file_path (Path): Path of the workbook.
+    - sheet (int): Position of the sheet, starting at 0.
+    """
+    file_path = Path(file_path)
+
+    if excel_engine(file_path) == 'pyxlsb':
+        from pyxlsb import open_workbook
+
+        # pyxlsb numbers the sheets from 1
+        with open_workbook(str(file_path)) as workbook, workbook.get_sheet(sheet + 1) as worksheet:
+            for row in worksheet.rows(sparse=True):
+                yield tuple(cell_value(cell.v) for cell in row)
+    else:
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for row in workbook.worksheets[sheet].iter_rows(values_only=True):
+                yield tuple(cell_value(value) for value in row)
+        finally:
+            workbook.close()
+
+def iter_sheet(file_path, sheet, columns=None, chunk_rows=CHUNK_ROWS):
+    """
+    Read a sheet in blocks of rows, so only one block is in memory at a time. The first row
+    is the header and empty rows are skipped, as in pd.read_excel.
+
+    Args:
+    - file_path (Path): Path of the workbook.
+    - sheet (int): Position of the sheet, starting at 0.
+    - columns (list of str): Columns to keep. Default is all the columns.
+    - chunk_rows (int): Maximum number of rows of each block.
+
+    Yields:
+    - pd.DataFrame: Rows of the sheet, with a RangeIndex over the whole sheet.
+    """
+    rows = sheet_rows(file_path, sheet)
+    header = next(rows, None)
+    if header is None:
+        return
+
+    header = [f"Unnamed: {idx}" if name is None else str(name) for idx, name in enumerate(header)]
+    columns = header if columns is None else list(columns)
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in sheet {sheet} of {Path(file_path).name}")
+
+    positions = [header.index(column) for column in columns]
+    start = 0
+    block = []
+
+    for row in rows:
+        values = tuple(row[idx] if idx < len(row) else None for idx in positions)
+        if all(value is None for value in row):
+            continue
+        block.append(values)
+
+        if len(block) == chunk_rows:
+            yield pd.DataFrame.from_records(block, columns=columns, index=pd.RangeIndex(start, start + len(block)))
+            start += len(block)
+            block = []
+
+    if block or not start:
+        yield pd.DataFrame.from_records(block, columns=columns, index=pd.RangeIndex(start, start + len(block)))
+
+def write_cache(tables, cache_path):
+    """
+    Save the sheets of a workbook as Parquet files, replacing older caches of the same workbook.
+
+    Args:
+    - tables (list of pa.Table): Sheets of the workbook, converted with to_arrow.
+    - cache_path (Path): Directory of the cache for this version of the workbook.
+    """
+    cache_path = Path(cache_path)
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    prefix = cache_path.name.rsplit('-', 1)[0]
+
+    try:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        for idx, table in enumerate(tables):
+            pq.write_table(table, tmp_path / f"sheet_{idx:02d}.parquet")
+
+        # Remove the caches of previous versions of the workbook
+        for old in cache_path.parent.glob(f"{prefix}-*"):
+            if old != tmp_path:
+                shutil.rmtree(old, ignore_errors=True)
+
+        os.replace(tmp_path, cache_path)
+        logger.success(f"Workbook cache written to {cache_path}")
+
+    except Exception as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.warning(f"Could not write workbook cache {cache_path}: {e}")
+
+def to_arrow(df):
+    """
+    Convert a sheet to an Arrow table. Object columns mixing numbers and text (e.g. '<0.5')
+    are stored as strings, keeping the missing values.
+    """
+    df = df.copy()
+    df.columns = [str(column) for column in df.columns]
+
+    for column in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+
+    return pa.Table.from_pandas(df, preserve_index=False)
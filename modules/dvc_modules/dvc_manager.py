@@ -4,7 +4,8 @@ from loguru import logger
 import subprocess
 import sys
 import datetime
-from dotenv import load_dotenv
+import threading
+from modules.metrics import stage, timed
 from modules.config import PROJ_ROOT, PROCESSED_DATA_DIR, RAW_DATA_DIR, DVC_ROOT, DVC_REMOTE, DVC_GDRIVE_CLIENT_ID, DVC_GDRIVE_CLIENT_SECRET
 
 app = typer.Typer()
@@ -77,6 +78,7 @@ def add_credentials(remote_name):
         logger.error(f"Error trying to add gdrive credentials to DVC: {e}")
         raise RuntimeError(f"Error trying to add gdrive credentials to DVC.") from e
 
+@timed('dvc.add')
 def add_file_to_dvc(file_path):
     """Add the file to DVC."""
     
@@ -93,6 +95,7 @@ def add_file_to_dvc(file_path):
         raise RuntimeError(f"Error trying to add {file_path} to DVC.") from e
 
 
+@timed('dvc.push')
 def push_to_dvc_remote(remote_name="origin"):
     """Push changes to the DVC remote."""
     logger.info(f"Attempting to push to remote {DVC_REMOTE}...")
@@ -103,6 +106,99 @@ def push_to_dvc_remote(remote_name="origin"):
         logger.error(f"Error trying to push to remote {DVC_REMOTE}: {e}")
         raise RuntimeError(f"Failed to push to remote {remote_name}.") from e
     
+class DvcSession:
+    """
+    Collect the files produced during a pipeline run and add them to DVC and push them at once.
+
+    Every `dvc add` and `dvc push` scans the repository and authenticates to the remote, so
+    a single add over all the paths and a single push are much faster than one of each per file.
+    The in-process DVC API is used when available, otherwise the dvc command is called.
+
+    Usage:
+        with DvcSession(remote_name='origin') as session:
+            session.track(path)
+        # Files are added and pushed when the block ends without errors
+    """
+
+    def __init__(self, remote_name="origin", use_api=True, repo_path=PROJ_ROOT, push=True):
+        """
+        Args:
+        - remote_name (str): Remote name for DVC.
+        - use_api (bool): Use dvc.repo.Repo instead of running the dvc command. Default is True.
+        - repo_path (Path): Root of the DVC repository.
+        - push (bool): Push to the remote after adding the files. Default is True.
+        """
+        self.remote_name = remote_name
+        self.push = push
+        self.use_api = use_api
+        self.repo_path = Path(repo_path)
+        self.paths = []
+        self._lock = threading.Lock()
+
+    def track(self, file_path):
+        """Register a file to be added to DVC when the session is flushed."""
+        file_path = Path(file_path)
+
+        if not file_path.exists():
+            logger.error(f"The file {file_path} does not exist.")
+            raise FileNotFoundError(f"The file {file_path} does not exist.")
+
+        with self._lock:
+            if file_path not in self.paths:
+                self.paths.append(file_path)
+        logger.info(f"{file_path} will be added to DVC at the end of the run")
+
+    def flush(self):
+        """Add all the registered files to DVC and push them to the remote."""
+        with self._lock:
+            paths, self.paths = self.paths, []
+
+        if not paths:
+            logger.info(f"No files to add to DVC.")
+            return
+
+        logger.info(f"Adding {len(paths)} files to DVC...")
+        with stage('dvc.flush', files=len(paths)) as record:
+            record.read(*paths)
+            self.add_and_push(paths)
+
+    def add_and_push(self, paths):
+        """Add the files to DVC and push them, with the DVC API or the dvc command."""
+        if self.use_api:
+            try:
+                from dvc.repo import Repo
+            except ImportError:
+                logger.warning(f"DVC API not available. Using the dvc command instead.")
+            else:
+                try:
+                    with Repo(str(self.repo_path)) as repo:
+                        repo.add([str(path) for path in paths])
+                        if self.push:
+                            repo.push(remote=self.remote_name)
+                    logger.success(f"{len(paths)} files added to DVC.")
+                    return
+                except Exception as e:
+                    logger.error(f"Error trying to add and push {len(paths)} files with DVC: {e}")
+                    raise RuntimeError(f"Failed to add and push files to remote {self.remote_name}.") from e
+
+        try:
+            subprocess.run(["dvc", "add", *[str(path) for path in paths]], check=True, cwd=self.repo_path)
+            if self.push:
+                subprocess.run(["dvc", "push", "-r", self.remote_name], check=True, cwd=self.repo_path)
+            logger.success(f"{len(paths)} files added to DVC.")
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error trying to add and push {len(paths)} files with DVC: {e}")
+            raise RuntimeError(f"Failed to add and push files to remote {self.remote_name}.") from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not version the outputs of a failed run
+        if exc_type is None:
+            self.flush()
+        return False
+
 def check_setup():
     try:
         logger.info(f"Checking DVC configuration")
@@ -1,28 +1,323 @@
 from pathlib import Path
+import hashlib
+import inspect
+import json
+import os
 
+import pandas as pd
+import pyarrow.parquet as pq
 import typer
 from loguru import logger
 from tqdm import tqdm
 
-from modules.config import PROCESSED_DATA_DIR
+from dataset_modules.join import load_municipalities, municipality_codes
+from dataset_modules.manifest import config_hash, load_manifest
+from dataset_modules.uploader import read_parquet_dataset, write_parquet
+from modules.config import PROCESSED_DATA_DIR, POLLUTANTS
 
 app = typer.Typer()
 
+FEATURES_DIR = PROCESSED_DATA_DIR / "features"
+FEATURES_INDEX = "features.json"
+
+# Processed outputs the blocks read, with the manifest stage that builds them
+INPUTS = {
+    'water': ('water', PROCESSED_DATA_DIR / 'water_quality_tidy_data.parquet'),
+    'yearly': ('yearly', PROCESSED_DATA_DIR / 'water_livestock_yearly.parquet'),
+}
+
+# Columns identifying a water sample in the water blocks
+SAMPLE_KEYS = ['ID_MUESTRA', 'CLAVE SITIO', 'FECHA REALIZACIÓN', 'Año', 'Clave_INEGI']
+
+ROLLING_WINDOW = '365D'
+LIVESTOCK_LAGS = [1, 2]
+
+# Reference limits of each pollutant: ('max', x) flags values above x, ('min', x) values below x.
+# CONAGUA water quality indicators for surface water; adjust them to the regulation being studied.
+POLLUTANT_LIMITS = {
+    'OD_mg/L': ('min', 4.0),
+    'DBO_TOT': ('max', 30.0),
+    'DQO_TOT': ('max', 40.0),
+    'COLI_FEC': ('max', 1000.0),
+    'E_COLI': ('max', 1000.0),
+    'N_TOT': ('max', 10.0),
+    'P_TOT': ('max', 0.5),
+    'TOX_D_48_UT': ('max', 1.0),
+    'TOX_FIS_SUP_15_UT': ('max', 1.0),
+}
+
+
+def water_samples(water):
+    """
+    Water samples with a date, sorted by site and date, with a stable sample id.
+
+    Every water block starts from this table, so their rows can be joined on ID_MUESTRA.
+    """
+    municipalities = load_municipalities()
+    samples = water.dropna(subset=['FECHA REALIZACIÓN'])
+    samples = samples.sort_values(['CLAVE SITIO', 'FECHA REALIZACIÓN'], kind='stable').reset_index(drop=True)
+    samples.insert(0, 'ID_MUESTRA', range(len(samples)))
+    samples['Clave_INEGI'] = municipality_codes(samples['MUNICIPIO'], municipalities)
+    return samples
+
+
+def pollutant_values(inputs, pollutants=POLLUTANTS):
+    """
+    Measured value of each pollutant and the location of the site, used to train the imputers.
+    """
+    samples = water_samples(inputs['water'])
+    return samples[SAMPLE_KEYS + ['LATITUD', 'LONGITUD'] + pollutants].copy()
+
+
+def water_rolling(inputs, window=ROLLING_WINDOW, pollutants=POLLUTANTS):
+    """
+    Rolling mean, standard deviation and maximum of each pollutant per site, over the samples
+    of the site in the previous `window` (the current sample included).
+    """
+    samples = water_samples(inputs['water'])
+    features = samples[SAMPLE_KEYS].copy()
+
+    rolling = samples.set_index('FECHA REALIZACIÓN').groupby('CLAVE SITIO', sort=False)[pollutants].rolling(window)
+    for stat in ['mean', 'std', 'max']:
+        values = getattr(rolling, stat)()
+        # The groups keep the order of the sorted samples, so the positions match
+        for pollutant in pollutants:
+            features[f"{pollutant}_{stat}_{window}"] = values[pollutant].to_numpy()
+
+    return features
+
+
+def exceedance_flags(inputs, limits=POLLUTANT_LIMITS):
+    """
+    Flag of each pollutant exceeding its limit (1/0, <NA> when the value is missing) and the
+    number of exceedances of each sample.
+    """
+    samples = water_samples(inputs['water'])
+    features = samples[SAMPLE_KEYS].copy()
+
+    for pollutant, (kind, limit) in limits.items():
+        values = samples[pollutant]
+        exceeded = values < limit if kind == 'min' else values > limit
+        features[f"{pollutant}_exceeds"] = exceeded.astype('Int8').mask(values.isna())
+
+    flags = [f"{pollutant}_exceeds" for pollutant in limits]
+    features['exceedances'] = features[flags].sum(axis=1).astype('Int8')
+
+    return features
+
+
+def livestock_lags(inputs, lags=LIVESTOCK_LAGS):
+    """
+    Livestock volumes and value of previous years per municipality.
+
+    Lags are joined by year, so a missing year gives <NA> instead of shifting an older one.
+    """
+    yearly = inputs['yearly']
+    columns = [column for column in yearly.columns if column.startswith('Volumen_')] + ['Valor_Total']
+    features = yearly[['Clave_INEGI', 'Año']].copy()
+
+    for lag in lags:
+        lagged = yearly[['Clave_INEGI', 'Año'] + columns].copy()
+        lagged['Año'] = lagged['Año'] + lag
+        lagged.columns = ['Clave_INEGI', 'Año'] + [f"{column}_lag{lag}" for column in columns]
+        features = features.merge(lagged, on=['Clave_INEGI', 'Año'], how='left')
+
+    return features
+
+
+# Functions shared by the water blocks: every water block starts from water_samples
+WATER_HELPERS = [water_samples, load_municipalities, municipality_codes]
+
+# Feature blocks: inputs read, shared functions they call, parameters and the keys used to
+# join them in a feature set
+BLOCKS = {
+    'pollutant_values': {
+        'function': pollutant_values,
+        'helpers': WATER_HELPERS,
+        'inputs': ['water'],
+        'params': {'pollutants': POLLUTANTS},
+        'keys': ['ID_MUESTRA'],
+    },
+    'water_rolling': {
+        'function': water_rolling,
+        'helpers': WATER_HELPERS,
+        'inputs': ['water'],
+        'params': {'window': ROLLING_WINDOW, 'pollutants': POLLUTANTS},
+        'keys': ['ID_MUESTRA'],
+    },
+    'exceedance_flags': {
+        'function': exceedance_flags,
+        'helpers': WATER_HELPERS,
+        'inputs': ['water'],
+        'params': {'limits': POLLUTANT_LIMITS},
+        'keys': ['ID_MUESTRA'],
+    },
+    'livestock_lags': {
+        'function': livestock_lags,
+        'helpers': [],
+        'inputs': ['yearly'],
+        'params': {'lags': LIVESTOCK_LAGS},
+        'keys': ['Clave_INEGI', 'Año'],
+    },
+}
+
+
+def input_hash(name):
+    """
+    Hash of a processed output, from the inputs and configuration recorded in the build manifest.
+
+    Outputs that are not in the manifest are hashed by the name, size and modification time of
+    their files.
+    """
+    stage, path = INPUTS[name]
+    entry = load_manifest()['stages'].get(stage)
+
+    if entry is not None:
+        return config_hash({'inputs': entry['inputs'], 'config': entry['config']})
+
+    path = Path(path)
+    files = sorted(path.rglob('*.parquet')) if path.is_dir() else [path]
+    return config_hash([(str(f.relative_to(path.parent)), f.stat().st_size, f.stat().st_mtime_ns) for f in files])
+
+
+def block_key(name):
+    """
+    Key of a feature block: the hashes of its inputs, its parameters and the source code of its
+    function and of the helpers it calls, so a block is computed again when any of them changes.
+    """
+    block = BLOCKS[name]
+    sources = [inspect.getsource(function) for function in [block['function']] + block['helpers']]
+    code = hashlib.md5(''.join(sources).encode('utf-8')).hexdigest()
+
+    return config_hash({
+        'inputs': {input_name: input_hash(input_name) for input_name in block['inputs']},
+        'params': block['params'],
+        'code': code,
+    })
+
+
+def load_index(features_dir=FEATURES_DIR):
+    """
+    Read the keys of the blocks stored in the feature store.
+    """
+    path = Path(features_dir) / FEATURES_INDEX
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index(index, features_dir=FEATURES_DIR):
+    path = Path(features_dir) / FEATURES_INDEX
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def build_features(blocks=None, features_dir=FEATURES_DIR, force=False):
+    """
+    Compute the requested feature blocks and save them in the feature store.
+
+    Only the blocks whose key changed are computed, and only the inputs of those blocks are read.
+
+    Args:
+    - blocks (list of str): Blocks to build. Default is all the blocks in BLOCKS.
+    - features_dir (Path): Directory of the feature store, one Parquet file per block.
+    - force (bool): Compute the blocks even if they are up to date. Default is False.
+
+    Returns:
+    - dict: Path of each block in the feature store.
+    """
+    blocks = list(BLOCKS) if blocks is None else list(blocks)
+    unknown = [name for name in blocks if name not in BLOCKS]
+    if unknown:
+        raise KeyError(f"Unknown feature blocks {unknown}. Available blocks: {list(BLOCKS)}")
+
+    features_dir = Path(features_dir)
+    features_dir.mkdir(parents=True, exist_ok=True)
+    index = load_index(features_dir)
+    inputs = {}
+    paths = {}
+
+    for name in tqdm(blocks, desc="Feature blocks", unit="block"):
+        key = block_key(name)
+        path = features_dir / f"{name}.parquet"
+        paths[name] = path
+
+        if not force and index.get(name) == key and path.exists():
+            logger.info(f"Feature block {name} is up to date")
+            continue
+
+        # Inputs are read only when a block needs them, and once per run
+        for input_name in BLOCKS[name]['inputs']:
+            if input_name not in inputs:
+                inputs[input_name] = read_parquet_dataset(INPUTS[input_name][1])
+
+        logger.info(f"Computing feature block {name}")
+        features = BLOCKS[name]['function'](inputs, **BLOCKS[name]['params'])
+        write_parquet(features, path)
+
+        index[name] = key
+        save_index(index, features_dir)
+
+    return paths
+
+
+def load_features(blocks=None, features_dir=FEATURES_DIR, columns=None):
+    """
+    Read a feature set from the feature store, joining the blocks by their keys.
+
+    Water blocks are joined by ID_MUESTRA and the municipality blocks by Clave_INEGI and Año,
+    so each water sample gets the livestock features of its municipality and year.
+
+    Args:
+    - blocks (list of str): Blocks of the feature set. Default is all the blocks.
+    - features_dir (Path): Directory of the feature store.
+    - columns (list of str): Feature columns to read. Default is all of them. Only these
+      columns and the keys are read from each block, so large feature sets can be read in subsets.
+
+    Returns:
+    - pd.DataFrame: The feature set.
+    """
+    paths = build_features(blocks, features_dir=features_dir)
+    features = None
+
+    # Sample level blocks first, so the municipality blocks are joined to each sample
+    for name in sorted(paths, key=lambda name: BLOCKS[name]['keys'] != ['ID_MUESTRA']):
+        keys = BLOCKS[name]['keys']
+        block_columns = None
+
+        if columns is not None:
+            available = pq.read_schema(paths[name]).names
+            block_columns = [column for column in available if column in columns or column in SAMPLE_KEYS + keys]
+            if not set(block_columns) - set(SAMPLE_KEYS + keys):
+                continue
+
+        block = pd.read_parquet(paths[name], columns=block_columns)
+
+        if features is None:
+            features = block
+        else:
+            # Keep a single copy of the columns shared by the blocks
+            block = block[keys + [column for column in block.columns if column not in features.columns]]
+            features = features.merge(block, on=keys, how='left')
+
+    if features is None:
+        raise KeyError(f"None of the columns {columns} are in the feature blocks {list(paths)}")
+
+    return features
+
 
 @app.command()
 def main(
-    # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
-    input_path: Path = PROCESSED_DATA_DIR / "dataset.csv",
-    output_path: Path = PROCESSED_DATA_DIR / "features.csv",
-    # -----------------------------------------
+    blocks: list[str] = typer.Option(None, help="Feature blocks to build. Default is all of them"),
+    features_dir: Path = FEATURES_DIR,
+    force: bool = typer.Option(False, help="Compute the blocks even if they are up to date"),
 ):
-    # ---- REPLACE THIS WITH YOUR OWN CODE ----
-    logger.info("Generating features from dataset...")
-    for i in tqdm(range(10), total=10):
-        if i == 5:
-            logger.info("Something happened for iteration 5.")
-    logger.success("Features generation complete.")
-    # -----------------------------------------
+    logger.info("Generating features from the processed data...")
+    paths = build_features(blocks or None, features_dir=features_dir, force=force)
+    logger.success(f"Features generation complete: {', '.join(path.name for path in paths.values())}")
 
 
 if __name__ == "__main__":
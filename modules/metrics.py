@@ -0,0 +1,298 @@
+from contextlib import contextmanager
+from pathlib import Path
+import cProfile
+import datetime
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from loguru import logger
+from modules.config import REPORTS_DIR
+
+try:
+    # Peak RSS of the process and of its child processes, not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+METRICS_DIR = REPORTS_DIR / 'metrics'
+METRICS_FILE = METRICS_DIR / 'pipeline_metrics.jsonl'
+# Functions listed in the text summary of the cProfile dump
+PROFILE_TOP = 40
+
+# Metrics of the run in progress; stages outside a run are not recorded
+_active = None
+_local = threading.local()
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident memory of the process (or of its finished child processes) in MiB.
+
+    Without the resource module (Windows) the peak working set of the process is reported
+    with psutil, and the one of the child processes is not available (None).
+    """
+    if resource is None:
+        if children:
+            return None
+        import psutil
+        memory = psutil.Process().memory_info()
+        # peak_wset only exists on Windows, elsewhere the current RSS is the best estimate
+        return getattr(memory, 'peak_wset', memory.rss) / (1024 * 1024)
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def children_cpu_seconds():
+    times = os.times()
+    return times.children_user + times.children_system
+
+def path_size(path):
+    """
+    Size in bytes of a file, or of all the files of a directory (Parquet datasets). 0 if it does not exist.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+class StageRecord:
+    """
+    Rows and bytes of a stage, filled by the code of the stage.
+    """
+    def __init__(self, name, fields=None):
+        self.name = name
+        self.fields = dict(fields or {})
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, *paths):
+        self.bytes_read += sum(path_size(path) for path in paths)
+
+    def wrote(self, *paths):
+        self.bytes_written += sum(path_size(path) for path in paths)
+
+class PipelineMetrics:
+    """
+    Record the metrics of the stages of a pipeline run and append them to a JSON lines file.
+
+    Each stage (see `stage`) writes one line with its wall time, CPU time of the process and
+    of its finished child processes, peak RSS, rows in/out and bytes read/written. All the
+    lines of a run share the same run_id, so runs can be compared over time.
+
+    With profile=True the whole run is also profiled with cProfile and saved next to the
+    metrics file (<run_id>.prof, plus a .txt summary of the slowest functions). cProfile only
+    sees the thread that enabled it, so the blocks run in other threads (the nodes of the DAG)
+    are profiled on their own with `profiled` and merged into the profile of the run.
+
+    Usage:
+        with PipelineMetrics(profile=True):
+            process_data()
+    """
+
+    def __init__(self, path=METRICS_FILE, profile=False):
+        """
+        Args:
+        - path (Path): JSON lines file where the metrics are appended.
+        - profile (bool): Profile the run with cProfile. Default is False.
+        """
+        self.path = Path(path)
+        self.profile = profile
+        self.run_id = f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+        self.records = []
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._thread_profiles = []
+        self._run = None
+
+    def record(self, data):
+        """Append the metrics of a stage to the file."""
+        data = {'run_id': self.run_id, **data}
+        with self._lock:
+            self.records.append(data)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(data, default=str) + '\n')
+
+    def summary(self):
+        """Log the wall time, CPU time and peak RSS of every stage of the run, nested by parent."""
+        parents = {data['stage']: data['parent'] for data in self.records}
+
+        def depth(name):
+            level = 0
+            while parents.get(name) and level < len(parents):
+                name = parents[name]
+                level += 1
+            return level
+
+        lines = []
+        # Parents start at the same time as their first child, so they go first on ties
+        for data in sorted(self.records, key=lambda data: (data['started'], depth(data['stage']))):
+            indent = 2 * depth(data['stage'])
+            lines.append(
+                f"{' ' * indent}{data['stage']:<{32 - indent}} {data['wall_s']:>9.2f} s wall "
+                f"{data['cpu_s']:>9.2f} s cpu {data['peak_rss_mb']:>8.0f} MiB"
+            )
+        logger.info(f"Stages of run {self.run_id}:\n" + '\n'.join(lines))
+
+    def add_profile(self, profiler):
+        """Merge the profile of a block run in another thread into the profile of the run."""
+        with self._lock:
+            self._thread_profiles.append(profiler)
+
+    def dump_profile(self):
+        prof_path = self.path.parent / f"{self.run_id}.prof"
+        text = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=text)
+        for profiler in self._thread_profiles:
+            stats.add(profiler)
+        stats.dump_stats(prof_path)
+
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        prof_path.with_suffix('.txt').write_text(text.getvalue())
+        logger.info(f"Profile of the run saved to {prof_path} (open it with snakeviz or pstats)")
+
+    def __enter__(self):
+        global _active
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        _active = self
+
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+        self._run = stage('run')
+        self._run.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+        try:
+            self._run.__exit__(exc_type, exc_value, traceback)
+        finally:
+            if self._profiler is not None:
+                self._profiler.disable()
+                self.dump_profile()
+            _active = None
+
+        self.summary()
+        logger.info(f"Metrics of run {self.run_id} appended to {self.path}")
+        return False
+
+def current_stage():
+    """
+    Name of the stage running in the current thread, None outside a stage.
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+@contextmanager
+def stage(name, parent=None, **fields):
+    """
+    Measure a stage of the pipeline run in progress.
+
+    The block can set the rows and bytes of the stage on the yielded StageRecord. Outside
+    a PipelineMetrics run nothing is measured. CPU time is the one of the whole process, so
+    it includes the other threads running at the same time (e.g. concurrent downloads).
+
+    Args:
+    - name (str): Name of the stage, e.g. 'water.read'.
+    - parent (str): Stage this one is nested under. Default is the stage running in the current
+      thread. Every thread has its own stack of stages, so the stages run in a pool of threads
+      (e.g. the nodes of the DAG) are given the stage that submitted them (see current_stage).
+    - fields: Extra values saved with the metrics, e.g. file='livestock_2013_raw_data.csv'.
+
+    Usage:
+        with stage('water.write') as record:
+            write_parquet(df, path)
+            record.rows_out = len(df)
+            record.wrote(path)
+    """
+    record = StageRecord(name, fields)
+    metrics = _active
+    if metrics is None:
+        yield record
+        return
+
+    stack = _local.__dict__.setdefault('stack', [])
+    if parent is None:
+        parent = stack[-1] if stack else None
+    stack.append(name)
+
+    started = datetime.datetime.now()
+    start_rss = peak_rss_mb()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_children = children_cpu_seconds()
+    status = 'ok'
+
+    try:
+        yield record
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        stack.pop()
+        children_peak = peak_rss_mb(children=True)
+        metrics.record({
+            'stage': name,
+            'parent': parent,
+            'status': status,
+            'started': started.isoformat(timespec='milliseconds'),
+            'wall_s': round(time.perf_counter() - start_wall, 4),
+            'cpu_s': round(time.process_time() - start_cpu, 4),
+            'children_cpu_s': round(children_cpu_seconds() - start_children, 4),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'rss_growth_mb': round(peak_rss_mb() - start_rss, 1),
+            'children_peak_rss_mb': round(children_peak, 1) if children_peak is not None else None,
+            'rows_in': record.rows_in,
+            'rows_out': record.rows_out,
+            'bytes_read': record.bytes_read,
+            'bytes_written': record.bytes_written,
+            **record.fields,
+        })
+
+@contextmanager
+def profiled():
+    """
+    Profile a block run outside the main thread when the run in progress is profiled.
+
+    The block gets its own cProfile profiler, which is merged into the profile of the run
+    when the block ends. Outside a profiled run nothing is done.
+    """
+    metrics = _active
+    if metrics is None or metrics._profiler is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Since Python 3.12 cProfile uses sys.monitoring, so the profiler of the run already
+        # sees every thread and a second one can not be enabled
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        metrics.add_profile(profiler)
+
+def timed(name):
+    """
+    Decorator measuring every call of a function as a stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
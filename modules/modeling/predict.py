@@ -1,29 +1,212 @@
+from functools import lru_cache
 from pathlib import Path
+import json
+import sys
+import time
 
+import joblib
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
 import typer
 from loguru import logger
-from tqdm import tqdm
 
+from dataset_modules.numeric import WATER_STRIP, parse_numeric_columns
+from dataset_modules.uploader import write_parquet
+from modeling.train import MODEL_FILE
 from modules.config import MODELS_DIR, PROCESSED_DATA_DIR
 
 app = typer.Typer()
 
+BATCH_SIZE = 64 * 1024
+WATCH_INTERVAL = 5
+WATCH_PATTERNS = ['*.parquet', '*.csv']
+
+
+@lru_cache(maxsize=None)
+def load_model(model_path=MODELS_DIR / MODEL_FILE):
+    """
+    Load the trained imputer once per process.
+
+    The arrays of the model (e.g. the training samples of KNNImputer) are memory mapped, so
+    several processes scoring with the same model share them instead of copying them.
+    """
+    model_path = Path(model_path)
+    if not model_path.exists():
+        raise FileNotFoundError(f"The model {model_path} does not exist. Train it first")
+
+    artifact = joblib.load(model_path, mmap_mode='r')
+    logger.info(f"Model {artifact['config']['name']} loaded from {model_path} (trained on {artifact['trained_on']})")
+    return artifact
+
+
+def predict_frame(df, artifact):
+    """
+    Impute the missing pollutants of a batch of samples.
+
+    Results as reported by the laboratory are converted to numbers as in the processed data
+    ('<0.5' is 0.5). Values that cannot be converted are logged and imputed like missing ones.
+
+    Returns:
+    - pd.DataFrame: The batch with the missing values of the model columns filled, and an
+      <column>_imputed flag for each of them.
+    """
+    columns = artifact['columns']
+    model = artifact['model']
+
+    values = df.reindex(columns=columns)
+    parse_numeric_columns(values, columns, strip=WATER_STRIP)
+    values = values.to_numpy(dtype='float64')
+    imputed = model[:-1].inverse_transform(model.transform(values))
+
+    predictions = df.copy()
+    missing = np.isnan(values)
+    for idx, column in enumerate(columns):
+        predictions[column] = np.where(missing[:, idx], imputed[:, idx], values[:, idx])
+        predictions[f"{column}_imputed"] = missing[:, idx]
+
+    return predictions
+
+
+def iter_batches(input_path, batch_size=BATCH_SIZE):
+    """
+    Read a Parquet file or dataset, or a CSV file, in batches of at most batch_size rows.
+    """
+    input_path = Path(input_path)
+
+    if input_path.suffix == '.csv':
+        yield from pd.read_csv(input_path, chunksize=batch_size)
+        return
+
+    dataset = ds.dataset(input_path, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+def score_batches(batches, artifact):
+    """
+    Score the batches as they are read.
+
+    The latency of each batch is logged at DEBUG level, and a summary with the median and 95th
+    percentile latency per batch and the throughput at INFO level once all the batches are scored.
+    """
+    total_rows = 0
+    latencies = []
+
+    for idx, batch in enumerate(batches):
+        start = time.perf_counter()
+        predictions = predict_frame(batch, artifact)
+        seconds = time.perf_counter() - start
+
+        total_rows += len(batch)
+        latencies.append(seconds)
+        logger.debug(f"Batch {idx}: {len(batch)} rows in {seconds * 1000:.1f} ms ({len(batch) / max(seconds, 1e-9):.0f} rows/s)")
+
+        yield predictions
+
+    if total_rows:
+        total_seconds = sum(latencies)
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        logger.info(
+            f"Scored {total_rows} rows in {len(latencies)} batches in {total_seconds:.2f} s: "
+            f"p50 {p50:.1f} ms, p95 {p95:.1f} ms per batch, {total_rows / max(total_seconds, 1e-9):.0f} rows/s"
+        )
+
+
+def score_file(input_path, output_path, artifact, batch_size=BATCH_SIZE):
+    """
+    Score a file batch by batch and write the predictions as they are produced, so the memory
+    used does not depend on the size of the file.
+    """
+    write_parquet(score_batches(iter_batches(input_path, batch_size), artifact), output_path)
+
 
 @app.command()
 def main(
-    # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
-    features_path: Path = PROCESSED_DATA_DIR / "test_features.csv",
-    model_path: Path = MODELS_DIR / "model.pkl",
-    predictions_path: Path = PROCESSED_DATA_DIR / "test_predictions.csv",
-    # -----------------------------------------
+    features_path: Path = PROCESSED_DATA_DIR / "water_quality_tidy_data.parquet",
+    model_path: Path = MODELS_DIR / MODEL_FILE,
+    # Not water_quality_imputed_data.parquet, the output of the neighbour imputer of processor.py
+    predictions_path: Path = PROCESSED_DATA_DIR / "water_quality_predictions.parquet",
+    batch_size: int = typer.Option(BATCH_SIZE, help="Rows scored in each batch"),
 ):
-    # ---- REPLACE THIS WITH YOUR OWN CODE ----
+    """
+    Impute the missing pollutants of a Parquet file or dataset, or a CSV file.
+    """
     logger.info("Performing inference for model...")
-    for i in tqdm(range(10), total=10):
-        if i == 5:
-            logger.info("Something happened for iteration 5.")
-    logger.success("Inference complete.")
-    # -----------------------------------------
+    score_file(features_path, predictions_path, load_model(model_path), batch_size=batch_size)
+    logger.success(f"Inference complete. Predictions saved to {predictions_path}")
+
+
+@app.command()
+def stdin(
+    model_path: Path = MODELS_DIR / MODEL_FILE,
+    batch_size: int = typer.Option(1, help="Records scored together. 1 answers each record as it arrives"),
+):
+    """
+    Read JSON records (one per line) from stdin and write the scored records to stdout.
+    """
+    # stdout is used for the records, the logs go to stderr
+    logger.remove()
+    logger.add(sys.stderr)
+    artifact = load_model(model_path)
+
+    def batches():
+        records = []
+        for line in sys.stdin:
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Skipping a record that is not valid JSON: {e}")
+                    continue
+            if len(records) >= batch_size:
+                yield pd.DataFrame.from_records(records)
+                records = []
+        if records:
+            yield pd.DataFrame.from_records(records)
+
+    for predictions in score_batches(batches(), artifact):
+        for record in predictions.to_json(orient='records', lines=True, date_format='iso').splitlines():
+            sys.stdout.write(record + '\n')
+        sys.stdout.flush()
+
+
+@app.command()
+def watch(
+    input_dir: Path = typer.Argument(..., help="Directory where the new monitoring results are saved"),
+    output_dir: Path = typer.Option(None, help="Directory of the predictions. Default is input_dir/predictions"),
+    model_path: Path = MODELS_DIR / MODEL_FILE,
+    batch_size: int = typer.Option(BATCH_SIZE, help="Rows scored in each batch"),
+    interval: float = typer.Option(WATCH_INTERVAL, help="Seconds between checks of the directory"),
+):
+    """
+    Score every new or modified file saved in a directory, keeping the model loaded.
+    """
+    artifact = load_model(model_path)
+    output_dir = output_dir or input_dir / 'predictions'
+    output_dir.mkdir(parents=True, exist_ok=True)
+    seen = {}
+
+    logger.info(f"Watching {input_dir} for new files (Ctrl+C to stop)")
+    try:
+        while True:
+            for path in sorted(f for pattern in WATCH_PATTERNS for f in input_dir.glob(pattern)):
+                mtime = path.stat().st_mtime_ns
+                # Files modified during the last interval may still be being written
+                if seen.get(path) == mtime or time.time() - mtime / 1e9 < interval:
+                    continue
+
+                output_path = output_dir / f"{path.stem}_predictions.parquet"
+                try:
+                    score_file(path, output_path, artifact, batch_size=batch_size)
+                    logger.success(f"Predictions of {path.name} saved to {output_path}")
+                except Exception as e:
+                    logger.error(f"Could not score {path.name}: {e}")
+                seen[path] = mtime
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
 
 
 if __name__ == "__main__":
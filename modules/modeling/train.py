@@ -1,29 +1,213 @@
 from pathlib import Path
+import datetime
+import json
 
+import joblib
+import numpy as np
+import pandas as pd
 import typer
+import yaml
+from joblib import Parallel, delayed, parallel_config
 from loguru import logger
-from tqdm import tqdm
 
-from modules.config import MODELS_DIR, PROCESSED_DATA_DIR
+from features import load_features
+from modules.config import MODELS_DIR, POLLUTANTS
 
 app = typer.Typer()
 
+MODEL_FILE = "imputer.joblib"
+METRICS_FILE = "imputer_metrics.csv"
+
+# Imputers of sklearn.impute, imported when a model is built so predict.py and --help do
+# not load scikit-learn
+ESTIMATORS = {
+    'simple': 'SimpleImputer',
+    'knn': 'KNNImputer',
+    'iterative': 'IterativeImputer',
+}
+
+# Model configurations compared by the harness. A YAML or JSON file with the same structure
+# can be passed with --grid.
+DEFAULT_GRID = [
+    {'name': 'median', 'estimator': 'simple', 'params': {'strategy': 'median'}},
+    {'name': 'knn_2', 'estimator': 'knn', 'params': {'n_neighbors': 2}},
+    {'name': 'knn_5', 'estimator': 'knn', 'params': {'n_neighbors': 5, 'weights': 'distance'}},
+    {'name': 'knn_10', 'estimator': 'knn', 'params': {'n_neighbors': 10, 'weights': 'distance'}},
+    {'name': 'mice_10', 'estimator': 'iterative', 'params': {'max_iter': 10, 'random_state': 0}},
+    {'name': 'mice_30', 'estimator': 'iterative', 'params': {'max_iter': 30, 'random_state': 0}},
+]
+
+# Fraction of the known values hidden in each validation fold to score the reconstruction
+MASK_FRACTION = 0.2
+# Successive halving: each round keeps 1/ETA of the configurations and gives them ETA times more rows
+ETA = 3
+MIN_ROWS = 200
+
+
+def build_model(config):
+    """
+    Pipeline of a configuration: log1p of the skewed concentrations, standard scaling and the imputer.
+    """
+    from sklearn.experimental import enable_iterative_imputer  # noqa: F401
+    from sklearn import impute
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import FunctionTransformer, StandardScaler
+
+    return make_pipeline(
+        FunctionTransformer(np.log1p, inverse_func=np.expm1, check_inverse=False, feature_names_out='one-to-one'),
+        StandardScaler(),
+        # Columns without values in a fold are kept, so every fold returns all the columns
+        getattr(impute, ESTIMATORS[config['estimator']])(**{'keep_empty_features': True, **config.get('params', {})}),
+    )
+
+
+def mask_values(X, targets, fraction=MASK_FRACTION, random_state=0):
+    """
+    Hide a fraction of the known values of the target columns.
+
+    Returns:
+    - tuple (np.ndarray, np.ndarray): The data with the hidden values as NaN and the boolean mask of hidden values.
+    """
+    rng = np.random.default_rng(random_state)
+    mask = np.zeros(X.shape, dtype=bool)
+    mask[:, targets] = ~np.isnan(X[:, targets]) & (rng.random((X.shape[0], len(targets))) < fraction)
+
+    masked = X.copy()
+    masked[mask] = np.nan
+    return masked, mask
+
+
+def score_fold(config, X, targets, train_idx, test_idx, n_rows, random_state=0):
+    """
+    Fit a configuration on n_rows of the training rows and score it on the validation rows.
+
+    The score is the RMSE, in the scaled log space, of the hidden values reconstructed by the imputer.
+    """
+    rng = np.random.default_rng(random_state)
+    if n_rows < len(train_idx):
+        train_idx = rng.choice(train_idx, size=n_rows, replace=False)
+
+    model = build_model(config).fit(X[train_idx])
+    masked, mask = mask_values(X[test_idx], targets, random_state=random_state)
+
+    preprocess = model[:-1]
+    expected = preprocess.transform(X[test_idx])
+    reconstructed = model[-1].transform(preprocess.transform(masked))
+
+    return float(np.sqrt(np.mean((expected[mask] - reconstructed[mask]) ** 2)))
+
+
+def successive_halving(grid, X, targets, folds=5, n_jobs=-1, eta=ETA, min_rows=MIN_ROWS, random_state=0):
+    """
+    Compare the configurations with successive halving over the number of training rows.
+
+    Every round runs all the (configuration, fold) pairs in parallel, keeps the best 1/eta of
+    the configurations and multiplies their rows by eta, until one configuration is left or
+    all the rows are used.
+
+    Returns:
+    - pd.DataFrame: Mean and standard deviation of the score of each configuration in each round.
+    """
+    from sklearn.model_selection import KFold
+
+    splits = list(KFold(n_splits=folds, shuffle=True, random_state=random_state).split(X))
+    max_rows = min(len(train_idx) for train_idx, _ in splits)
+    n_rounds = max(1, int(np.ceil(np.log(len(grid)) / np.log(eta))))
+    n_rows = max(min_rows, int(max_rows / eta ** (n_rounds - 1)))
+    candidates = list(grid)
+    results = []
+
+    # One thread per worker, so n_jobs is the real core budget
+    with parallel_config(backend='loky', n_jobs=n_jobs, inner_max_num_threads=1):
+        for round_idx in range(n_rounds):
+            n_rows = min(n_rows, max_rows)
+            logger.info(f"Round {round_idx}: {len(candidates)} configurations with {n_rows} rows")
+
+            scores = Parallel()(
+                delayed(score_fold)(config, X, targets, train_idx, test_idx, n_rows, random_state + fold)
+                for config in candidates
+                for fold, (train_idx, test_idx) in enumerate(splits)
+            )
+            scores = np.array(scores).reshape(len(candidates), len(splits))
+
+            for config, config_scores in zip(candidates, scores):
+                results.append({
+                    'round': round_idx,
+                    'name': config['name'],
+                    'estimator': config['estimator'],
+                    'params': json.dumps(config.get('params', {}), sort_keys=True),
+                    'rows': n_rows,
+                    'rmse_mean': config_scores.mean(),
+                    'rmse_std': config_scores.std(),
+                })
+
+            order = np.argsort(scores.mean(axis=1))
+            candidates = [candidates[idx] for idx in order[:max(1, len(candidates) // eta)]]
+
+            if len(candidates) == 1 or n_rows >= max_rows:
+                break
+            n_rows *= eta
+
+    return pd.DataFrame(results)
+
+
+def load_grid(path=None):
+    """
+    Read the model configurations from a YAML or JSON file, or use DEFAULT_GRID.
+    """
+    if path is None:
+        return DEFAULT_GRID
+
+    with open(path) as f:
+        grid = yaml.safe_load(f)
+
+    unknown = [config['estimator'] for config in grid if config['estimator'] not in ESTIMATORS]
+    if unknown:
+        raise ValueError(f"Unknown estimators {unknown}. Use one of {list(ESTIMATORS)}")
+    return grid
+
 
 @app.command()
 def main(
-    # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
-    features_path: Path = PROCESSED_DATA_DIR / "features.csv",
-    labels_path: Path = PROCESSED_DATA_DIR / "labels.csv",
-    model_path: Path = MODELS_DIR / "model.pkl",
-    # -----------------------------------------
+    model_path: Path = MODELS_DIR / MODEL_FILE,
+    metrics_path: Path = MODELS_DIR / METRICS_FILE,
+    grid_path: Path = typer.Option(None, "--grid", help="YAML or JSON file with the model configurations"),
+    columns: list[str] = typer.Option(None, help="Feature columns used. Default is POLLUTANTS"),
+    folds: int = typer.Option(5, help="Number of cross-validation folds"),
+    n_jobs: int = typer.Option(-1, help="Number of cores used. -1 uses all of them"),
 ):
-    # ---- REPLACE THIS WITH YOUR OWN CODE ----
-    logger.info("Training some model...")
-    for i in tqdm(range(10), total=10):
-        if i == 5:
-            logger.info("Something happened for iteration 5.")
-    logger.success("Modeling training complete.")
-    # -----------------------------------------
+    """
+    Train the pollutant imputer, comparing the configurations of the grid with cross-validation.
+    """
+    grid = load_grid(grid_path)
+    columns = columns or POLLUTANTS
+    targets = [idx for idx, column in enumerate(columns) if column in POLLUTANTS]
+
+    # Only the columns used are read from the feature store
+    features = load_features(columns=columns)
+    X = features[columns].to_numpy(dtype='float64')
+    X = X[~np.isnan(X).all(axis=1)]
+    logger.info(f"Training with {X.shape[0]} samples and {X.shape[1]} columns")
+
+    metrics = successive_halving(grid, X, targets, folds=folds, n_jobs=n_jobs)
+    last_round = metrics[metrics['round'] == metrics['round'].max()]
+    best = last_round.sort_values('rmse_mean').iloc[0]
+    config = next(config for config in grid if config['name'] == best['name'])
+    logger.info(f"Best configuration: {best['name']} (RMSE {best['rmse_mean']:.4f} ± {best['rmse_std']:.4f})")
+
+    model = build_model(config).fit(X)
+
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+    joblib.dump({
+        'model': model,
+        'columns': columns,
+        'config': config,
+        'rmse': float(best['rmse_mean']),
+        'trained_on': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }, model_path)
+    metrics.to_csv(metrics_path, index=False)
+
+    logger.success(f"Modeling training complete. Model saved to {model_path}")
 
 
 if __name__ == "__main__":
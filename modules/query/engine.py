@@ -0,0 +1,141 @@
+from pathlib import Path
+from functools import lru_cache
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dataset_modules.uploader import open_dataset
+from modules.config import PROCESSED_DATA_DIR, POLLUTANTS
+
+# Processed outputs registered as views
+VIEWS = {
+    'water': PROCESSED_DATA_DIR / 'water_quality_tidy_data.parquet',
+    'livestock': PROCESSED_DATA_DIR / 'livestock_tidy_data.parquet',
+    'water_livestock_yearly': PROCESSED_DATA_DIR / 'water_livestock_yearly.parquet',
+}
+
+def register_view(name, path):
+    """
+    Register a Parquet file or hive-partitioned dataset as a view.
+
+    Args:
+    - name (str): Name of the view.
+    - path (Path): Parquet file or directory of the dataset.
+    """
+    VIEWS[name] = Path(path)
+    get_view.cache_clear()
+
+@lru_cache(maxsize=None)
+def get_view(name):
+    """
+    Open a view as an Arrow dataset. Only the metadata is read; the data is read by the queries.
+
+    Integer partition columns (Año of the livestock output) are int64, as in the other views.
+    """
+    if name not in VIEWS:
+        raise KeyError(f"Unknown view {name}. Available views: {list(VIEWS)}")
+
+    path = VIEWS[name]
+    if not path.exists():
+        raise FileNotFoundError(f"The file {path} does not exist. Process the data first")
+
+    return open_dataset(path)
+
+def scan(name, columns=None, filters=None):
+    """
+    Read the selected columns and rows of a view.
+
+    Only the requested columns are read, filters on partition columns skip the partitions that
+    do not match, and the other filters skip row groups using their statistics. Files and row
+    groups are read in parallel.
+
+    Args:
+    - name (str): Name of the view.
+    - columns (list of str): Columns to read. Default is all the columns.
+    - filters (list of tuple): Filters in pyarrow format, e.g. [('Año', '>=', 2018)].
+
+    Returns:
+    - pa.Table: The selected data.
+    """
+    expression = pq.filters_to_expression(filters) if filters else None
+    return get_view(name).to_table(columns=columns, filter=expression, use_threads=True)
+
+def pollutant_percentiles(pollutants=POLLUTANTS, percentiles=(0.5, 0.9, 0.95), sites=None, years=None):
+    """
+    Percentiles of each pollutant per monitoring site and year.
+
+    Only the requested columns and partitions are read with Arrow. The percentiles are then
+    computed per group with pandas, interpolating linearly between samples as numpy and pandas
+    do, so they match the values of the notebooks.
+
+    Args:
+    - pollutants (list of str): Pollutant columns.
+    - percentiles (tuple of float): Percentiles between 0 and 1.
+    - sites (list of str): CLAVE SITIO to include. Default is all of them.
+    - years (list of int): Years to include. Default is all of them.
+
+    Returns:
+    - pa.Table: One row per CLAVE SITIO and Año with <pollutant>_count and <pollutant>_p<N> columns.
+    """
+    keys = ['CLAVE SITIO', 'Año']
+    filters = []
+    if sites is not None:
+        filters.append(('CLAVE SITIO', 'in', list(sites)))
+    if years is not None:
+        filters.append(('Año', 'in', list(years)))
+
+    pollutants = list(pollutants)
+    percentiles = list(percentiles)
+    table = scan('water', columns=keys + pollutants, filters=filters or None)
+
+    grouped = table.to_pandas().groupby(keys, observed=True, sort=True)[pollutants]
+    counts = grouped.count()
+    quantiles = {q: grouped.quantile(q) for q in percentiles}
+
+    result = counts[[]].copy()
+    for pollutant in pollutants:
+        result[f"{pollutant}_count"] = counts[pollutant]
+        for q in percentiles:
+            result[f"{pollutant}_p{round(q * 100)}"] = quantiles[q][pollutant]
+
+    # Groups without samples of a pollutant have null percentiles
+    return pa.Table.from_pandas(result.reset_index(), preserve_index=False)
+
+def livestock_totals(group_by=('Año', 'Nombre_Municipio', 'Nombre_Especie'), years=None, municipalities=None, species=None):
+    """
+    Total Volumen and Valor Total of livestock production.
+
+    Args:
+    - group_by (tuple of str): Columns to group by.
+    - years (list of int): Years to include. Default is all of them.
+    - municipalities (list of str): Municipalities (Nombre_Municipio) to include. Default is all of them.
+    - species (list of str): Species (Nombre_Especie) to include. Default is all of them.
+
+    Returns:
+    - pa.Table: One row per group with Volumen_sum, Valor Total_sum and the number of records.
+    """
+    filters = []
+    if years is not None:
+        filters.append(('Año', 'in', list(years)))
+    if municipalities is not None:
+        filters.append(('Nombre_Municipio', 'in', list(municipalities)))
+    if species is not None:
+        filters.append(('Nombre_Especie', 'in', list(species)))
+
+    table = scan('livestock', columns=list(group_by) + ['Volumen', 'Valor Total'], filters=filters or None)
+
+    # Dictionary encoded columns are grouped by their values
+    for name in group_by:
+        if pa.types.is_dictionary(table.schema.field(name).type):
+            idx = table.schema.get_field_index(name)
+            table = table.set_column(idx, name, table[name].cast(table.schema.field(name).type.value_type))
+
+    aggregated = table.group_by(list(group_by)).aggregate([
+        ('Volumen', 'sum'),
+        ('Valor Total', 'sum'),
+        ('Volumen', 'count', pc.CountOptions(mode='all')),
+    ])
+    aggregated = aggregated.rename_columns(
+        [name if name != 'Volumen_count' else 'records' for name in aggregated.column_names]
+    )
+
+    return aggregated.sort_by([(key, 'ascending') for key in group_by])
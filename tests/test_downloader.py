@@ -0,0 +1,117 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import pytest
+from dataset_modules.downloader import create_session, fetch
+
+BODY = os.urandom(3 * 1024 * 1024 + 123)
+
+class RangeServer(ThreadingHTTPServer):
+    """
+    Local server of BODY that supports Range requests and can drop the first transfer halfway.
+    """
+    def __init__(self, interrupt=False, ranges=True):
+        super().__init__(('127.0.0.1', 0), RangeHandler)
+        self.interrupt = interrupt
+        self.ranges = ranges
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/water_quality_raw_data.xlsb"
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        requested = self.headers.get('Range')
+        server.requests.append(requested)
+
+        start = int(requested[len('bytes='):].rstrip('-')) if requested and server.ranges else 0
+        if start >= len(BODY):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = BODY[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f"bytes {start}-{len(BODY) - 1}/{len(BODY)}")
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+
+        if server.interrupt:
+            # Send half of the body and close the connection
+            server.interrupt = False
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            return
+
+        self.wfile.write(body)
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**kwargs):
+        server = RangeServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def test_fetch_resumes_an_interrupted_transfer(serve, tmp_path):
+    server = serve(interrupt=True)
+    part_path = tmp_path / 'water_quality_raw_data.xlsb.part'
+
+    with create_session() as session:
+        headers = fetch(session, server.url, part_path, chunk_size=64 * 1024)
+
+    assert part_path.read_bytes() == BODY
+    assert headers['ETag'] == '"v1"'
+    # The second request only asks for the bytes that were not written (the last incomplete
+    # chunk of the interrupted transfer is lost)
+    assert server.requests[0] is None
+    offset = int(server.requests[1][len('bytes='):].rstrip('-'))
+    assert 0 < offset <= len(BODY) // 2
+
+def test_fetch_resumes_a_part_file_of_a_previous_run(serve, tmp_path):
+    server = serve()
+    part_path = tmp_path / 'water_quality_raw_data.xlsb.part'
+    part_path.write_bytes(BODY[:1000])
+
+    with create_session() as session:
+        fetch(session, server.url, part_path)
+
+    assert part_path.read_bytes() == BODY
+    assert server.requests == ['bytes=1000-']
+
+def test_fetch_starts_over_when_the_server_ignores_range(serve, tmp_path):
+    server = serve(ranges=False)
+    part_path = tmp_path / 'water_quality_raw_data.xlsb.part'
+    part_path.write_bytes(b'old partial body')
+
+    with create_session() as session:
+        fetch(session, server.url, part_path)
+
+    assert part_path.read_bytes() == BODY
+
+def test_fetch_starts_over_when_the_part_file_is_larger(serve, tmp_path):
+    server = serve()
+    part_path = tmp_path / 'water_quality_raw_data.xlsb.part'
+    part_path.write_bytes(BODY + b'extra')
+
+    with create_session() as session:
+        fetch(session, server.url, part_path)
+
+    assert part_path.read_bytes() == BODY
+    assert server.requests == [f"bytes={len(BODY) + 5}-", None]
@@ -0,0 +1,84 @@
+import shutil
+import subprocess
+import pytest
+from dvc_modules.dvc_manager import DvcSession
+
+pytestmark = pytest.mark.skipif(shutil.which('dvc') is None or shutil.which('git') is None, reason="dvc and git are required")
+
+FILES = {
+    'water_quality_tidy_data.parquet': b'water',
+    'water_livestock_yearly.parquet': b'yearly',
+    'neighbor_imputer.joblib': b'imputer',
+}
+
+@pytest.fixture
+def dvc_repo(tmp_path, monkeypatch):
+    """
+    Git and DVC repository with a local directory as its default remote.
+    """
+    monkeypatch.setenv('DVC_NO_ANALYTICS', '1')
+    repo, remote = tmp_path / 'repo', tmp_path / 'remote'
+    repo.mkdir()
+    remote.mkdir()
+
+    for command in [['git', 'init', '-q'], ['dvc', 'init', '-q'], ['dvc', 'remote', 'add', '-d', 'origin', str(remote)]]:
+        subprocess.run(command, cwd=repo, check=True)
+
+    for name, content in FILES.items():
+        (repo / name).write_bytes(content)
+
+    return repo, remote
+
+def remote_files(remote):
+    return [path for path in remote.rglob('*') if path.is_file()]
+
+@pytest.mark.parametrize('use_api', [True, False])
+def test_flush_adds_and_pushes_all_the_files_at_once(dvc_repo, use_api):
+    repo, remote = dvc_repo
+    session = DvcSession(remote_name='origin', use_api=use_api, repo_path=repo)
+
+    calls = []
+    add_and_push = session.add_and_push
+    session.add_and_push = lambda paths: (calls.append(paths), add_and_push(paths))
+
+    for name in FILES:
+        session.track(repo / name)
+    # Files tracked twice are added once
+    session.track(repo / 'neighbor_imputer.joblib')
+
+    session.flush()
+
+    assert calls == [[repo / name for name in FILES]]
+    assert all((repo / f"{name}.dvc").exists() for name in FILES)
+    assert len(remote_files(remote)) == len(FILES)
+
+    # The files were taken by the flush, a second one does nothing
+    session.flush()
+    assert len(calls) == 1
+
+def test_flush_without_push_only_adds(dvc_repo):
+    repo, remote = dvc_repo
+
+    with DvcSession(remote_name='origin', repo_path=repo, push=False) as session:
+        for name in FILES:
+            session.track(repo / name)
+
+    assert all((repo / f"{name}.dvc").exists() for name in FILES)
+    assert remote_files(remote) == []
+
+def test_failed_run_is_not_added(dvc_repo):
+    repo, remote = dvc_repo
+
+    with pytest.raises(ValueError):
+        with DvcSession(remote_name='origin', repo_path=repo) as session:
+            session.track(repo / 'water_quality_tidy_data.parquet')
+            raise ValueError("stage failed")
+
+    assert not (repo / 'water_quality_tidy_data.parquet.dvc').exists()
+    assert remote_files(remote) == []
+
+def test_track_missing_file(dvc_repo):
+    repo, _ = dvc_repo
+
+    with pytest.raises(FileNotFoundError):
+        DvcSession(repo_path=repo).track(repo / 'missing.parquet')
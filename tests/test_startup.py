@@ -0,0 +1,22 @@
+import pytest
+from benchmarks.startup import ENTRY_POINTS, check_entry_point
+
+# Import times depend on the machine, so the budgets of benchmarks/startup.py are enforced
+# with some headroom for slower machines (e.g. CI runners)
+BUDGET_MARGIN = 1.5
+
+@pytest.mark.parametrize('name', list(ENTRY_POINTS))
+def test_help_stays_within_its_import_budget(name):
+    """
+    A cold `--help` of every entry point must not import the dependencies of its commands and
+    must stay under its import time budget.
+    """
+    result = check_entry_point(name, ENTRY_POINTS[name], repeat=3)
+
+    assert not result['forbidden'], f"{name} --help imports {', '.join(result['forbidden'])}"
+
+    slowest = ', '.join(f"{module} {us / 1000:.0f} ms" for module, us in result['slowest'])
+    assert result['import_ms'] <= result['budget_ms'] * BUDGET_MARGIN, (
+        f"{name} imports take {result['import_ms']:.0f} ms, over its budget of {result['budget_ms']} ms "
+        f"(+{BUDGET_MARGIN - 1:.0%}). Slowest: {slowest}"
+    )
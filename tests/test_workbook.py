@@ -0,0 +1,48 @@
+import os
+import pandas as pd
+import pytest
+import yaml
+from dataset_modules.workbook import file_md5, get_md5, load_workbook
+
+def write_dvc_file(path, md5):
+    path.with_name(path.name + '.dvc').write_text(yaml.safe_dump({'outs': [{'md5': md5, 'size': path.stat().st_size, 'path': path.name}]}))
+
+def test_get_md5_uses_the_dvc_file_while_it_is_up_to_date(tmp_path):
+    path = tmp_path / 'water_quality_raw_data.xlsb'
+    path.write_bytes(b'version 1')
+    write_dvc_file(path, 'recorded')
+    # The file is older than its .dvc file
+    os.utime(path, ns=(0, 0))
+
+    assert get_md5(path) == 'recorded'
+
+def test_get_md5_hashes_a_file_replaced_after_the_dvc_file(tmp_path):
+    path = tmp_path / 'water_quality_raw_data.xlsb'
+    path.write_bytes(b'version 1')
+    write_dvc_file(path, file_md5(path))
+
+    # Downloaded again with the same size
+    path.write_bytes(b'version 2')
+    dvc_mtime = path.with_name(path.name + '.dvc').stat().st_mtime_ns
+    os.utime(path, ns=(dvc_mtime + 10**9, dvc_mtime + 10**9))
+
+    assert get_md5(path) == file_md5(path)
+
+def test_load_workbook_returns_the_same_sheets_with_and_without_cache(tmp_path):
+    pytest.importorskip('openpyxl')
+    path = tmp_path / 'water_quality_raw_data.xlsx'
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame({'CLAVE': ['A', 'B', 'C'], 'RESULTADO': [1.5, 'x', None], 2019: [1, 2, 3]}).to_excel(writer, sheet_name='results', index=False)
+        pd.DataFrame({'CLAVE': ['A'], 'SITIO': ['Río Sonora']}).to_excel(writer, sheet_name='sites', index=False)
+
+    cache_dir = tmp_path / 'cache'
+    miss = load_workbook(path, cache_dir=cache_dir)
+    hit = load_workbook(path, cache_dir=cache_dir)
+    uncached = load_workbook(path, use_cache=False)
+
+    assert len(miss) == len(hit) == len(uncached) == 2
+    for sheets in zip(miss, hit, uncached):
+        pd.testing.assert_frame_equal(sheets[0], sheets[1])
+        pd.testing.assert_frame_equal(sheets[0], sheets[2])
+    assert miss[0]['RESULTADO'].tolist() == ['1.5', 'x', None]
+    assert list(miss[0].columns) == ['CLAVE', 'RESULTADO', '2019']